@@ -0,0 +1,292 @@
+"""Index of the modules found in addons paths.
+
+The index is built by the recipe at buildout time, and stored as a JSON file.
+It maps each module name to the directory that holds it, together with a
+checksum of its manifest and its direct dependencies.
+
+At runtime, it spares OpenERP/Odoo the scanning of all addons paths each time
+it looks for a module (see :mod:`anybox.recipe.odoo.runtime.patch_odoo`).
+
+This module must stay importable without buildout nor OpenERP/Odoo.
+"""
+import os
+import ast
+import json
+import heapq
+import hashlib
+import logging
+import ConfigParser
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAMES = ('__manifest__.py', '__openerp__.py', '__terp__.py')
+"""Possible names for module manifests, by order of precedence."""
+
+CONFIG_SECTION = 'buildout'
+"""Section of the OpenERP/Odoo configuration file that holds ``CONFIG_KEY``.
+"""
+
+CONFIG_KEY = 'addons_index'
+"""Key for the path to the index in the OpenERP/Odoo configuration file."""
+
+IGNORED_EXTENSIONS = ('.pyc', '.pyo')
+"""Extensions of files that don't count in :func:`module_checksum`."""
+
+IGNORED_DIRS = ('.git', '.hg', '.bzr', '.svn')
+"""Directories that don't count in :func:`module_checksum`."""
+
+
+def manifest_path(module_dir):
+    """Return the path to the manifest of module_dir, or None."""
+    for name in MANIFEST_NAMES:
+        path = os.path.join(module_dir, name)
+        if os.path.isfile(path):
+            return path
+
+
+def read_manifest(path):
+    """Read the manifest at path without executing it.
+
+    :returns: the checksum of the manifest and its contents as a dict, that
+              is empty if the manifest isn't a plain literal.
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    checksum = hashlib.sha256(source).hexdigest()
+    try:
+        manifest = ast.literal_eval(source)
+    except (SyntaxError, ValueError):
+        manifest = None
+    if not isinstance(manifest, dict):
+        logger.warn("Could not read manifest %r", path)
+        manifest = {}
+    return checksum, manifest
+
+
+def build_index(addons_paths):
+    """Index the modules found in addons_paths.
+
+    As with OpenERP/Odoo itself, if a module name is found in several addons
+    paths, the first one wins, the others are said to be *shadowed*.
+
+    :returns: a JSON serializable dict, with the following keys:
+
+              - ``addons_paths``: the list of addons paths
+              - ``modules``: a dict whose keys are module names, and values
+                dicts with ``path``, ``manifest_sha256``, ``depends`` and
+                ``installable`` keys
+              - ``shadowed``: a dict whose keys are module names, and values
+                the lists of directories of the shadowed ones
+              - ``mtimes``: modification times of the addons paths, see
+                :func:`is_fresh`
+    """
+    modules = {}
+    shadowed = {}
+    mtimes = {}
+    for addons_path in addons_paths:
+        if not os.path.isdir(addons_path):
+            continue
+        mtimes[addons_path] = os.stat(addons_path).st_mtime
+        for name in sorted(os.listdir(addons_path)):
+            module_dir = os.path.join(addons_path, name)
+            manifest = manifest_path(module_dir)
+            if manifest is None:
+                continue
+            if name in modules:
+                shadowed.setdefault(name, []).append(module_dir)
+                continue
+            checksum, contents = read_manifest(manifest)
+            modules[name] = dict(
+                path=module_dir,
+                manifest_sha256=checksum,
+                depends=list(contents.get('depends', ())),
+                installable=bool(contents.get('installable', True)))
+    return dict(addons_paths=list(addons_paths),
+                modules=modules,
+                shadowed=shadowed,
+                mtimes=mtimes)
+
+
+def is_fresh(index):
+    """Tell if no module has been added or removed since index was built.
+
+    This compares the modification times of the addons paths with those
+    recorded in the index, which is a matter of one ``stat`` per addons path.
+    Changes inside existing modules are not detected.
+    """
+    mtimes = index.get('mtimes', {})
+    for addons_path in index['addons_paths']:
+        try:
+            mtime = os.stat(addons_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != mtimes.get(addons_path):
+            return False
+    return True
+
+
+def installable_modules(index):
+    """List installable modules, each one after all its dependencies.
+
+    Dependencies that aren't in the index are ignored. Among modules whose
+    dependencies are satisfied, the alphabetical order is used, so that the
+    result is reproducible. Modules involved in dependency cycles end the
+    list.
+    """
+    modules = dict((name, module) for name, module in index['modules'].items()
+                   if module['installable'])
+    depends = dict((name, set(dep for dep in module['depends']
+                              if dep in modules and dep != name))
+                   for name, module in modules.items())
+    dependents = dict((name, []) for name in modules)
+    for name, deps in depends.items():
+        for dep in deps:
+            dependents[dep].append(name)
+
+    ready = [name for name, deps in depends.items() if not deps]
+    heapq.heapify(ready)
+    result = []
+    while ready:
+        name = heapq.heappop(ready)
+        result.append(name)
+        for dependent in dependents[name]:
+            deps = depends[dependent]
+            deps.discard(name)
+            if not deps:
+                heapq.heappush(ready, dependent)
+
+    if len(result) < len(modules):
+        done = set(result)
+        cycling = sorted(name for name in modules if name not in done)
+        logger.warn("Dependency cycle among modules %s",
+                    ', '.join(cycling))
+        result.extend(cycling)
+    return result
+
+
+def module_checksum(module_dir):
+    """Return a checksum of the contents of all files in module_dir.
+
+    Compiled Python files and VCS metadata are ignored. Being computed from
+    the files themselves, this reflects any change, be it uncommitted or
+    made after the index has been built.
+    """
+    checksum = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(module_dir):
+        dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRS)
+        for name in sorted(filenames):
+            if name.endswith(IGNORED_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            file_checksum = hashlib.sha256()
+            try:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), ''):
+                        file_checksum.update(chunk)
+            except IOError:  # e.g., broken symbolic link
+                pass
+            checksum.update('%s\0%s\n' % (
+                os.path.relpath(path, module_dir),
+                file_checksum.hexdigest()))
+    return checksum.hexdigest()
+
+
+def module_fingerprints(index, names=None):
+    """Return what identifies the current state of the indexed modules.
+
+    :param names: if not ``None``, restrict to the modules of that iterable
+    :returns: a dict whose keys are module names and values their
+              :func:`module_checksum`. Modules whose directory doesn't exist
+              any more are left out.
+    """
+    modules = index['modules']
+    if names is None:
+        names = modules
+    return dict((name, module_checksum(modules[name]['path']))
+                for name in names
+                if name in modules and os.path.isdir(modules[name]['path']))
+
+
+def modules_to_update(index, installed, previous, current=None):
+    """Compute the installed modules that changed, and their dependents.
+
+    A module is considered changed if its fingerprint (see
+    :func:`module_fingerprints`) differs from the previous one, or if there
+    is no previous one. All installed modules that depend on it, directly
+    or not, are then to be updated as well.
+
+    Installed modules that can't be fingerprinted, not being in the index
+    or their directory missing, are not considered changed: nothing can
+    tell, and they would otherwise be updated on every run.
+
+    :param installed: iterable of names of installed modules
+    :param previous: former result of :func:`module_fingerprints`
+    :param current: current result of :func:`module_fingerprints` for the
+                    installed modules, computed if not given
+    :returns: the sorted list of modules to update
+    """
+    installed = set(installed)
+    if current is None:
+        current = module_fingerprints(index, installed)
+    unknown = sorted(installed.difference(current))
+    if unknown:
+        logger.debug("Can't tell if modules %s changed, not in the "
+                     "addons index", ', '.join(unknown))
+    changed = set(name for name in installed
+                  if name in current and current[name] != previous.get(name))
+
+    dependents = {}
+    for name, module in index['modules'].items():
+        for dep in module['depends']:
+            dependents.setdefault(dep, []).append(name)
+    to_update = set()
+    while changed:
+        name = changed.pop()
+        to_update.add(name)
+        changed.update(dependent for dependent in dependents.get(name, ())
+                       if dependent in installed
+                       and dependent not in to_update)
+    return sorted(to_update)
+
+
+def write_index(index, path):
+    """Write index to path, atomically, and only if it changed.
+
+    :returns: ``True`` if the file has been written
+    """
+    dumped = json.dumps(index, sort_keys=True, separators=(',', ':'))
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == dumped:
+                return False
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(dumped)
+    os.rename(tmp_path, path)
+    return True
+
+
+def load_index(path):
+    """Load the index stored at path.
+
+    :returns: the index, or ``None`` if it can't be read.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError), exc:
+        logger.warn("Could not load addons index %r: %s", path, exc)
+
+
+def load_index_from_config(conffile):
+    """Load the index referenced by an OpenERP/Odoo configuration file.
+
+    :returns: the index, or ``None`` if there's none.
+    """
+    parser = ConfigParser.RawConfigParser()
+    parser.read(conffile)
+    try:
+        path = parser.get(CONFIG_SECTION, CONFIG_KEY)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return None
+    return load_index(path)
@@ -3,13 +3,16 @@ from os.path import join, basename
 import os
 import sys
 import re
-import urllib
 import tarfile
 import setuptools
 import logging
 import stat
 import imp
 import shutil
+import tempfile
+import posixpath
+import json
+import hashlib
 import ConfigParser
 import distutils.core
 import pkg_resources
@@ -26,10 +29,14 @@ from zc.buildout.easy_install import IncompatibleConstraintError
 import zc.recipe.egg
 
 import httplib
+import urllib2
 import rfc822
 from urlparse import urlparse
 from . import vcs
 from . import utils
+from . import download
+from . import setup_reader
+from . import addons_index
 from .utils import option_splitlines, option_strip
 
 logger = logging.getLogger(__name__)
@@ -37,7 +44,7 @@ logger = logging.getLogger(__name__)
 
 def rfc822_time(h):
     """Parse RFC 2822-formatted http header and return a time int."""
-    rfc822.mktime_tz(rfc822.parsedate_tz(h))
+    return rfc822.mktime_tz(rfc822.parsedate_tz(h))
 
 
 class MainSoftware(object):
@@ -152,6 +159,7 @@ class BaseRecipe(object):
         self.vcs_clear_locks = clear_locks == 'true'
         clear_retry = options.get('vcs-clear-retry', '').lower()
         self.clear_retry = clear_retry == 'true'
+        self.vcs_parallel = self.parse_vcs_parallel(options)
 
         # same as in zc.recipe.eggs
         self.extra_paths = [
@@ -162,12 +170,17 @@ class BaseRecipe(object):
 
         self.downloads_dir = self.make_absolute(
             self.b_options.get('openerp-downloads-directory', 'downloads'))
+        mirrors_dir = self.b_options.get('openerp-git-mirrors-directory')
+        self.git_mirrors_dir = mirrors_dir and self.make_absolute(
+            mirrors_dir.strip())
         self.version_wanted = None  # from the buildout
         self.version_detected = None  # string from the openerp setup.py
         self.parts = self.buildout['buildout']['parts-directory']
+        self._state = None
         self.openerp_dir = None
         self.archive_filename = None
         self.archive_path = None  # downloaded tar.gz
+        self.archive_sha256 = None  # declared checksum of the archive
 
         if options.get('scripts') is None:
             options['scripts'] = ''
@@ -198,6 +211,25 @@ class BaseRecipe(object):
         self.parse_revisions(options)
         self.parse_merges(options)
 
+    def parse_vcs_parallel(self, options):
+        """Return the maximum number of concurrent VCS operations.
+
+        This is read from the ``vcs-parallel`` option, and defaults to 1,
+        meaning that everything happens in sequence.
+        """
+        value = option_strip(options.get('vcs-parallel'))
+        if not value:
+            return 1
+        try:
+            value = int(value)
+        except ValueError:
+            value = 0
+        if value <= 0:
+            raise UserError("Invalid value for vcs-parallel in part %r: %r "
+                            "(should be a positive integer)" % (
+                                self.name, options.get('vcs-parallel')))
+        return value
+
     def parse_version(self):
         """Set the main software in :attr:`sources` and related attributes.
         """
@@ -234,21 +266,23 @@ class BaseRecipe(object):
         elif type_spec == 'url':
             url = version_split[1]
             self.archive_filename = urlparse(url).path.split('/')[-1]
-            self.archive_path = join(self.downloads_dir, self.archive_filename)
+            self.parse_archive_options(version_split[2:])
+            self.archive_path = self.make_archive_path()
             self.sources[main_software] = ('downloadable', url, None)
         elif type_spec == 'nightly':
-            if len(version_split) != 3:
+            if len(version_split) < 3:
                 raise UserError(
                     "Unrecognized nightly version specification: "
-                    "%r (expecting series, number) % version_split[1:]")
-            self.nightly_series, self.version_wanted = version_split[1:]
+                    "%r (expecting series, number)" % version_split[1:])
+            self.nightly_series, self.version_wanted = version_split[1:3]
+            self.parse_archive_options(version_split[3:])
             type_spec = 'downloadable'
             if self.version_wanted == 'latest':
                 self.main_http_caching = 'http-head'
             series = self.nightly_series
             self.archive_filename = (
                 self.nightly_filenames[series] % self.version_wanted)
-            self.archive_path = join(self.downloads_dir, self.archive_filename)
+            self.archive_path = self.make_archive_path()
             base_url = self.options.get('base_url',
                                         self.nightly_dl_url[series])
             self.sources[main_software] = (
@@ -263,6 +297,37 @@ class BaseRecipe(object):
             self.sources[main_software] = (type_spec,
                                            (url, self.version_wanted), options)
 
+    def parse_archive_options(self, tokens):
+        """Parse the options of a downloadable main software.
+
+        These take the ``name=value`` form, and currently the only one is
+        ``sha256``, the expected checksum of the archive.
+        """
+        version = option_strip(self.options.get('version'))
+        for token in tokens:
+            name, value = token.split('=', 1) if '=' in token else (token, '')
+            if name != 'sha256':
+                raise UserError("Unknown option %r in version %r" % (
+                    token, version))
+            value = value.strip().lower()
+            if len(value) != 64 or not all(c in '0123456789abcdef'
+                                           for c in value):
+                raise UserError("Invalid sha256 checksum %r in version "
+                                "%r" % (value, version))
+            self.archive_sha256 = value
+
+    def make_archive_path(self):
+        """Return the local path for the archive of the main software.
+
+        If its checksum is known, the archive is stored under
+        ``sha256/<checksum>`` in :attr:`downloads_dir`. This makes it safe to
+        share among buildouts, and spares any further freshness check.
+        """
+        if self.archive_sha256 is None:
+            return join(self.downloads_dir, self.archive_filename)
+        return join(self.downloads_dir, 'sha256', self.archive_sha256,
+                    self.archive_filename)
+
     def preinstall_version_check(self):
         """Perform version checks before any attempt to install.
 
@@ -270,8 +335,18 @@ class BaseRecipe(object):
         """
 
     def install_recipe_requirements(self):
-        """Install requirements for the recipe to run."""
+        """Install requirements for the recipe to run.
+
+        This is skipped if nothing changed since previous run, see
+        :meth:`phase_unchanged`.
+        """
         to_install = self.recipe_requirements
+        inputs = dict(requirements=list(to_install))
+        stored = self.phase_unchanged('recipe_requirements', inputs)
+        if stored is not None:
+            self.recipe_requirements_paths = stored['paths']
+            sys.path.extend(self.recipe_requirements_paths)
+            return
         eggs_option = os.linesep.join(to_install)
         eggs = zc.recipe.egg.Eggs(self.buildout, '', dict(eggs=eggs_option))
         ws = eggs.install()
@@ -279,6 +354,9 @@ class BaseRecipe(object):
         self.recipe_requirements_paths = [ws.by_key[dist].location
                                           for dist in to_install]
         sys.path.extend(self.recipe_requirements_paths)
+        self.record_phase('recipe_requirements', inputs,
+                          paths=self.recipe_requirements_paths,
+                          working_set=self.working_set_versions(ws))
 
     def merge_requirements(self):
         """Merge eggs option with self.requirements."""
@@ -361,12 +439,62 @@ class BaseRecipe(object):
         in an old OpenERP version. Could become the norm, but setup is also
         used to list dependencies.
         """
+        try:
+            self.version_detected = setup_reader.read_release(
+                self.openerp_dir)
+            return
+        except setup_reader.StaticReadError:
+            pass
         with open(join(self.openerp_dir, 'bin', 'release.py'), 'rb') as f:
             mod = imp.load_module('release', f, 'release.py',
                                   ('.py', 'r', imp.PY_SOURCE))
         self.version_detected = mod.version
 
     def read_openerp_setup(self):
+        """Extract requirements & version from setup.py.
+
+        The file is read statically if possible (see
+        :mod:`anybox.recipe.odoo.setup_reader`), and executed otherwise.
+        The result is kept in :attr:`state`, and reused as long as the files
+        it's been read from don't change.
+        """
+        cached = self.state.get('openerp_setup')
+        if (cached is not None
+                and cached.get('openerp_dir') == self.openerp_dir
+                and utils.files_unchanged(cached.get('files'))):
+            logger.info("Reusing version and requirements read from %s "
+                        "previously", self.openerp_dir)
+            self.version_detected = str(cached['version'])
+            self.requirements.extend(str(r) for r in cached['requirements'])
+        else:
+            setup_path = join(self.openerp_dir, 'setup.py')
+            try:
+                version, requirements, paths = setup_reader.read_setup(
+                    self.openerp_dir)
+            except setup_reader.StaticReadError, exc:
+                logger.info("Could not read %s statically (%s). "
+                            "Executing it.", setup_path, exc)
+                nb_reqs = len(self.requirements)
+                self.exec_openerp_setup()
+                version = self.version_detected
+                requirements = self.requirements[nb_reqs:]
+                paths = [setup_path]
+                release_path = setup_reader.release_path(self.openerp_dir)
+                if release_path is not None:
+                    paths.append(release_path)
+            else:
+                self.version_detected = version
+                self.requirements.extend(requirements)
+            self.state['openerp_setup'] = dict(
+                openerp_dir=self.openerp_dir,
+                version=version,
+                requirements=requirements,
+                files=dict((path, utils.file_fingerprint(path))
+                           for path in paths))
+        self.save_state()
+        self.apply_version_dependent_decisions()
+
+    def exec_openerp_setup(self):
         """Ugly method to extract requirements & version from ugly setup.py.
 
         Primarily designed for 6.0, but works with 6.1 as well.
@@ -416,7 +544,147 @@ class BaseRecipe(object):
         sys.path.pop(0)
         setuptools.setup = old_setup
         distutils.core.setup = old_distutils_setup
-        self.apply_version_dependent_decisions()
+
+    def phase_fingerprint(self, inputs):
+        """Return a checksum of inputs, together with general ones.
+
+        The general inputs are the ``buildout`` and ``versions`` sections of
+        the buildout configuration, and the version of this recipe. The
+        ``offline`` and ``newest`` options are left aside: they are taken
+        into account by :meth:`phase_unchanged`.
+        """
+        try:
+            recipe_version = pkg_resources.get_distribution(
+                'anybox.recipe.odoo').version
+        except pkg_resources.DistributionNotFound:
+            recipe_version = None
+        buildout = dict((k, v) for k, v in self.b_options.items()
+                        if k not in ('offline', 'newest'))
+        all_inputs = dict(inputs,
+                          buildout=buildout,
+                          versions=self.versions_section(),
+                          recipe_version=recipe_version)
+        return hashlib.sha256(json.dumps(all_inputs, sort_keys=True,
+                                         default=repr)).hexdigest()
+
+    def versions_section(self):
+        """Return the versions pinned in the buildout configuration."""
+        section = self.b_options.get('versions', 'versions')
+        try:
+            return dict(self.buildout[section])
+        except KeyError:
+            return {}
+
+    def phase_unchanged(self, phase, inputs):
+        """Tell if an installation phase can be skipped.
+
+        This is the case if the inputs of the phase are the same as in the
+        previous run, all paths it recorded still exist, and the
+        distributions it relied upon can't have been superseded by newer
+        ones (offline or non-newest mode, or all of them pinned in the
+        ``versions`` section).
+
+        :param inputs: JSON serializable description of the inputs
+        :returns: what :meth:`record_phase` stored if the phase can be
+                  skipped, ``None`` otherwise.
+        """
+        stored = self.state.get('phases', {}).get(phase)
+        if stored is None:
+            return None
+        if stored.get('fingerprint') != self.phase_fingerprint(inputs):
+            logger.debug("Inputs of phase %r changed", phase)
+            return None
+        for path in stored.get('paths', ()):
+            if not os.path.exists(path):
+                logger.debug("Phase %r: %r is missing", phase, path)
+                return None
+        if not (self.offline
+                or self.b_options.get('newest', 'true') == 'false'):
+            versions = dict((name.lower(), version.strip()) for name, version
+                            in self.versions_section().items())
+            for name, version in stored.get('working_set', ()):
+                if versions.get(name.lower()) != version:
+                    logger.debug("Phase %r: %r is not pinned, newer "
+                                 "versions may exist", phase, name)
+                    return None
+        logger.info("Part %r: nothing changed for %s, skipping", self.name,
+                    phase.replace('_', ' '))
+        return stored
+
+    @staticmethod
+    def working_set_versions(ws):
+        """List (project name, version) pairs of non-develop distributions.
+        """
+        return [(dist.project_name, dist.version) for dist in ws
+                if dist.precedence != pkg_resources.DEVELOP_DIST]
+
+    def record_phase(self, phase, inputs, paths=(), working_set=(), **kw):
+        """Record the inputs and results of a phase in :attr:`state`.
+
+        :param paths: files or directories that must still exist for the
+                      phase to be skipped in next run.
+        :param working_set: list of pairs (project name, version) of the
+                            distributions used by the phase.
+        :param kw: additional values to store
+        """
+        self.state.setdefault('phases', {})[phase] = dict(
+            kw, fingerprint=self.phase_fingerprint(inputs),
+            paths=list(paths), working_set=list(working_set))
+        self.save_state()
+
+    @property
+    def addons_index_path(self):
+        """Path to the index of modules, see :meth:`build_addons_index`."""
+        return join(self.parts, '.%s.addons.json' % self.name)
+
+    def build_addons_index(self):
+        """Index the modules of all addons paths and warn about shadowing.
+
+        The index is written at :attr:`addons_index_path`, and referenced in
+        the configuration file, for use at runtime.
+        See :mod:`anybox.recipe.odoo.addons_index`.
+        """
+        index = addons_index.build_index(self.addons_paths)
+        for name, paths in sorted(index['shadowed'].items()):
+            logger.warn("Part %r: module %r in %s shadows the one(s) in %s",
+                        self.name, name,
+                        os.path.dirname(index['modules'][name]['path']),
+                        ', '.join(os.path.dirname(p) for p in paths))
+        if addons_index.write_index(index, self.addons_index_path):
+            logger.info("Part %r: indexed %d modules in %s", self.name,
+                        len(index['modules']),
+                        os.path.relpath(self.addons_index_path,
+                                        self.buildout_dir))
+        return index
+
+    @property
+    def state_path(self):
+        """Path to the file holding :attr:`state`."""
+        return join(self.parts, '.%s.state.json' % self.name)
+
+    @property
+    def state(self):
+        """A JSON serializable dict, persisted from one run to the next.
+
+        It is used to avoid repeating expensive operations whose inputs
+        didn't change. Call :meth:`save_state` to persist it.
+        """
+        if self._state is None:
+            try:
+                with open(self.state_path) as state_file:
+                    self._state = json.load(state_file)
+            except (IOError, ValueError):
+                self._state = {}
+        return self._state
+
+    def save_state(self):
+        """Persist :attr:`state`, atomically."""
+        if not os.path.isdir(self.parts):
+            os.makedirs(self.parts)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.state_path)
 
     def make_absolute(self, path):
         """Make a path absolute if needed.
@@ -427,7 +695,7 @@ class BaseRecipe(object):
             return path
         return join(self.buildout_dir, path)
 
-    def sandboxed_tar_extract(self, sandbox, tarfile, first=None):
+    def sandboxed_tar_extract(self, sandbox, tarfile, first=None, path=''):
         """Extract those members that are below the tarfile path 'sandbox'.
 
         The tarfile module official doc warns against attacks with .. in tar.
@@ -437,18 +705,121 @@ class BaseRecipe(object):
         main directory in parts.
         It is taken for granted that this first member has already been
         checked.
+
+        Members are read in order, therefore this works with tarfiles opened
+        in stream mode (``r|*``), and extracted in the ``path`` directory.
         """
 
         if first is not None:
-            tarfile.extract(first)
+            tarfile.extract(first, path=path)
+
+        def in_sandbox(name):
+            return posixpath.normpath(name).startswith(sandbox + '/')
 
         for tinfo in tarfile:
-            if tinfo.name.startswith(sandbox + '/'):
-                tarfile.extract(tinfo)
+            if not in_sandbox(tinfo.name):
+                ok = False
+            elif tinfo.issym():
+                ok = in_sandbox(posixpath.join(
+                    posixpath.dirname(tinfo.name), tinfo.linkname))
+            elif tinfo.islnk():
+                ok = in_sandbox(tinfo.linkname)
+            else:
+                ok = True
+            if ok:
+                tarfile.extract(tinfo, path=path)
             else:
                 logger.warn('Tarball member %r is outside of %r. Ignored.',
                             tinfo, sandbox)
 
+    def extract_main_archive(self):
+        """Extract the main software archive as :attr:`openerp_dir`.
+
+        The archive is streamed once, and extracted to a temporary directory,
+        that replaces the previous version only if everything went well.
+
+        The extraction is skipped altogether if the archive is the same as
+        the one previously extracted, according to a sha256 checksum, stored
+        next to :attr:`openerp_dir`.
+        """
+        logger.info(u'Inspecting %s ...' % self.archive_path)
+        tar = tarfile.open(self.archive_path, 'r|*')
+        try:
+            first = tar.next()
+            # Everything that follows assumes all tarball members
+            # are inside a directory with an expected name such
+            # as openerp-6.1-1
+            assert(first.isdir())
+            extracted_name = first.name.split('/')[0]
+            self.openerp_dir = join(self.parts, extracted_name)
+            # protection against malicious tarballs
+            assert(not os.path.isabs(extracted_name))
+            assert(extracted_name not in ('.', '..'))
+            assert(self.openerp_dir.startswith(self.parts))
+
+            info_path = join(self.parts, '.%s.archive' % extracted_name)
+            archive_info = self.read_archive_info(info_path)
+            if os.path.isdir(self.openerp_dir) and archive_info is not None:
+                logger.info("%s already extracted from %s",
+                            self.openerp_dir, self.archive_path)
+                if self.clean:
+                    utils.clean_object_files(self.openerp_dir)
+                with open(info_path, 'w') as info_file:
+                    json.dump(archive_info, info_file)
+                return
+
+            tmp_dir = tempfile.mkdtemp(prefix='.%s-' % extracted_name,
+                                       dir=self.parts)
+            try:
+                logger.info(u'Extracting %s ...' % self.archive_path)
+                self.sandboxed_tar_extract(extracted_name, tar, first=first,
+                                           path=tmp_dir)
+                if os.path.exists(info_path):
+                    os.unlink(info_path)
+                if os.path.exists(self.openerp_dir):
+                    logger.info("Replacing existing %s", self.openerp_dir)
+                    os.rename(self.openerp_dir, join(tmp_dir, 'previous'))
+                os.rename(join(tmp_dir, extracted_name), self.openerp_dir)
+            finally:
+                shutil.rmtree(tmp_dir)
+        finally:
+            tar.close()
+
+        with open(info_path, 'w') as info_file:
+            json.dump(self.archive_info(), info_file)
+
+    def archive_info(self, previous=None):
+        """Return a dict identifying the main software archive.
+
+        :param previous: the result of a former call. If the archive has
+                         the same size and modification time, its sha256
+                         checksum is not computed again.
+        """
+        st = os.stat(self.archive_path)
+        info = dict(path=self.archive_path, size=st.st_size,
+                    mtime=st.st_mtime)
+        if self.archive_sha256 is not None:
+            info['sha256'] = self.archive_sha256
+        elif previous is not None and all(
+                previous.get(k) == info[k] for k in ('path', 'size', 'mtime')):
+            info['sha256'] = previous.get('sha256')
+        else:
+            info['sha256'] = utils.file_hash(self.archive_path)
+        return info
+
+    def read_archive_info(self, info_path):
+        """Return the stored archive info, if it is the current archive.
+        """
+        try:
+            with open(info_path) as info_file:
+                previous = json.load(info_file)
+        except (IOError, ValueError):
+            return None
+        info = self.archive_info(previous=previous)
+        if info['sha256'] != previous.get('sha256'):
+            return None
+        return info
+
     def develop(self, src_directory):
         """Develop the specified source distribution.
 
@@ -464,9 +835,20 @@ class BaseRecipe(object):
         :returns: project name of the distribution that's been "developed"
                   This is useful for OpenERP/Odoo itself, whose project name
                   changed within the 8.0 stable branch.
+
+        The subprocess is spared if the egg link and the egg-info directory
+        produced by a previous run are still there, and ``setup.py``,
+        ``setup.cfg`` and ``release.py`` did not change in the meanwhile.
         """
-        logger.debug("Developing %r", src_directory)
         develop_dir = self.b_options['develop-eggs-directory']
+        cached = self.state.get('develop', {}).get(src_directory)
+        if cached is not None and self.develop_unchanged(
+                src_directory, develop_dir, cached):
+            logger.debug("Reusing previous develop of %r", src_directory)
+            self.save_state()
+            return str(cached['project_name'])
+
+        logger.debug("Developing %r", src_directory)
         pythonpath_bak = os.getenv('PYTHONPATH')
         os.putenv('PYTHONPATH', ':'.join(self.recipe_requirements_paths))
 
@@ -484,7 +866,38 @@ class BaseRecipe(object):
                 "Development of OpenERP/Odoo distribution "
                 "produced an unexpected egg link: %r" % egg_link)
 
-        return os.path.basename(egg_link)[:-len(suffix)]
+        project_name = os.path.basename(egg_link)[:-len(suffix)]
+        paths = [join(src_directory, name)
+                 for name in ('setup.py', 'setup.cfg')]
+        release_path = setup_reader.release_path(src_directory)
+        if release_path is not None:
+            paths.append(release_path)
+        self.state.setdefault('develop', {})[src_directory] = dict(
+            project_name=project_name,
+            files=dict((path, utils.file_fingerprint(path))
+                       for path in paths))
+        self.save_state()
+        return project_name
+
+    def develop_unchanged(self, src_directory, develop_dir, cached):
+        """Tell if the result of a previous develop can be reused.
+
+        :param cached: what :meth:`develop` stored in :attr:`state`
+        """
+        project_name = cached['project_name']
+        egg_link = join(develop_dir, project_name + '.egg-link')
+        egg_info = join(src_directory,
+                        pkg_resources.to_filename(project_name) + '.egg-info')
+        if not os.path.isdir(egg_info):
+            return False
+        try:
+            with open(egg_link) as f:
+                linked = f.readline().strip()
+        except IOError:
+            return False
+        if os.path.realpath(linked) != os.path.realpath(src_directory):
+            return False
+        return utils.files_unchanged(cached.get('files'))
 
     def parse_addons(self, options):
         """Parse the addons options into :attr:`sources`.
@@ -581,12 +994,57 @@ class BaseRecipe(object):
             self.sources[local_path] = ((source[0], (source[1][0], revision))
                                         + source[2:])
 
+    def resolve_git_refs(self):
+        """Resolve remote refs of all Git sources and merges in one pass.
+
+        All the refs needed from a given remote are queried with a single
+        ``git ls-remote``, whose results are then reused for the rest of
+        the run. Up to :attr:`vcs_parallel` remotes get queried concurrently.
+
+        Refs that are fixed revisions already present in the target
+        directory (see :meth:`GitRepo.have_fixed_revision`) aren't queried.
+        """
+        if self.offline or self.git_mirrors_dir:
+            # in the latter case, queries are done against the local mirrors
+            return
+        by_url = OrderedDict()
+        specs = list(self.sources.items())
+        for local_dir, merges in self.merges.items():
+            specs.extend((local_dir, merge) for merge in merges)
+        for local_dir, spec in specs:
+            if spec[0] != 'git':
+                continue
+            url, rev = spec[1]
+            if not rev or not (os.path.isabs(url) or ':' in url):
+                # relative paths are interpreted from the target directories
+                continue
+            if len(rev) >= 12 and vcs.git.ishex(rev):
+                # can't be queried, see GitRepo.have_fixed_revision
+                continue
+            if local_dir is main_software:
+                target_dir = self.openerp_dir
+            else:
+                target_dir = self.make_absolute(local_dir)
+            if (target_dir is not None
+                    and vcs.GitRepo(target_dir, url).have_fixed_revision(rev)):
+                continue
+            by_url.setdefault(url, set()).add(rev)
+
+        utils.ordered_parallel_map(
+            lambda url_refs: vcs.GitRepo.resolve_remote_refs(*url_refs),
+            by_url.items(), workers=self.vcs_parallel)
+
     def retrieve_addons(self):
         """Peform all lookup and downloads specified in :attr:`sources`.
 
         See :class:`BaseRecipe` for the structure of :attr:`sources`.
+
+        Up to :attr:`vcs_parallel` sources get retrieved concurrently, but
+        the resulting :attr:`addons_paths` is always in the order of
+        :attr:`sources`.
         """
         self.addons_paths = []
+        to_retrieve = []
         for local_dir, source_spec in self.sources.items():
             if local_dir is main_software:
                 continue
@@ -598,10 +1056,10 @@ class BaseRecipe(object):
                            clean=self.clean)
             if loc_type == 'git':
                 options['depth'] = self.options.get('git-depth')
+                options['mirrors_dir'] = self.git_mirrors_dir
             options.update(addons_options)
 
             group = addons_options.get('group')
-            group_dir = None
             if group:
                 if loc_type == 'local':
                     raise UserError(
@@ -614,6 +1072,7 @@ class BaseRecipe(object):
                         "you create yourself the intermediate directory." % (
                             local_dir, ))
 
+                # done right away, because several sources can share it
                 group_dir = os.path.dirname(local_dir)
                 if not os.path.exists(group_dir):
                     os.makedirs(group_dir)
@@ -622,33 +1081,53 @@ class BaseRecipe(object):
                     if k.startswith(loc_type + '-'):
                         options[k] = v
 
-                repo_url, repo_rev = loc_spec
-                vcs.get_update(loc_type, local_dir, repo_url, repo_rev,
-                               clear_retry=self.clear_retry,
-                               **options)
-            elif self.clean:
-                utils.clean_object_files(local_dir)
+            to_retrieve.append((local_dir, loc_type, loc_spec, options))
 
-            subdir = addons_options.get('subdir')
-            if group_dir:
-                addons_dir = group_dir
-            else:
-                addons_dir = local_dir
+        for addons_dir in utils.ordered_parallel_map(
+                self._retrieve_addons_source, to_retrieve,
+                workers=self.vcs_parallel):
+            if addons_dir not in self.addons_paths:
+                self.addons_paths.append(addons_dir)
 
-            if subdir:
-                addons_dir = join(addons_dir, subdir)
+    def _retrieve_addons_source(self, to_retrieve):
+        """Retrieve a single addons source and return its addons directory.
 
-            manifest = os.path.join(addons_dir, '__openerp__.py')
-            manifest_pre_v6 = os.path.join(addons_dir, '__terp__.py')
-            if os.path.isfile(manifest) or os.path.isfile(manifest_pre_v6):
-                raise UserError("Standalone addons such as %r "
-                                "are now supported by means "
-                                "of the explicit 'group' option. Please "
-                                "update your buildout configuration. " % (
-                                    addons_dir))
+        This is meant to be thread-safe, and therefore must not change
+        the state of the recipe instance.
 
-            if addons_dir not in self.addons_paths:
-                self.addons_paths.append(addons_dir)
+        :param to_retrieve: a tuple ``(local_dir, type, spec, options)``,
+                            with the same meaning as in :attr:`sources`,
+                            except that ``local_dir`` is absolute and
+                            ``options`` is the full set to pass on to the
+                            VCS layer.
+        """
+        local_dir, loc_type, loc_spec, options = to_retrieve
+        if loc_type != 'local':
+            repo_url, repo_rev = loc_spec
+            vcs.get_update(loc_type, local_dir, repo_url, repo_rev,
+                           clear_retry=self.clear_retry,
+                           **options)
+        elif self.clean:
+            utils.clean_object_files(local_dir)
+
+        subdir = options.get('subdir')
+        if options.get('group'):
+            addons_dir = os.path.dirname(local_dir)
+        else:
+            addons_dir = local_dir
+
+        if subdir:
+            addons_dir = join(addons_dir, subdir)
+
+        manifest = os.path.join(addons_dir, '__openerp__.py')
+        manifest_pre_v6 = os.path.join(addons_dir, '__terp__.py')
+        if os.path.isfile(manifest) or os.path.isfile(manifest_pre_v6):
+            raise UserError("Standalone addons such as %r "
+                            "are now supported by means "
+                            "of the explicit 'group' option. Please "
+                            "update your buildout configuration. " % (
+                                addons_dir))
+        return addons_dir
 
     def revert_sources(self):
         """Revert all sources to the revisions specified in :attr:`sources`.
@@ -695,6 +1174,13 @@ class BaseRecipe(object):
 
     def main_download(self):
         """HTTP download for main part of the software to self.archive_path.
+
+        The download is streamed to a temporary ``.part`` file, that gets
+        renamed only if complete, and matching :attr:`archive_sha256`, if
+        known. Being unique to the current process, it can't be mixed up
+        with a download of the same archive by another buildout sharing the
+        downloads directory. Interruptions are resumed within the retries of
+        :class:`download.Downloader`.
         """
         if self.offline:
             raise IOError("%s not found, and offline "
@@ -702,19 +1188,36 @@ class BaseRecipe(object):
         url = self.sources[main_software][1]
         logger.info("Downloading %s ..." % url)
 
+        archive_dir = os.path.dirname(self.archive_path)
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        fd, part_path = tempfile.mkstemp(dir=archive_dir,
+                                         prefix=self.archive_filename + '.',
+                                         suffix='.part')
+        os.close(fd)
         try:
-            msg = urllib.urlretrieve(url, self.archive_path)
-            if msg[1].type == 'text/html':
-                os.unlink(self.archive_path)
+            try:
+                info = download.Downloader(url)(part_path)
+            except IOError, exc:
+                if not (isinstance(exc, urllib2.HTTPError)
+                        and exc.code == 404):
+                    raise IOError('The archive could not be downloaded: '
+                                  '%s (%s)' % (repr(self.archive_path), exc))
+                info = None
+            if info is None or info.gettype() == 'text/html':
                 raise LookupError(
                     'Wanted version %r not found on server (tried %s)' % (
                         self.version_wanted, url))
-
-        except (tarfile.TarError, IOError):
-            # GR: ContentTooShortError subclasses IOError
-            os.unlink(self.archive_path)
-            raise IOError('The archive does not seem valid: ' +
-                          repr(self.archive_path))
+            if self.archive_sha256 is not None:
+                sha256 = utils.file_hash(part_path, 'sha256')
+                if sha256 != self.archive_sha256:
+                    raise UserError(
+                        "Checksum mismatch for %s: expected sha256 %s, "
+                        "got %s" % (url, self.archive_sha256, sha256))
+            os.rename(part_path, self.archive_path)
+        finally:
+            if os.path.exists(part_path):
+                os.unlink(part_path)
 
     def is_stale_http_head(self):
         """Tell if the download is stale by doing a HEAD request.
@@ -771,34 +1274,18 @@ class BaseRecipe(object):
             # download if needed
             if ((self.archive_path and not os.path.exists(self.archive_path))
                 or (self.main_http_caching == 'http-head'
+                    and self.archive_sha256 is None
                     and self.is_stale_http_head())):
                 self.main_download()
 
-            logger.info(u'Inspecting %s ...' % self.archive_path)
-            tar = tarfile.open(self.archive_path)
-            first = tar.next()
-            # Everything that follows assumes all tarball members
-            # are inside a directory with an expected name such
-            # as openerp-6.1-1
-            assert(first.isdir())
-            extracted_name = first.name.split('/')[0]
-            self.openerp_dir = join(self.parts, extracted_name)
-            # protection against malicious tarballs
-            assert(not os.path.isabs(extracted_name))
-            assert(self.openerp_dir.startswith(self.parts))
-
-            logger.info("Cleaning existing %s", self.openerp_dir)
-            if os.path.exists(self.openerp_dir):
-                shutil.rmtree(self.openerp_dir)
-            logger.info(u'Extracting %s ...' % self.archive_path)
-            self.sandboxed_tar_extract(extracted_name, tar, first=first)
-            tar.close()
+            self.extract_main_archive()
         else:
             url, rev = source[1]
             options = dict((k, v) for k, v in self.options.iteritems()
                            if k.startswith(type_spec + '-'))
             if type_spec == 'git':
                 options['depth'] = options.pop('git-depth', None)
+                options['mirrors_dir'] = self.git_mirrors_dir
 
             options.update(source[2])
             if self.clean:
@@ -833,6 +1320,7 @@ class BaseRecipe(object):
             freeze_to = os.path.join(extract_downloads_to,
                                      'extracted_from.cfg')
 
+        self.resolve_git_refs()
         self.retrieve_main_software()
         self.retrieve_addons()
         self.retrieve_merges()
@@ -850,9 +1338,24 @@ class BaseRecipe(object):
 
         self.finalize_addons_paths()
         self._register_extra_paths()
+        self.build_addons_index()
 
         if self.version_detected is None:
             raise EnvironmentError('Version of OpenERP could not be detected')
+
+        setup_files = (self.state.get('openerp_setup') or {}).get('files', {})
+        inputs = dict(options=dict(self.options),
+                      requirements=list(self.requirements),
+                      version=self.version_detected,
+                      openerp_dir=self.openerp_dir,
+                      addons_paths=list(self.addons_paths),
+                      setup_files=dict((path, fp and fp.get('sha256'))
+                                       for path, fp in setup_files.items()))
+        if freeze_to is None and extract_downloads_to is None:
+            stored = self.phase_unchanged('requirements', inputs)
+            if stored is not None:
+                return [str(path) for path in stored['installed']]
+
         self.merge_requirements()
         self.install_requirements()
 
@@ -875,9 +1378,18 @@ class BaseRecipe(object):
             if not config.has_section(section):
                 config.add_section(section)
             config.set(section, option, self.options[recipe_option])
+        if not config.has_section(addons_index.CONFIG_SECTION):
+            config.add_section(addons_index.CONFIG_SECTION)
+        config.set(addons_index.CONFIG_SECTION, addons_index.CONFIG_KEY,
+                   self.addons_index_path)
         with open(self.config_path, 'wb') as configfile:
             config.write(configfile)
 
+        self.record_phase('requirements', inputs,
+                          paths=self.openerp_installed + [self.config_path],
+                          working_set=self.working_set_versions(self.ws),
+                          installed=self.openerp_installed)
+
         if extract_downloads_to:
             self.extract_downloads_to(extract_downloads_to)
         if freeze_to:
@@ -912,6 +1424,7 @@ class BaseRecipe(object):
         out_conf.add_section(self.name)
         addons_option = []
         self.local_modifications = []
+        to_freeze = []
         for local_path, source in self.sources.items():
             source_type = source[0]
             if source_type == 'local':
@@ -928,8 +1441,12 @@ class BaseRecipe(object):
 
             if source_type == 'downloadable':
                 continue
+            to_freeze.append((local_path, source_type, abspath))
 
-            revision = self._freeze_vcs_source(source_type, abspath)
+        revisions = self._freeze_vcs_sources(
+            [(frozen_type, frozen_path)
+             for _, frozen_type, frozen_path in to_freeze])
+        for (local_path, _, _), revision in zip(to_freeze, revisions):
             if local_path is main_software:
                 addons_option.insert(0, '%s  ; main software part' % revision)
                 # actually, that comment will be lost if this is not the
@@ -983,21 +1500,26 @@ class BaseRecipe(object):
         conf.set('buildout', 'versions', 'versions')
 
         # freezing for gp.vcsdevelop
-        extends = []
+        develops = []
         for raw, parsed in self._get_gp_vcs_develops():
             local_path = parsed[0]
             hash_split = raw.rsplit('#')
             url = hash_split[0]
             url = url.rsplit('@', 1)[0]
             vcs_type = url.split('+', 1)[0]
-            # vcs-develop process adds .egg-info file (often forgotten in VCS
-            # ignore files) and changes setup.cfg.
-            # For now we'll have to allow local modifications.
-            revision = self._freeze_vcs_source(vcs_type,
-                                               self.make_absolute(local_path),
-                                               pip_compatible=True,
-                                               allow_local_modification=True)
-            extends.append('%s@%s#%s' % (url, revision, hash_split[1]))
+            develops.append((url, hash_split[1], vcs_type,
+                             self.make_absolute(local_path)))
+
+        # vcs-develop process adds .egg-info file (often forgotten in VCS
+        # ignore files) and changes setup.cfg.
+        # For now we'll have to allow local modifications.
+        revisions = self._freeze_vcs_sources(
+            [(develop_type, develop_path)
+             for _, _, develop_type, develop_path in develops],
+            pip_compatible=True, allow_local_modification=True)
+        extends = ['%s@%s#%s' % (develop_url, revision, egg)
+                   for (develop_url, egg, _, _), revision
+                   in zip(develops, revisions)]
 
         conf.set('buildout', GP_VCS_EXTEND_DEVELOP, os.linesep.join(extends))
 
@@ -1043,17 +1565,39 @@ class BaseRecipe(object):
         :param pip_compatible: if ``True``, a pip compatible revision number
                                is issued. This depends on the precise vcs.
         """
+        return self._freeze_vcs_sources(
+            [(vcs_type, abspath)], pip_compatible=pip_compatible,
+            allow_local_modification=allow_local_modification)[0]
 
-        repo = vcs.repo(vcs_type, abspath, '')  # no need of remote URL
-
-        if not allow_local_modification and repo.uncommitted_changes():
-            self.local_modifications.append(abspath)
+    def _freeze_vcs_sources(self, sources, pip_compatible=False,
+                            allow_local_modification=False):
+        """Return the current revisions for several VCS sources.
 
-        parents = repo.parents(pip_compatible=pip_compatible)
-        if len(parents) > 1:
-            self.local_modifications.append(abspath)
+        The repositories are queried concurrently, up to
+        :attr:`vcs_parallel` at a time, but the results, as well as the
+        additions to :attr:`local_modifications` come in the same order as
+        ``sources``.
 
-        return parents[0]
+        :param sources: iterable of pairs (vcs type, absolute path)
+        """
+        def probe(source):
+            vcs_type, abspath = source
+            repo = vcs.repo(vcs_type, abspath, '')  # no need of remote URL
+            dirty = (not allow_local_modification
+                     and repo.uncommitted_changes())
+            return dirty, repo.parents(pip_compatible=pip_compatible)
+
+        sources = list(sources)
+        revisions = []
+        for (vcs_type, abspath), (dirty, parents) in zip(
+                sources, utils.ordered_parallel_map(
+                    probe, sources, workers=self.vcs_parallel)):
+            if dirty:
+                self.local_modifications.append(abspath)
+            if len(parents) > 1:
+                self.local_modifications.append(abspath)
+            revisions.append(parents[0])
+        return revisions
 
     def extract_downloads_to(self, target_dir, outconf_name='release.cfg'):
         """Extract anything that has been downloaded to target_dir.
@@ -1094,6 +1638,9 @@ class BaseRecipe(object):
         out_conf is a ConfigParser instance to write to
         extracted is a technical set used to know what targets have already
         been written by previous parts and store for subsequent ones.
+
+        Addons sources are extracted concurrently, up to
+        :attr:`vcs_parallel` at a time.
         """
 
         if not os.path.exists(target_dir):
@@ -1114,6 +1661,7 @@ class BaseRecipe(object):
             out_conf.set(self.name, 'recipe', extracted_recipe)
 
         addons_option = []
+        to_extract = []
         for local_path, source in self.sources.items():
             source_type = source[0]
             if local_path is main_software:
@@ -1140,15 +1688,28 @@ class BaseRecipe(object):
             addons_line.extend('%s=%s' % (opt, val)
                                for opt, val in options.items())
             addons_option.append(' '.join(addons_line))
+            if source_type != 'local':
+                to_extract.append((source_type, local_path))
 
+        # parent directories are shared (groups), create them beforehand
+        for _, local_path in to_extract:
+            parent = os.path.dirname(os.path.join(target_dir, local_path))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+        def extract(job):
+            source_type, local_path = job
             abspath = self.make_absolute(local_path)
             if source_type == 'downloadable':
-                shutil.copytree(abspath,
-                                os.path.join(target_dir, local_path))
-            elif source_type != 'local':  # vcs
+                utils.link_or_copy_tree(abspath,
+                                        os.path.join(target_dir, local_path))
+            else:  # vcs
                 self._extract_vcs_source(source_type, abspath, target_dir,
                                          local_path, extracted)
 
+        utils.ordered_parallel_map(extract, to_extract,
+                                   workers=self.vcs_parallel)
+
         out_conf.set(self.name, 'addons', os.linesep.join(addons_option))
         if self.options.get('revisions'):
             out_conf.set(self.name, 'revisions', '')
@@ -1204,7 +1765,8 @@ class BaseRecipe(object):
             return local_path
 
         if source_type == 'downloadable':
-            shutil.copytree(self.openerp_dir, target_path)
+            utils.link_or_copy_tree(self.openerp_dir, target_path,
+                                    workers=self.vcs_parallel)
         elif source_type != 'local':  # see docstring for 'local'
             self._extract_vcs_source(source_type, self.openerp_dir, target_dir,
                                      local_path, extracted)
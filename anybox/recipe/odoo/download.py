@@ -0,0 +1,145 @@
+"""Streaming, resumable HTTP downloads.
+
+This is used for the main software archives (nightly builds, custom
+URLs), that can weigh hundreds of megabytes.
+"""
+import os
+import re
+import time
+import socket
+import httplib
+import urllib2
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+"""Size of chunks read from the network and written to disk."""
+
+PROGRESS_INTERVAL = 10
+"""Minimal delay in seconds between two progress log messages."""
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+
+class Downloader(object):
+    """Download an URL to a local file, by chunks, resuming if possible.
+
+    If the target file already exists, it is considered to be the beginning
+    of a previous, interrupted, download of the same URL, and an HTTP
+    ``Range`` request is issued to get the rest. Servers that don't
+    support that just send the whole content again.
+
+    Network failures and server errors (5xx) are retried up to
+    :attr:`retries` times, resuming each time from what has been written
+    so far. The delay before a retry starts with :attr:`backoff` seconds and
+    doubles each time.
+    """
+
+    def __init__(self, url, chunk_size=CHUNK_SIZE, retries=3, backoff=2.0,
+                 timeout=60):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def __call__(self, target):
+        """Download to target and return the headers of the last response.
+
+        :raises: :class:`IOError` if the download could not be completed
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.download_attempt(target)
+            except urllib2.HTTPError, exc:
+                if exc.code < 500 or attempt >= self.retries:
+                    raise
+                error = exc
+            except (IOError, socket.error, httplib.HTTPException), exc:
+                # URLError subclasses IOError
+                if attempt >= self.retries:
+                    raise IOError("Download of %s failed: %s" % (
+                        self.url, exc))
+                error = exc
+            delay = self.backoff * 2 ** attempt
+            attempt += 1
+            logger.warn("Download of %s interrupted (%s), retrying "
+                        "in %.1f seconds (%d/%d)", self.url, error, delay,
+                        attempt, self.retries)
+            time.sleep(delay)
+
+    def download_attempt(self, target):
+        """Download or resume the download to target, in one request."""
+        offset = os.path.getsize(target) if os.path.exists(target) else 0
+        request = urllib2.Request(self.url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, exc:
+            if exc.code != 416 or not offset:
+                raise
+            # Range not satisfiable: can't make sense of what we have
+            logger.warn("Server refuses to resume download of %s, "
+                        "starting over", self.url)
+            os.unlink(target)
+            return self.download_attempt(target)
+
+        info = response.info()
+        total = info.getheader('Content-Length')
+        total = int(total) if total is not None else None
+
+        match = CONTENT_RANGE_RE.match(info.getheader('Content-Range') or '')
+        if (offset and response.getcode() == 206 and match is not None
+                and int(match.group(1)) == offset):
+            logger.info("Resuming download of %s at byte %d",
+                        self.url, offset)
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+        if total is not None:
+            total += offset
+
+        try:
+            with open(target, mode) as out:
+                self.copy_chunks(response, out, offset, total)
+        finally:
+            response.close()
+
+        size = os.path.getsize(target)
+        if total is not None and size != total:
+            raise IOError("Download of %s incomplete: got %d bytes out of "
+                          "%d" % (self.url, size, total))
+        return info
+
+    def copy_chunks(self, response, out, offset, total):
+        """Copy response to the out file, logging progress and throughput.
+        """
+        start = last_log = time.time()
+        received = 0
+        while True:
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                break
+            out.write(chunk)
+            received += len(chunk)
+            now = time.time()
+            if now - last_log >= PROGRESS_INTERVAL:
+                last_log = now
+                self.log_progress(offset + received, total, received,
+                                  now - start)
+        self.log_progress(offset + received, total, received,
+                          time.time() - start, done=True)
+
+    def log_progress(self, written, total, received, elapsed, done=False):
+        rate = received / elapsed / 1024 if elapsed > 0 else 0.0
+        if total:
+            progress = '%d%% of %d kB' % (100 * written / total, total / 1024)
+        else:
+            progress = '%d kB' % (written / 1024)
+        logger.info("%s %s: %s, %.1f kB/s",
+                    "Downloaded" if done else "Downloading",
+                    self.url, progress, rate)
@@ -0,0 +1,386 @@
+"""Entry point for the cron worker script built for Gunicorn setups.
+
+Gunicorn workers don't process OpenERP cron jobs. This worker does it, for
+the databases specified by the ``db_name`` option (comma-separated list) or,
+if there's none, for all the initialized OpenERP databases of the cluster.
+
+Discovered databases are cached, and the list is refreshed every
+:data:`DISCOVERY_INTERVAL` seconds only: a database created in the meanwhile
+will wait for that long before its cron jobs get processed.
+
+The registries of the most recently processed databases are kept loaded
+between rounds, up to :data:`MAX_REGISTRIES` of them (see
+:class:`RegistryCache`).
+
+The work can be split among several child processes, each one in charge of
+a share of the databases (see :func:`run_workers`), so that a slow job only
+delays the databases of the same share.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import hashlib
+import logging
+import warnings
+from collections import OrderedDict
+
+try:
+    import openerp
+except ImportError:
+    warnings.warn("This must be imported with a buildout openerp recipe "
+                  "driven sys.path", RuntimeWarning)
+else:
+    from openerp.tools import config
+
+from . import patch_odoo
+from .. import addons_index
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 60
+"""Delay in seconds between two rounds of cron jobs processing."""
+
+DISCOVERY_INTERVAL = 600
+"""Delay in seconds between two refreshes of the list of databases."""
+
+RESTART_DELAY = 5
+"""Delay in seconds before restarting a child worker that exited."""
+
+MAX_REGISTRIES = 4
+"""Default number of registries kept loaded by a worker between rounds."""
+
+quit_signals_received = 0
+"""Number of calls to the signal handler, see :func:`signal_handler`."""
+
+children = {}
+"""Child workers, if any: a dict whose keys are pids and values indexes."""
+
+
+def signal_handler(sig, frame):
+    """Ask for a graceful exit, or exit right away on the second signal.
+
+    The signal is forwarded to the child workers, if any.
+
+    :param sig: the signal number
+    :param frame: the interrupted stack frame or None
+    """
+    global quit_signals_received
+    quit_signals_received += 1
+    for pid in children:
+        try:
+            os.kill(pid, sig)
+        except OSError:  # already exited
+            pass
+    if quit_signals_received == 1:
+        logger.info("Waiting for the current jobs to complete. "
+                    "Hit Ctrl-C again to force shutdown.")
+    else:
+        # logging.shutdown may already have been called at this point.
+        sys.stderr.write("Forced shutdown.\n")
+        os._exit(0)
+
+
+def setup_signal_handlers():
+    """Register :func:`signal_handler` for SIGINT and SIGTERM."""
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal_handler)
+
+
+def list_databases():
+    """List the databases of the cluster, through OpenERP's database layer.
+
+    This is a single query on the PostgreSQL catalog, that excludes the
+    templates and, as for OpenERP's database manager, the databases that
+    aren't owned by the database user.
+    """
+    db_service = openerp.service.db
+    list_dbs = getattr(db_service, 'list_dbs', None)
+    if list_dbs is not None:  # Odoo >= 9
+        return list_dbs(force=True)
+    return db_service.exp_list(document=True)
+
+
+def is_initialized(db_name):
+    """Tell if the given database is an initialized OpenERP database.
+
+    The connections to the database are closed afterwards.
+    """
+    cr = openerp.sql_db.db_connect(db_name).cursor()
+    try:
+        return openerp.modules.db.is_initialized(cr)
+    finally:
+        cr.close()
+        openerp.sql_db.close_db(db_name)
+
+
+class DatabaseDiscovery(object):
+    """Cached list of the initialized OpenERP databases.
+
+    Calling an instance returns the list, that is refreshed if older than
+    ``refresh_interval`` seconds. Only the databases that weren't already
+    known as initialized have to be checked upon refresh.
+    """
+
+    def __init__(self, refresh_interval=DISCOVERY_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._databases = None
+        self._expires = 0
+        self._initialized = set()
+
+    def __call__(self):
+        now = time.time()
+        if self._databases is None or now >= self._expires:
+            self._databases = self.discover()
+            self._expires = now + self.refresh_interval
+        return self._databases
+
+    def list_databases(self):
+        return list_databases()
+
+    def is_initialized(self, db_name):
+        return is_initialized(db_name)
+
+    def discover(self):
+        db_names = self.list_databases()
+        self._initialized.intersection_update(db_names)
+        for db_name in db_names:
+            if db_name in self._initialized:
+                continue
+            try:
+                initialized = self.is_initialized(db_name)
+            except Exception:
+                logger.warn("Could not check database %r", db_name,
+                            exc_info=True)
+                continue
+            if initialized:
+                self._initialized.add(db_name)
+        databases = [db_name for db_name in db_names
+                     if db_name in self._initialized]
+        logger.info("Monitoring %d databases out of %d", len(databases),
+                    len(db_names))
+        return databases
+
+
+def process_jobs(db_name):
+    """Process the cron jobs of the given database that are due.
+
+    This goes through ``ir_cron._acquire_job()``, as the cron workers of
+    OpenERP's own prefork server do: it's the only entry point that takes
+    care of the locking of jobs among concurrent workers.
+    Beforehand, the registry is reloaded if another process signaled it's
+    been changed, e.g., by a module update.
+    """
+    import openerp.addons.base
+    registry_manager = openerp.modules.registry.RegistryManager
+    check_signaling = getattr(registry_manager, 'check_registry_signaling',
+                              None)
+    if check_signaling is not None:  # OpenERP >= 7
+        check_signaling(db_name)
+    openerp.addons.base.ir.ir_cron.ir_cron._acquire_job(db_name)
+
+
+def release_registry(db_name):
+    """Release the registry and database connections of db_name."""
+    openerp.modules.registry.RegistryManager.delete(db_name)
+    openerp.sql_db.close_db(db_name)
+
+
+class RegistryCache(object):
+    """Process cron jobs, keeping the registries of up to size databases.
+
+    Loading a registry is expensive, and cron jobs are polled every
+    :data:`POLL_INTERVAL` seconds: the registries of the most recently
+    processed databases are kept loaded, the least recently used one being
+    released when there are more than ``size`` of them. Those whose
+    processing failed, or that aren't listed any more, are released right
+    away.
+    """
+
+    def __init__(self, size=MAX_REGISTRIES):
+        self.size = size
+        self._loaded = OrderedDict()
+
+    @property
+    def loaded(self):
+        """Names of the databases kept loaded, least recently used first."""
+        return list(self._loaded)
+
+    def process_jobs(self, db_name):
+        process_jobs(db_name)
+
+    def release_registry(self, db_name):
+        release_registry(db_name)
+
+    def process(self, db_name):
+        """Process the cron jobs of db_name, see :func:`process_jobs`."""
+        self._loaded.pop(db_name, None)
+        try:
+            self.process_jobs(db_name)
+        except Exception:
+            self.release_registry(db_name)
+            raise
+        self._loaded[db_name] = True
+        while len(self._loaded) > self.size:
+            self.release_registry(self._loaded.popitem(last=False)[0])
+
+    def retain(self, db_names):
+        """Release the registries of databases not in db_names."""
+        for db_name in self.loaded:
+            if db_name not in db_names:
+                del self._loaded[db_name]
+                self.release_registry(db_name)
+
+
+def run(databases, poll_interval=POLL_INTERVAL, registries=None):
+    """Process cron jobs until a signal is received.
+
+    :param databases: callable returning the list of databases to process.
+    :param registries: the :class:`RegistryCache` to use, a default one
+                       is created if ``None``.
+    """
+    if registries is None:
+        registries = RegistryCache()
+    while not quit_signals_received:
+        db_names = databases()
+        registries.retain(db_names)
+        for db_name in db_names:
+            if quit_signals_received:
+                break
+            try:
+                registries.process(db_name)
+            except Exception:
+                logger.exception("Failed to process cron jobs of "
+                                 "database %r", db_name)
+        if not quit_signals_received:
+            time.sleep(poll_interval)
+
+
+def worker_index(db_name, workers):
+    """Return the index of the worker in charge of db_name.
+
+    This is rendezvous hashing: the worker with the highest hash of its
+    index along with db_name wins. It doesn't depend on the other
+    databases, and adding a worker moves only the databases that it wins,
+    about one out of the new number of workers.
+    """
+    if isinstance(db_name, unicode):
+        db_name = db_name.encode('utf-8')
+    return max(xrange(workers), key=lambda index: hashlib.md5(
+        '%s/%d' % (db_name, index)).digest())
+
+
+def run_workers(databases, workers, poll_interval=POLL_INTERVAL,
+                max_registries=MAX_REGISTRIES):
+    """Process cron jobs in child processes until a signal is received.
+
+    Each child runs :func:`run` on the databases of ``databases()`` that
+    :func:`worker_index` assigns to it, keeping up to ``max_registries``
+    of them loaded. Children that exit are restarted
+    after :data:`RESTART_DELAY` seconds. Signals received by this process
+    are forwarded to them (see :func:`signal_handler`).
+
+    Nothing in this process should connect to the databases before, as
+    connections can't be shared with the children.
+    """
+    def spawn(index):
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+        children.clear()
+        # signals from the terminal are forwarded by the parent process
+        os.setpgid(0, 0)
+        status = 0
+        try:
+            run(lambda: [db_name for db_name in databases()
+                         if worker_index(db_name, workers) == index],
+                poll_interval=poll_interval,
+                registries=RegistryCache(max_registries))
+        except BaseException:
+            logger.exception("Cron worker %d crashed", index)
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    for index in xrange(workers):
+        spawn(index)
+    logger.info("Started %d cron workers", workers)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as exc:
+            if exc.errno == errno.EINTR:  # signal received
+                continue
+            raise
+        index = children.pop(pid, None)
+        if index is None or quit_signals_received:
+            continue
+        if os.WIFSIGNALED(status):
+            reason = "was killed by signal %d" % os.WTERMSIG(status)
+        else:
+            reason = "exited with status %d" % os.WEXITSTATUS(status)
+        logger.warn("Cron worker %d (pid %d) %s, restarting it",
+                    index, pid, reason)
+        time.sleep(RESTART_DELAY)
+        if not quit_signals_received:
+            spawn(index)
+
+
+def setup_openerp():
+    """Prepare OpenERP for processing cron jobs in the current process.
+
+    This is what the former ``openerp-cron-worker`` script did: unless
+    configured otherwise, cron jobs are logged at the ``DEBUG`` level, and
+    the addons paths are set up for imports before any registry is loaded.
+    The wake up of the scheduler of in-process cron threads, if any (OpenERP
+    6.1), is disabled: jobs are polled by this worker instead.
+    """
+    if config['log_handler'] == [':INFO']:
+        # Replace the default value, which is suitable for the server.
+        config['log_handler'].append('openerp.addons.base.ir.ir_cron:DEBUG')
+    openerp.netsvc.init_logger()
+    openerp.modules.module.initialize_sys_path()
+    cron = getattr(openerp, 'cron', None)
+    if cron is not None:  # OpenERP 6.1
+        cron.enable_schedule_wakeup = False
+    openerp.multi_process = True  # enable multi-process signaling
+
+
+def main(conf, discovery_interval=DISCOVERY_INTERVAL, workers=1,
+         max_registries=MAX_REGISTRIES):
+    """Start the cron worker.
+
+    :param conf: path to the OpenERP configuration file (managed by the
+                 recipe). Command line arguments are parsed as OpenERP
+                 server options on top of it.
+    :param workers: if greater than 1, the number of child processes to
+                    share the databases among, see :func:`run_workers`.
+    :param max_registries: number of registries each process keeps loaded,
+                           see :class:`RegistryCache`.
+    """
+    os.environ['TZ'] = 'UTC'
+    config.parse_config(['-c', conf] + sys.argv[1:])
+    index = addons_index.load_index_from_config(conf)
+    if index is not None and addons_index.is_fresh(index):
+        patch_odoo.use_addons_index(index)
+
+    setup_signal_handlers()
+    setup_openerp()
+
+    if config['db_name']:
+        db_names = config['db_name'].split(',')
+        logger.info("Monitoring databases %s", ', '.join(db_names))
+
+        def databases():
+            return db_names
+    else:
+        logger.info("Monitored databases are auto-discovered")
+        databases = DatabaseDiscovery(refresh_interval=discovery_interval)
+    if workers > 1:
+        run_workers(databases, workers, max_registries=max_registries)
+    else:
+        run(databases, registries=RegistryCache(max_registries))
@@ -1,6 +1,7 @@
 """Necessary monkey patches to make Odoo work in the buildout context.
 """
 
+import os
 import subprocess
 
 
@@ -21,3 +22,50 @@ def do_patch(gevent_script_path):
         server.long_polling_pid = popen.pid
 
     PreforkServer.long_polling_spawn = long_polling_spawn
+
+
+def use_addons_index(index):
+    """Patch module lookups so that they use the index built by the recipe.
+
+    Addons directories that the index knows about don't have to be scanned:
+    only the others (typically, the one for modules downloaded in the data
+    directory) are. Modules that are not in the index, and versions of Odoo
+    that don't have the expected internal API are looked up as usual.
+
+    :param index: as loaded by :mod:`anybox.recipe.odoo.addons_index`
+    """
+    import openerp.modules
+    from openerp.modules import module as odoo_module
+
+    original = getattr(odoo_module, 'get_module_path', None)
+    if original is None or not hasattr(odoo_module, 'ad_paths'):
+        return
+    original = getattr(original, 'unindexed', original)
+
+    indexed_dirs = set(index['addons_paths'])
+    module_dirs = {}
+    for name, module in index['modules'].items():
+        module_dirs[name] = set([os.path.dirname(module['path'])])
+    for name, paths in index['shadowed'].items():
+        module_dirs[name].update(os.path.dirname(p) for p in paths)
+
+    def get_module_path(module, *args, **kwargs):
+        dirs = module_dirs.get(module)
+        if dirs is None:
+            return original(module, *args, **kwargs)
+        initialize = getattr(odoo_module, 'initialize_sys_path', None)
+        if initialize is not None:
+            initialize()
+        for adp in odoo_module.ad_paths:
+            if adp in indexed_dirs:
+                if adp in dirs:
+                    return os.path.join(adp, module)
+            elif (os.path.exists(os.path.join(adp, module))
+                    or os.path.exists(os.path.join(adp, module + '.zip'))):
+                return os.path.join(adp, module)
+        return original(module, *args, **kwargs)
+
+    get_module_path.unindexed = original
+    odoo_module.get_module_path = get_module_path
+    if getattr(openerp.modules, 'get_module_path', None) is not None:
+        openerp.modules.get_module_path = get_module_path
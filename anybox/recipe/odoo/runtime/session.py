@@ -2,7 +2,11 @@
 import warnings
 import sys
 import os
+import json
+import time
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
 from distutils.version import Version
 
 
@@ -21,6 +25,8 @@ else:
     from openerp.tools.parse_version import parse_version
 
 from optparse import OptionParser  # we support python >= 2.6
+from . import patch_odoo
+from .. import addons_index
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +34,22 @@ DEFAULT_VERSION_PARAMETER = 'buildout.db_version'
 
 DEFAULT_VERSION_FILE = 'VERSION.txt'
 
+DEFAULT_MODULES_PARAMETER = 'buildout.modules_fingerprints'
+
+
+def resident_memory():
+    """Return the resident memory of the current process, in bytes.
+
+    This reads ``/proc/self/statm``, and returns ``None`` on systems that
+    don't have it.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
 
 class OpenERPVersion(Version):
     """OpenERP idea of version, wrapped in a class.
@@ -78,6 +100,14 @@ class Session(object):
     * :attr:`registry`: access to model objects
     * :attr:`is_initialization`: True if and only if the database was not
       initialized before the call to :meth:`open`
+    * :attr:`modules_up_to_date`: True if and only if all the modules whose
+      sources changed have been updated since the call to :meth:`open`
+      (see :meth:`update_changed_modules`)
+
+    The index of modules built by the recipe is available right away as
+    :attr:`addons_index` (``None`` if there is none, or if modules have been
+    added or removed since it's been built), see
+    :mod:`anybox.recipe.odoo.addons_index`.
 
     Example application code::
 
@@ -120,12 +150,38 @@ class Session(object):
         self.openerp_config_file = conffile
 
         self._registry = self.cr = None
+        self._batch = None
+        self._modules_fingerprints = {}
+        self.timings = []
         if parse_config:
             config.parse_config(['-c', conffile])
+        index = addons_index.load_index_from_config(conffile)
+        if index is not None and addons_index.is_fresh(index):
+            self.addons_index = index
+            patch_odoo.use_addons_index(index)
+        else:
+            self.addons_index = None
 
     def ready(self):
         return self._registry is not None
 
+    @contextmanager
+    def timed(self, phase, **details):
+        """Context manager recording the duration of a phase.
+
+        The record is appended to :attr:`timings`. It is a dict with the
+        phase name, start time (seconds since the epoch), duration in
+        seconds and the given details. Records of nested phases come before
+        the enclosing one.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            record = dict(details, phase=phase, start=start,
+                          seconds=time.time() - start)
+            self.timings.append(record)
+
     def open(self, db=None, with_demo=False):
         """Load the database
 
@@ -156,9 +212,14 @@ class Session(object):
         if not db:
             db = ''  # expected value expected by OpenERP to start defaulting.
 
+        with self.timed('open', db=db):
+            self._open(db, with_demo)
+
+    def _open(self, db, with_demo):
         cnx = openerp.sql_db.db_connect(db)
         cr = cnx.cursor()
         self.is_initialization = not(openerp.modules.db.is_initialized(cr))
+        self.modules_up_to_date = False
         cr.close()
 
         startup.check_root_user()
@@ -172,8 +233,9 @@ class Session(object):
         config['without_demo'] = not with_demo
         self.with_demo = with_demo
 
-        self._registry = openerp.modules.registry.RegistryManager.get(
-            db, update_module=False)
+        with self.timed('registry_load', db=db):
+            self._registry = openerp.modules.registry.RegistryManager.get(
+                db, update_module=False)
         config['without_demo'] = saved_without_demo
         self.init_cursor()
         self.uid = SUPERUSER_ID
@@ -363,6 +425,9 @@ class Session(object):
                         Not installed modules will be ignored
                         The special name ``'all'`` triggers the update of
                         all installed modules.
+
+        Within a :meth:`batch`, the update is only registered, to be applied
+        at the end of the batch.
         """
         if db is None:
             if self.cr is None:
@@ -370,15 +435,116 @@ class Session(object):
                                  "be opened or an explicit database name")
             db = self.cr.dbname
 
+        if self._batch is not None:
+            self._batch_add(db, update=modules)
+            return
+
         if self.cr is not None:
             self.close()
+        modules = list(modules)
         for module in modules:
             config['update'][module] = 1
-        self._registry = openerp.modules.registry.RegistryManager.get(
-            db, update_module=True)
+        with self.timed('update_modules', db=db, modules=modules):
+            self._registry = openerp.modules.registry.RegistryManager.get(
+                db, update_module=True)
         config['update'].clear()
         self.init_cursor()
         self.clean_environments()
+        if 'all' in modules:
+            self.modules_up_to_date = True
+
+    # A later version might read that from buildout configuration.
+    _modules_parameter_name = DEFAULT_MODULES_PARAMETER
+
+    def installed_modules(self):
+        """Return the names of the modules installed in the database."""
+        self.cr.execute("SELECT name FROM ir_module_module "
+                        "WHERE state IN ('installed', 'to upgrade')")
+        return [row[0] for row in self.cr.fetchall()]
+
+    def modules_to_update(self):
+        """Compute the installed modules whose sources changed.
+
+        The comparison is made between checksums of the current contents of
+        the modules directories, as found through :attr:`addons_index`, and
+        those stored in the database by :meth:`record_modules_fingerprints`.
+        Installed modules that depend on changed ones are included.
+
+        :returns: the sorted list of modules to update, or ``None`` if that
+                  can't be determined (no index, or nothing recorded yet)
+        """
+        if self.addons_index is None:
+            return None
+        previous = self.registry('ir.config_parameter').get_param(
+            self.cr, self.uid, self._modules_parameter_name)
+        if not previous:
+            return None
+        installed = self.installed_modules()
+        return addons_index.modules_to_update(
+            self.addons_index, installed, json.loads(previous),
+            current=self.modules_fingerprints(installed))
+
+    def modules_fingerprints(self, modules):
+        """Return the fingerprints of the given modules sources.
+
+        They are computed once per session: that's what the modules have
+        been compared against, and what will be recorded afterwards.
+        See :func:`anybox.recipe.odoo.addons_index.module_fingerprints`.
+        """
+        cache = self._modules_fingerprints
+        missing = [m for m in modules if m not in cache]
+        if missing:
+            cache.update(addons_index.module_fingerprints(self.addons_index,
+                                                          missing))
+        return dict((m, cache[m]) for m in modules if m in cache)
+
+    def update_changed_modules(self):
+        """Update the modules whose sources changed, and their dependents.
+
+        See :meth:`modules_to_update`. If the modules to update can't be
+        determined, all of them are updated.
+        The session must have been opened beforehand.
+
+        Afterwards, :attr:`modules_up_to_date` is ``True``, or, within a
+        :meth:`batch`, will be once the batch is applied.
+
+        :returns: the list of updated modules, or ``['all']``
+        """
+        modules = self.modules_to_update()
+        if modules is None:
+            logger.info("No reference to compare modules with, "
+                        "updating all of them")
+            modules = ['all']
+        elif not modules:
+            logger.info("No module changed, nothing to update")
+            self.modules_up_to_date = True
+            return modules
+        else:
+            logger.info("Updating changed modules and their dependents: %s",
+                        ', '.join(modules))
+        if self._batch is not None:
+            self._batch['modules_up_to_date'] = True
+        self.update_modules(modules)
+        if self._batch is None:
+            self.modules_up_to_date = True
+        return modules
+
+    def record_modules_fingerprints(self):
+        """Store the current state of modules sources in the database.
+
+        This is the reference for subsequent calls of
+        :meth:`modules_to_update`, hence must be called only if the database
+        is up to date with the sources of all installed modules. The upgrade
+        script calls it after successful runs that initialized the database
+        or ended with :attr:`modules_up_to_date`.
+        It does nothing if :attr:`addons_index` is ``None``.
+        """
+        if self.addons_index is None:
+            return
+        self.registry('ir.config_parameter').set_param(
+            self.cr, self.uid, self._modules_parameter_name,
+            json.dumps(self.modules_fingerprints(self.installed_modules()),
+                       sort_keys=True))
 
     def install_modules(self, modules, db=None, update_modules_list=True,
                         open_with_demo=False):
@@ -401,6 +567,9 @@ class Session(object):
                                     *and commit* before the install begins.
         :param open_with_demo: if ``db`` is not None, will be passed to
                                :meth:`open`.
+
+        Within a :meth:`batch`, the installation is only registered, to be
+        applied at the end of the batch.
         """
         already_open = self.cr is not None
         if db is None:
@@ -408,6 +577,10 @@ class Session(object):
                 raise ValueError("install_modules needs either the session to "
                                  "be opened or an explicit database name")
             db = self.cr.dbname
+        if self._batch is not None:
+            self._batch_add(db, init=modules,
+                            update_modules_list=update_modules_list)
+            return
         elif update_modules_list and not (
                 already_open and self.cr.dbname == db):
             self.open(db=db, with_demo=open_with_demo)
@@ -423,15 +596,87 @@ class Session(object):
         # with update_modules_list=False, an explicitely named DB would not
         # have gone through open() yet.
         config['without_demo'] = not getattr(self, 'with_demo', open_with_demo)
+        modules = list(modules)
         for module in modules:
             config['init'][module] = 1
-        self._registry = openerp.modules.registry.RegistryManager.get(
-            db, update_module=True, force_demo=self.with_demo)
+        with self.timed('install_modules', db=db, modules=modules):
+            self._registry = openerp.modules.registry.RegistryManager.get(
+                db, update_module=True, force_demo=self.with_demo)
         config['init'].clear()
         config['without_demo'] = saved_without_demo
         self.init_cursor()
         self.clean_environments()
 
+    @contextmanager
+    def batch(self):
+        """Context manager to apply several module operations at once.
+
+        Calls to :meth:`install_modules` and :meth:`update_modules` within
+        the ``with`` block are gathered, and applied in a single loading of
+        the registry when the block exits, instead of one per call. The
+        session must be opened beforehand, and the calls can only be about
+        its current database. Example::
+
+           with session.batch():
+               session.install_modules(['sale', 'purchase'])
+               session.update_modules(['stock'])
+
+        If an exception occurs within the block, nothing is applied.
+        """
+        if self._batch is not None:
+            raise RuntimeError("Batches of module operations can't be nested")
+        if self.cr is None:
+            raise ValueError("A batch of module operations needs the "
+                             "session to be opened")
+        self._batch = dict(db=self.cr.dbname, init=[], update=[],
+                           update_modules_list=False,
+                           modules_up_to_date=False)
+        try:
+            yield
+            batch = self._batch
+        finally:
+            self._batch = None
+        self._apply_batch(batch)
+
+    def _batch_add(self, db, init=(), update=(), update_modules_list=False):
+        batch = self._batch
+        if db != batch['db']:
+            raise ValueError("A batch of module operations applies to the "
+                             "opened database %r only, not %r" % (
+                                 batch['db'], db))
+        batch['init'].extend(m for m in init if m not in batch['init'])
+        batch['update'].extend(m for m in update if m not in batch['update'])
+        batch['update_modules_list'] |= update_modules_list
+
+    def _apply_batch(self, batch):
+        init, update = batch['init'], batch['update']
+        if not init and not update:
+            return
+        if init and batch['update_modules_list']:
+            self.update_modules_list()
+            self.cr.commit()
+
+        db = batch['db']
+        self.close()
+        saved_without_demo = config['without_demo']
+        config['without_demo'] = not self.with_demo
+        for module in init:
+            config['init'][module] = 1
+        for module in update:
+            config['update'][module] = 1
+        try:
+            with self.timed('load_modules', db=db, init=init, update=update):
+                self._registry = openerp.modules.registry.RegistryManager.get(
+                    db, update_module=True, force_demo=self.with_demo)
+        finally:
+            config['init'].clear()
+            config['update'].clear()
+            config['without_demo'] = saved_without_demo
+        self.init_cursor()
+        self.clean_environments()
+        if batch['modules_up_to_date'] or 'all' in update:
+            self.modules_up_to_date = True
+
     def handle_command_line_options(self, to_handle):
         """Handle prescribed command line options and eat them.
 
@@ -491,3 +736,137 @@ class Session(object):
                 logger.info("No database specified, using the one specified "
                             "in buildout configuration.")
             self.open(db=options.db_name)
+
+
+class SessionPool(Session):
+    """A :class:`Session` that keeps the registries of several databases.
+
+    With a plain :class:`Session`, switching to another database with
+    :meth:`open` requires to :meth:`close` the current one, and its registry
+    has to be loaded again the next time it is opened. Instead, the
+    registry and cursor of the database being left are kept aside, and
+    reused as such if it is opened again::
+
+       pool = SessionPool(session.openerp_config_file, session.buildout_dir,
+                          parse_config=False)
+       for db_name in db_names:
+           pool.open(db_name)
+           (...)
+           pool.cr.commit()
+       pool.close_all()
+
+    Switching databases neither commits nor rolls back anything: the
+    transaction of the cursor kept aside is resumed when its database is
+    opened again.
+
+    The least recently used databases are closed for good as soon as more
+    than ``max_registries`` of them are kept, the current one included.
+
+    A database kept aside is reopened from scratch if it is opened again
+    with another value of ``with_demo``, as a plain :class:`Session` would.
+
+    If ``max_memory`` (in bytes) is given, one more of them is closed upon
+    each opening after which the resident memory of the process (see
+    :func:`resident_memory`) exceeds it. Not more, because the memory freed
+    by closing a registry is usually kept by the Python process for later
+    reuse, instead of being returned to the system: the resident memory
+    doesn't go down, and the next registries to load take it instead.
+
+    :meth:`close` closes the current database for good. The pool has no
+    other effect on the operations that reload the registry, such as
+    :meth:`update_modules`.
+    """
+
+    _per_database_attrs = ('_registry', 'cr', 'with_demo',
+                           'is_initialization', 'modules_up_to_date',
+                           '_db_version')
+
+    def __init__(self, conffile, buildout_dir, parse_config=True,
+                 max_registries=4, max_memory=None):
+        if max_registries < 1:
+            raise ValueError("max_registries must be at least 1, "
+                             "got %r" % max_registries)
+        super(SessionPool, self).__init__(conffile, buildout_dir,
+                                          parse_config=parse_config)
+        self.max_registries = max_registries
+        self.max_memory = max_memory
+        self._resident = OrderedDict()
+
+    @property
+    def resident_databases(self):
+        """Names of the databases kept aside, least recently used first."""
+        return list(self._resident)
+
+    def _open(self, db, with_demo):
+        if with_demo is None:  # same default as in Session._open
+            with_demo = config['without_demo']
+        if self.cr is not None:
+            if self.cr.dbname == db and self.with_demo == with_demo:
+                return
+            self._put_aside()
+        resident = self._resident.pop(db, None)
+        if resident is not None and resident['with_demo'] != with_demo:
+            # demo data is a matter of registry load, see Session.open()
+            logger.info("Reopening database %r, to change with_demo to %r",
+                        db, with_demo)
+            self._close_kept(db, resident)
+            resident = None
+        if resident is None:
+            super(SessionPool, self)._open(db, with_demo)
+        else:
+            logger.debug("Reusing the registry of database %r", db)
+            for attr, value in resident.items():
+                setattr(self, attr, value)
+            self.uid = SUPERUSER_ID
+            self.init_environments()
+        self._evict()
+
+    def _put_aside(self):
+        """Keep the current database aside, to be reopened later on."""
+        self.clean_environments(reinit=False)
+        db = self.cr.dbname
+        self._resident[db] = dict(
+            (attr, self.__dict__.pop(attr, None))
+            for attr in self._per_database_attrs)
+        self._registry = self.cr = None
+
+    def _evict(self):
+        """Close databases kept aside to stay within the bounds.
+
+        See the class docstring about ``max_memory``.
+        """
+        while len(self._resident) >= self.max_registries:
+            self._close_resident()
+        if self.max_memory is None or not self._resident:
+            return
+        memory = resident_memory()
+        if memory is not None and memory > self.max_memory:
+            self._close_resident()
+
+    def _close_resident(self):
+        """Close the least recently used database kept aside."""
+        db, resident = self._resident.popitem(last=False)
+        logger.info("Closing database %r, kept aside by the session pool",
+                    db)
+        self._close_kept(db, resident)
+
+    def _close_kept(self, db, resident):
+        """Close for good a database that was kept aside."""
+        resident['cr'].close()
+        openerp.modules.registry.RegistryManager.delete(db)
+
+    def close(self):
+        """Close the cursor and forget about the current database.
+
+        The databases kept aside are left untouched.
+        """
+        super(SessionPool, self).close()
+        self._registry = self.cr = None
+        self.__dict__.pop('_db_version', None)
+
+    def close_all(self):
+        """Close the current database, if any, and all those kept aside."""
+        if self.cr is not None:
+            self.close()
+        while self._resident:
+            self._close_resident()
@@ -11,6 +11,7 @@ from here.
 import sys
 import os
 from . import patch_odoo
+from .. import addons_index
 
 
 def insert_args(arguments):
@@ -55,15 +56,23 @@ def main(starter, conf, version=None, just_test=False,
         else:
             arguments.append('--load=' + ','.join(server_wide_modules))
 
+    index = addons_index.load_index_from_config(conf)
+    if index is not None and not addons_index.is_fresh(index):
+        index = None  # modules added or removed since last buildout run
+
     if '--install-all' in sys.argv:
         sys.argv.remove('--install-all')
-        from openerp.tools import config
-        # Maybe we should preparse config in all cases and therefore avoid
-        # adding the '-c' on the fly ?
-        # Still, cautious about pre-6.1 versions
-        config.parse_config(['-c', conf])
-        from openerp.modules import get_modules
-        arguments.extend(('-i', ','.join(get_modules())))
+        if index is not None:
+            modules = addons_index.installable_modules(index)
+        else:
+            from openerp.tools import config
+            # Maybe we should preparse config in all cases and therefore
+            # avoid adding the '-c' on the fly ?
+            # Still, cautious about pre-6.1 versions
+            config.parse_config(['-c', conf])
+            from openerp.modules import get_modules
+            modules = get_modules()
+        arguments.extend(('-i', ','.join(modules)))
 
     insert_args(arguments)
 
@@ -71,6 +80,9 @@ def main(starter, conf, version=None, just_test=False,
         assert gevent_script_path is not None
         patch_odoo.do_patch(gevent_script_path)
 
+    if index is not None:
+        patch_odoo.use_addons_index(index)
+
     os.chdir(os.path.split(starter)[0])
     glob = globals()
     glob['__name__'] = '__main__'
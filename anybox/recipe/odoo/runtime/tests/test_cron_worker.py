@@ -0,0 +1,141 @@
+import warnings
+from unittest import TestCase
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    from .. import cron_worker
+    from ..cron_worker import DatabaseDiscovery
+    from ..cron_worker import RegistryCache
+    from ..cron_worker import worker_index
+
+
+class FakeDiscovery(DatabaseDiscovery):
+    """Discovery on a fake cluster, recording the initialization checks."""
+
+    def __init__(self, cluster, **kw):
+        super(FakeDiscovery, self).__init__(**kw)
+        self.cluster = cluster
+        self.checked = []
+
+    def list_databases(self):
+        return sorted(self.cluster)
+
+    def is_initialized(self, db_name):
+        self.checked.append(db_name)
+        initialized = self.cluster[db_name]
+        if initialized is None:
+            raise RuntimeError("Connection refused")
+        return initialized
+
+
+class TestDatabaseDiscovery(TestCase):
+
+    def test_discover(self):
+        cluster = dict(db1=True, db2=False, db3=True, broken=None)
+        discovery = FakeDiscovery(cluster)
+        self.assertEqual(discovery(), ['db1', 'db3'])
+        self.assertEqual(sorted(discovery.checked),
+                         ['broken', 'db1', 'db2', 'db3'])
+
+        # cached
+        cluster['db4'] = True
+        discovery.checked = []
+        self.assertEqual(discovery(), ['db1', 'db3'])
+        self.assertEqual(discovery.checked, [])
+
+        # initialized databases aren't checked again
+        del cluster['db1']
+        cluster['db2'] = True
+        self.assertEqual(discovery.discover(), ['db2', 'db3', 'db4'])
+        self.assertEqual(sorted(discovery.checked), ['broken', 'db2', 'db4'])
+
+    def test_refresh_interval(self):
+        cluster = dict(db1=True)
+        discovery = FakeDiscovery(cluster, refresh_interval=0)
+        self.assertEqual(discovery(), ['db1'])
+        cluster['db2'] = True
+        self.assertEqual(discovery(), ['db1', 'db2'])
+
+
+class TestWorkerIndex(TestCase):
+
+    def test_worker_index(self):
+        db_names = ['tenant_%d' % i for i in range(200)] + [u'caf\xe9']
+        shards = dict((db_name, worker_index(db_name, 4))
+                      for db_name in db_names)
+        self.assertEqual(set(shards.values()), set(range(4)))
+        self.assertEqual(worker_index('tenant_0', 1), 0)
+
+        # adding a worker moves databases to the new one only
+        for db_name in db_names:
+            index = worker_index(db_name, 5)
+            self.assertTrue(index in (shards[db_name], 4))
+
+
+class FakeRegistryCache(RegistryCache):
+    """Registry cache recording the loads and releases of registries."""
+
+    def __init__(self, size, failing=(), **kw):
+        super(FakeRegistryCache, self).__init__(size, **kw)
+        self.failing = failing
+        self.registries = set()
+        self.events = []
+
+    def process_jobs(self, db_name):
+        if db_name not in self.registries:
+            self.registries.add(db_name)
+            self.events.append(('load', db_name))
+        if db_name in self.failing:
+            raise RuntimeError("Job failed")
+
+    def release_registry(self, db_name):
+        self.registries.discard(db_name)
+        self.events.append(('release', db_name))
+
+
+class TestRun(TestCase):
+
+    def tearDown(self):
+        cron_worker.quit_signals_received = 0
+
+    def run_rounds(self, rounds, registries):
+        """Run the worker for the given list of rounds of databases."""
+        rounds = list(rounds)
+        rounds.append(rounds[-1])
+
+        def databases():
+            if len(rounds) == 1:  # stop before processing
+                cron_worker.quit_signals_received = 1
+            return rounds.pop(0)
+
+        cron_worker.run(databases, poll_interval=0, registries=registries)
+
+    def test_registries_kept(self):
+        registries = FakeRegistryCache(3)
+        self.run_rounds([['db1', 'db2', 'db3']] * 3, registries)
+        self.assertEqual(registries.events, [
+            ('load', 'db1'), ('load', 'db2'), ('load', 'db3')])
+        self.assertEqual(registries.loaded, ['db1', 'db2', 'db3'])
+
+    def test_registries_bound(self):
+        registries = FakeRegistryCache(2)
+        self.run_rounds([['db1', 'db2'], ['db1', 'db2', 'db3'],
+                         ['db3', 'db2']], registries)
+        self.assertEqual(registries.events, [
+            ('load', 'db1'), ('load', 'db2'),
+            # second round: least recently used one released
+            ('load', 'db3'), ('release', 'db1'),
+        ])
+        self.assertEqual(registries.loaded, ['db3', 'db2'])
+
+    def test_registries_released(self):
+        registries = FakeRegistryCache(4, failing=['broken'])
+        self.run_rounds([['db1', 'broken', 'db2'], ['db2', 'broken']],
+                        registries)
+        self.assertEqual(registries.events, [
+            ('load', 'db1'), ('load', 'broken'), ('release', 'broken'),
+            ('load', 'db2'),
+            # db1 isn't listed any more
+            ('release', 'db1'), ('load', 'broken'), ('release', 'broken'),
+        ])
+        self.assertEqual(registries.loaded, ['db2'])
@@ -0,0 +1,343 @@
+import warnings
+from unittest import TestCase
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    from .. import session as session_module
+    from ..session import Session
+    from ..session import SessionPool
+
+
+class FakeCursor(object):
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.closed = False
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRegistry(object):
+
+    def __init__(self, manager, db):
+        self.manager = manager
+        self.db_name = db
+
+    def cursor(self):
+        return FakeCursor(self.db_name)
+
+    def get(self, model):
+        return FakeModel(self.manager, model)
+
+
+class FakeModel(object):
+
+    def __init__(self, manager, name):
+        self.manager = manager
+        self.name = name
+
+    def update_list(self, cr, uid):
+        self.manager.events.append(('update_list', cr.dbname))
+
+
+class FakeRegistryManager(object):
+    """Records the registry loads, with the modules to install or update."""
+
+    def __init__(self):
+        self.events = []
+
+    def get(self, db, update_module=False, force_demo=False):
+        config = session_module.config
+        if update_module:
+            self.events.append(('load', db, sorted(config['init']),
+                                sorted(config['update'])))
+        else:
+            self.events.append(('load', db))
+        return FakeRegistry(self, db)
+
+    def delete(self, db):
+        self.events.append(('delete', db))
+
+
+class FakeOpenERP(object):
+    """Just what the session needs, apart from :meth:`Session._open`."""
+
+    def __init__(self):
+        registry = type('registry', (object,),
+                        dict(RegistryManager=FakeRegistryManager()))
+        self.modules = type('modules', (object,), dict(registry=registry))
+
+
+class FakeSession(Session):
+    """Session on fake databases, whose opening is only a registry load."""
+
+    def __init__(self, conffile='/no/such/openerp.cfg',
+                 buildout_dir='/no/buildout', parse_config=False, **kw):
+        super(FakeSession, self).__init__(conffile, buildout_dir,
+                                          parse_config=parse_config, **kw)
+        self.changed_modules = []
+
+    def _open(self, db, with_demo):
+        self.is_initialization = False
+        self.modules_up_to_date = False
+        self.with_demo = with_demo
+        self._registry = self.registry_manager.get(db)
+        self.init_cursor()
+        self.uid = 1
+
+    @property
+    def registry_manager(self):
+        return session_module.openerp.modules.registry.RegistryManager
+
+    def modules_to_update(self):
+        return self.changed_modules
+
+
+class FakePool(SessionPool, FakeSession):
+
+    def __init__(self, **kw):
+        super(FakePool, self).__init__('/no/such/openerp.cfg', '/no/buildout',
+                                       parse_config=False, **kw)
+
+
+class FakeOpenERPTestCase(TestCase):
+
+    def setUp(self):
+        session_module.openerp = FakeOpenERP()
+        session_module.config = dict(init={}, update={}, without_demo=False,
+                                     db_name='')
+        session_module.SUPERUSER_ID = 1
+
+    def tearDown(self):
+        del session_module.openerp
+        del session_module.config
+        del session_module.SUPERUSER_ID
+
+    @property
+    def events(self):
+        return session_module.openerp.modules.registry.RegistryManager.events
+
+
+class TestTimed(TestCase):
+
+    def setUp(self):
+        self.session = Session('/no/such/openerp.cfg', '/no/buildout',
+                               parse_config=False)
+
+    def test_records(self):
+        session = self.session
+        with session.timed('upgrade', db='db1'):
+            with session.timed('update_modules', modules=['sale']):
+                pass
+        self.assertEqual([t['phase'] for t in session.timings],
+                         ['update_modules', 'upgrade'])
+        inner, outer = session.timings
+        self.assertEqual(inner['modules'], ['sale'])
+        self.assertEqual(outer['db'], 'db1')
+        self.assertTrue(outer['start'] <= inner['start'])
+        self.assertTrue(outer['seconds'] >= inner['seconds'] >= 0)
+
+    def test_exception(self):
+        session = self.session
+        with self.assertRaises(ZeroDivisionError):
+            with session.timed('failing'):
+                1 / 0
+        self.assertEqual([t['phase'] for t in session.timings], ['failing'])
+
+
+class TestBatch(FakeOpenERPTestCase):
+
+    def test_coalesce(self):
+        session = FakeSession()
+        session.open(db='db1')
+        del self.events[:]
+        with session.batch():
+            session.install_modules(['sale', 'purchase'])
+            session.update_modules(['stock'])
+            session.install_modules(['sale'], update_modules_list=False)
+            session.update_modules(['stock', 'account'])
+            self.assertEqual(self.events, [])
+        self.assertEqual(self.events, [
+            ('update_list', 'db1'),
+            ('delete', 'db1'),
+            ('load', 'db1', ['purchase', 'sale'], ['account', 'stock']),
+        ])
+        config = session_module.config
+        self.assertEqual((config['init'], config['update']), ({}, {}))
+        self.assertEqual(session.cr.dbname, 'db1')
+        self.assertEqual([t['phase'] for t in session.timings],
+                         ['open', 'load_modules'])
+        self.assertFalse(session.modules_up_to_date)
+
+    def test_update_only(self):
+        session = FakeSession()
+        session.open(db='db1')
+        del self.events[:]
+        with session.batch():
+            session.update_modules(['stock'])
+        self.assertEqual(self.events, [('delete', 'db1'),
+                                       ('load', 'db1', [], ['stock'])])
+
+    def test_empty(self):
+        session = FakeSession()
+        session.open(db='db1')
+        del self.events[:]
+        with session.batch():
+            pass
+        self.assertEqual(self.events, [])
+
+    def test_exception(self):
+        session = FakeSession()
+        session.open(db='db1')
+        del self.events[:]
+        with self.assertRaises(ZeroDivisionError):
+            with session.batch():
+                session.install_modules(['sale'])
+                1 / 0
+        self.assertEqual(self.events, [])
+        self.assertIsNone(session._batch)
+
+    def test_errors(self):
+        session = FakeSession()
+        with self.assertRaises(ValueError):
+            with session.batch():
+                pass
+
+        session.open(db='db1')
+        with self.assertRaises(RuntimeError):
+            with session.batch():
+                with session.batch():
+                    pass
+        with self.assertRaises(ValueError):
+            with session.batch():
+                session.update_modules(['stock'], db='db2')
+
+    def test_update_changed_modules(self):
+        session = FakeSession()
+        session.open(db='db1')
+        session.changed_modules = ['sale', 'sale_ext']
+        del self.events[:]
+        with session.batch():
+            session.install_modules(['purchase'], update_modules_list=False)
+            self.assertEqual(session.update_changed_modules(),
+                             ['sale', 'sale_ext'])
+            self.assertFalse(session.modules_up_to_date)
+        self.assertEqual(self.events, [
+            ('delete', 'db1'),
+            ('load', 'db1', ['purchase'], ['sale', 'sale_ext'])])
+        self.assertTrue(session.modules_up_to_date)
+
+
+class TestSessionPool(FakeOpenERPTestCase):
+
+    def setUp(self):
+        super(TestSessionPool, self).setUp()
+        self.memory = None
+        self.saved_resident_memory = session_module.resident_memory
+        session_module.resident_memory = lambda: self.memory
+
+    def tearDown(self):
+        session_module.resident_memory = self.saved_resident_memory
+        super(TestSessionPool, self).tearDown()
+
+    def test_reuse(self):
+        pool = FakePool()
+        pool.open(db='db1', with_demo=True)
+        cr1 = pool.cr
+        pool.modules_up_to_date = True
+        pool.open(db='db2')
+        self.assertEqual(pool.resident_databases, ['db1'])
+        self.assertFalse(pool.modules_up_to_date)
+        self.assertFalse(cr1.closed)
+
+        del self.events[:]
+        pool.open(db='db1', with_demo=True)
+        self.assertEqual(self.events, [])
+        self.assertTrue(pool.cr is cr1)
+        self.assertTrue(pool.with_demo)
+        self.assertTrue(pool.modules_up_to_date)
+        self.assertEqual(pool.resident_databases, ['db2'])
+
+        # opening the current database again is a no-op
+        pool.open(db='db1', with_demo=True)
+        self.assertEqual(self.events, [])
+
+    def test_reopen_with_demo(self):
+        pool = FakePool()
+        pool.open(db='db1')
+        cr1 = pool.cr
+        pool.open(db='db2')
+
+        del self.events[:]
+        pool.open(db='db1', with_demo=True)
+        self.assertEqual(self.events, [('delete', 'db1'), ('load', 'db1')])
+        self.assertTrue(cr1.closed)
+        self.assertTrue(pool.with_demo)
+        self.assertEqual(pool.resident_databases, ['db2'])
+
+        # same with the current database
+        cr1 = pool.cr
+        del self.events[:]
+        pool.open(db='db1', with_demo=False)
+        self.assertEqual(self.events, [('delete', 'db1'), ('load', 'db1')])
+        self.assertTrue(cr1.closed)
+        self.assertFalse(pool.with_demo)
+        self.assertEqual(pool.resident_databases, ['db2'])
+
+        # None stands for the configuration, as with a plain Session
+        del self.events[:]
+        pool.open(db='db1', with_demo=None)
+        self.assertEqual(self.events, [])
+
+    def test_max_registries(self):
+        pool = FakePool(max_registries=3)
+        for db in ('db1', 'db2', 'db3', 'db1'):
+            pool.open(db=db)
+        self.assertEqual(pool.resident_databases, ['db2', 'db3'])
+        cr2 = pool._resident['db2']['cr']
+
+        del self.events[:]
+        pool.open(db='db4')
+        # the least recently used one is closed
+        self.assertEqual(pool.resident_databases, ['db3', 'db1'])
+        self.assertEqual(self.events, [('load', 'db4'), ('delete', 'db2')])
+        self.assertTrue(cr2.closed)
+
+        del self.events[:]
+        pool.close_all()
+        self.assertEqual(pool.resident_databases, [])
+        self.assertIsNone(pool.cr)
+        self.assertEqual(sorted(self.events), [
+            ('delete', 'db1'), ('delete', 'db3'), ('delete', 'db4')])
+
+    def test_max_registries_validation(self):
+        with self.assertRaises(ValueError):
+            FakePool(max_registries=0)
+
+    def test_max_memory(self):
+        pool = FakePool(max_registries=10, max_memory=1000)
+        self.memory = 1000
+        for db in ('db1', 'db2', 'db3'):
+            pool.open(db=db)
+        self.assertEqual(pool.resident_databases, ['db1', 'db2'])
+
+        # resident memory doesn't go down as registries are closed:
+        # only one of them per opening
+        self.memory = 1001
+        pool.open(db='db4')
+        self.assertEqual(pool.resident_databases, ['db2', 'db3'])
+        pool.open(db='db2')
+        self.assertEqual(pool.resident_databases, ['db4'])
+        pool.open(db='db5')
+        self.assertEqual(pool.resident_databases, ['db2'])
+        pool.open(db='db6')
+        self.assertEqual(pool.resident_databases, ['db5'])
+
+        # unknown resident memory
+        self.memory = None
+        pool.open(db='db7')
+        self.assertEqual(pool.resident_databases, ['db5', 'db6'])
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import pstats
+import signal
+import shutil
+import logging
+import tempfile
+import warnings
+from unittest import TestCase
+from datetime import datetime
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    from .. import upgrade
+    from ..upgrade import fan_out
+    from ..upgrade import exit_status
+    from ..upgrade import run_instrumented
+
+
+class FakeSession(object):
+    """Just what :func:`run_instrumented` needs from a session."""
+
+    cr = None
+
+    def __init__(self):
+        self.timings = []
+
+
+def fake_target(item):
+    """Sleep, then exit with the given code, or get killed by SIGKILL."""
+    name, code, delay = item
+    time.sleep(delay)
+    if code == 'kill':
+        os.kill(os.getpid(), signal.SIGKILL)
+    sys.exit(code)
+
+
+class TestFanOut(TestCase):
+
+    def test_exit_status(self):
+        self.assertEqual([exit_status(code)
+                          for code in (None, 0, 3, 'failed', 1000)],
+                         [0, 0, 3, 1, 1])
+
+    def test_completion_order(self):
+        items = [('slow', 0, 0.5), ('fast', 3, 0), ('killed', 'kill', 0)]
+        results = [(item[0], exitcode) for item, exitcode, seconds
+                   in fan_out(fake_target, items, 2, poll_interval=0.01)]
+        self.assertEqual(results, [('fast', 3), ('killed', -signal.SIGKILL),
+                                   ('slow', 0)])
+
+    def test_one_at_a_time(self):
+        items = [('slow', 0, 0.2), ('fast', 2, 0)]
+        results = list(fan_out(fake_target, items, 1, poll_interval=0.01))
+        self.assertEqual([(item[0], exitcode)
+                          for item, exitcode, _ in results],
+                         [('slow', 0), ('fast', 2)])
+        self.assertTrue(results[0][2] >= 0.2)
+
+
+class TestUpgradeDatabases(TestCase):
+
+    statuses = dict(db1=None, db2=2, tenant_1='failed', tenant_2=0,
+                    tenant_3='kill')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, 'upgrade.log')
+        self.saved = upgrade._upgrade_database, upgrade.list_databases
+        upgrade._upgrade_database = self.fake_upgrade_database
+        upgrade.list_databases = lambda pattern: ['db2', 'tenant_1',
+                                                  'tenant_2', 'tenant_3']
+
+    def tearDown(self):
+        upgrade._upgrade_database, upgrade.list_databases = self.saved
+        logger = logging.getLogger('openerp.upgrade')
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+        shutil.rmtree(self.tmpdir)
+
+    def fake_upgrade_database(self, db_name):
+        status = self.statuses[db_name]
+        if status == 'kill':
+            os.kill(os.getpid(), signal.SIGKILL)
+        return status
+
+    def upgrade_databases(self, db_names, db_pattern=None, jobs=2):
+        return upgrade.upgrade_databases(
+            None, 'upgrade.py', 'run', db_names, db_pattern, jobs, False,
+            self.log_path, 'INFO', None)
+
+    def read_log(self):
+        with open(self.log_path) as log_file:
+            return log_file.read()
+
+    def test_success(self):
+        self.assertEqual(self.upgrade_databases(['db1', 'tenant_2']), 0)
+        self.assertFalse('Failed databases' in self.read_log())
+
+    def test_failures(self):
+        self.assertEqual(self.upgrade_databases(['db2', None], 'tenant_*'),
+                         1)
+        log = self.read_log()
+        # failures are listed in the order of the databases
+        self.assertTrue("Failed databases: db2, tenant_1, tenant_3" in log)
+        self.assertTrue("Database 'db2': failure (status code 2)" in log)
+        self.assertTrue("Database 'tenant_3': upgrade process killed by "
+                        "signal %d" % signal.SIGKILL in log)
+
+    def test_no_database(self):
+        self.assertEqual(self.upgrade_databases([None]), 1)
+
+
+class TestRunInstrumented(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, 'upgrade.log')
+        self.saved = upgrade.run_upgrade
+        self.session = FakeSession()
+
+    def tearDown(self):
+        upgrade.run_upgrade = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def fake_run_upgrade(self, status=None, exc=None):
+        def run_upgrade(session, db_name, *args):
+            session.timings.append(dict(phase='open', db=db_name,
+                                        start=0, seconds=1.5))
+            if exc is not None:
+                raise exc
+            return status
+        upgrade.run_upgrade = run_upgrade
+
+    def run_instrumented(self, **kw):
+        return run_instrumented(self.session, 'db1', 'upgrade.py', 'run',
+                                False, logging.getLogger('test'),
+                                datetime.utcnow(), self.log_path, **kw)
+
+    def read_report(self):
+        with open(os.path.join(self.tmpdir, 'upgrade.json')) as report:
+            return json.load(report)
+
+    def test_report(self):
+        self.fake_run_upgrade(status=3)
+        self.assertEqual(self.run_instrumented(), 3)
+        report = self.read_report()
+        self.assertEqual(report['database'], 'db1')
+        self.assertEqual(report['status'], 3)
+        self.assertEqual(report['phases'], [
+            dict(phase='open', db='db1', start=0, seconds=1.5)])
+        self.assertTrue(report['seconds'] >= 0)
+        self.assertTrue('started' in report)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'upgrade.prof')))
+
+    def test_report_exception(self):
+        self.fake_run_upgrade(exc=ZeroDivisionError())
+        with self.assertRaises(ZeroDivisionError):
+            self.run_instrumented()
+        report = self.read_report()
+        self.assertEqual(report['status'], 'exception')
+        self.assertEqual([p['phase'] for p in report['phases']], ['open'])
+
+    def test_profile(self):
+        self.fake_run_upgrade()
+        self.assertIsNone(self.run_instrumented(profile=True))
+        self.assertIsNone(self.read_report()['status'])
+        stats = pstats.Stats(os.path.join(self.tmpdir, 'upgrade.prof'))
+        self.assertTrue(any(func[2] == 'run_upgrade'
+                            for func in stats.stats))
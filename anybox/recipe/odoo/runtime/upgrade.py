@@ -7,10 +7,16 @@ taking logic.
 import os
 import sys
 import imp
+import time
+import json
+import cProfile
+import fnmatch
 import logging
+import multiprocessing
 from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter
 from argparse import SUPPRESS
+from collections import deque
 from datetime import datetime
 from math import ceil
 
@@ -19,6 +25,10 @@ from .session import Session
 
 DEFAULT_LOG_FILE = 'upgrade.log'
 
+POLL_INTERVAL = 0.5
+"""Delay in seconds between two checks of the processes of :func:`fan_out`.
+"""
+
 
 def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
     """Run the upgrade from a source file.
@@ -60,8 +70,20 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
                         help="Suppress console output from the main upgrade "
                              "script (lower level stages can still write)")
     parser.add_argument('-d', '--db-name', default=SUPPRESS,
+                        action='append',
                         help="Database name. If ommitted, the general default "
-                        "values from OpenERP config file or libpq will apply.")
+                        "values from OpenERP config file or libpq will apply."
+                        " Can be repeated to upgrade several databases.")
+    parser.add_argument('--db-pattern', default=SUPPRESS,
+                        help="Upgrade all databases whose names match this "
+                        "shell-style pattern, e.g., 'tenant_*'.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Maximum number of databases to upgrade "
+                        "concurrently, each in its own process.")
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile the upgrade with cProfile, and dump "
+                        "the statistics next to the log file (.prof "
+                        "extension).")
     parser.add_argument('--init-load-demo-data', action='store_true',
                         help="Demo data will be loaded with module "
                         "installations if and only if "
@@ -72,6 +94,9 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
     log_level = arguments.log_level.upper()
     console_level = arguments.console_log_level.upper()
     quiet = arguments.quiet
+    with_demo = bool(arguments.init_load_demo_data)
+    db_names = getattr(arguments, 'db_name', [None])
+    db_pattern = getattr(arguments, 'db_pattern', None)
 
     try:
         log_file = open(log_path, 'a')
@@ -85,6 +110,13 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
     config['logfile'] = log_path
     config['log-level'] = log_level
 
+    if db_pattern is not None or len(db_names) > 1:
+        log_file.close()
+        sys.exit(upgrade_databases(
+            session, upgrade_script, upgrade_callable, db_names, db_pattern,
+            arguments.jobs, with_demo, log_path, log_level,
+            None if quiet else console_level, arguments.profile))
+
     start_time = datetime.utcnow()
     if not quiet:
         print("Starting upgrade, logging details to %s at level %s, "
@@ -92,25 +124,53 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
                   log_path, log_level, console_level))
         print('')
 
+    logger = upgrade_logger(log_path, log_level,
+                            None if quiet else console_level)
+    statuscode = run_instrumented(session, db_names[0], upgrade_script,
+                                  upgrade_callable, with_demo, logger,
+                                  start_time, log_path, arguments.profile)
+    if statuscode is not None and statuscode != 0:
+        logger.error("Please check logs at %s" % log_path)
+
+    log_file.close()
+    sys.exit(statuscode)
+
+
+def upgrade_logger(log_path, log_level, console_level=None):
+    """Return the logger for the upgrade process, with its handlers.
+
+    :param console_level: if ``None``, nothing is logged to the console
+    """
     logger = logging.getLogger('openerp.upgrade')
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(getattr(logging, console_level))
-    console_handler.setFormatter(logging.Formatter(
-        "%(asctime)s %(levelname)s  %(message)s"))
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
 
+    formatter = logging.Formatter("%(asctime)s %(levelname)s  %(message)s")
     log_file_handler = logging.FileHandler(log_path, 'a')
     log_file_handler.setLevel(getattr(logging, log_level))
-    log_file_handler.setFormatter(logging.Formatter(
-                 "%(asctime)s %(levelname)s  %(message)s"))
-
+    log_file_handler.setFormatter(formatter)
     logger.addHandler(log_file_handler)
 
-    if not arguments.quiet:
+    if console_level is not None:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(getattr(logging, console_level))
+        console_handler.setFormatter(formatter)
         logger.addHandler(console_handler)
+    return logger
+
 
-    db_name = getattr(arguments, 'db_name', None)
+def run_upgrade(session, db_name, upgrade_script, upgrade_callable,
+                with_demo, logger, start_time):
+    """Open the database and run the upgrade callable on it.
+
+    The version is recorded in case of success, and so are the modules
+    fingerprints if the database is up to date with the modules sources
+    (see :meth:`.Session.record_modules_fingerprints`).
+
+    :returns: the status code returned by the upgrade callable
+    """
     logger.info("Opening database %r", db_name)
-    session.open(db=db_name, with_demo=bool(arguments.init_load_demo_data))
+    session.open(db=db_name, with_demo=with_demo)
     # actual value after all defaultings have been done
     db_name = session.cr.dbname
 
@@ -143,19 +203,229 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
 
     upgrade_module = imp.load_source('anybox.recipe.odoo.upgrade_openerp',
                                      upgrade_script)
-    statuscode = getattr(upgrade_module, upgrade_callable)(session, logger)
+    with session.timed('upgrade_callable', callable=upgrade_callable):
+        statuscode = getattr(upgrade_module, upgrade_callable)(session,
+                                                               logger)
     if statuscode is None or statuscode == 0:
         if pkg_version is not None:
             logger.info("setting version %s in database" % pkg_version)
             session.db_version = pkg_version
+        if session.is_initialization or session.modules_up_to_date:
+            session.record_modules_fingerprints()
         session.cr.commit()
 
         logger.info("%s successful. Total time: %d seconds." % (
             "Initialization" if session.is_initialization else "Upgrade",
             ceil(total_seconds((datetime.utcnow() - start_time)))
         ))
-    else:
-        logger.error("Please check logs at %s" % log_path)
+    return statuscode
 
-    log_file.close()
-    sys.exit(statuscode)
+
+def report_path(log_path, ext):
+    """Return the path of a report file, next to the log file.
+
+    >>> report_path('/var/log/upgrade.log', '.json')
+    '/var/log/upgrade.json'
+    """
+    return os.path.splitext(log_path)[0] + ext
+
+
+def run_instrumented(session, db_name, upgrade_script, upgrade_callable,
+                     with_demo, logger, start_time, log_path, profile=False):
+    """Call :func:`run_upgrade`, and write reports next to the log file.
+
+    The JSON report (``.json`` extension) holds the database name, the
+    status code, and :attr:`Session.timings <.Session.timings>`. It is
+    written even if the upgrade raises an exception.
+
+    :param profile: if ``True``, the upgrade is run under :mod:`cProfile`,
+                    whose statistics get dumped with the ``.prof``
+                    extension. They can be read with :mod:`pstats`.
+    """
+    profiler = cProfile.Profile() if profile else None
+    report = dict(database=db_name, status=None,
+                  started=start_time.isoformat())
+    try:
+        args = (session, db_name, upgrade_script, upgrade_callable,
+                with_demo, logger, start_time)
+        if profiler is None:
+            report['status'] = run_upgrade(*args)
+        else:
+            report['status'] = profiler.runcall(run_upgrade, *args)
+        return report['status']
+    except Exception:
+        report['status'] = 'exception'
+        raise
+    finally:
+        if session.cr is not None:
+            report['database'] = session.cr.dbname
+        report['seconds'] = total_seconds(datetime.utcnow() - start_time)
+        report['phases'] = session.timings
+        json_path = report_path(log_path, '.json')
+        with open(json_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        logger.info("Timings written to %s", json_path)
+        if profiler is not None:
+            prof_path = report_path(log_path, '.prof')
+            profiler.dump_stats(prof_path)
+            logger.info("Profiling statistics written to %s", prof_path)
+
+
+def db_log_path(log_path, db_name):
+    """Return the path of the log file dedicated to a database.
+
+    >>> db_log_path('/var/log/upgrade.log', 'tenant1')
+    '/var/log/upgrade-tenant1.log'
+    """
+    base, ext = os.path.splitext(log_path)
+    return '%s-%s%s' % (base, db_name, ext)
+
+
+def list_databases(pattern):
+    """Return the sorted names of the databases matching pattern."""
+    import openerp
+    from openerp.service import db
+    names = db.exp_list(document=True)
+    # no connection must be inherited by the worker processes
+    openerp.sql_db.close_all()
+    return sorted(fnmatch.filter(names, pattern))
+
+
+_fanout = {}
+"""Parameters of :func:`upgrade_databases`, for the worker processes.
+
+They inherit it by forking, which spares pickling the session.
+"""
+
+
+def _upgrade_database(db_name):
+    """Upgrade one database in a worker process of :func:`upgrade_databases`.
+
+    :returns: the status code, 1 if the upgrade raised an exception
+    """
+    from openerp.tools import config
+    start_time = datetime.utcnow()
+    log_path = db_log_path(_fanout['log_path'], db_name)
+    config['logfile'] = log_path
+    logger = upgrade_logger(log_path, _fanout['log_level'])
+    try:
+        return run_instrumented(
+            _fanout['session'], db_name, _fanout['upgrade_script'],
+            _fanout['upgrade_callable'], _fanout['with_demo'], logger,
+            start_time, log_path, _fanout['profile'])
+    except Exception:
+        logger.exception("Upgrade of database %r failed", db_name)
+        return 1
+
+
+def exit_status(statuscode):
+    """Convert a status code of an upgrade callable to a process exit status.
+
+    >>> [exit_status(code) for code in (None, 0, 3, 'failed', 1000)]
+    [0, 0, 3, 1, 1]
+    """
+    if statuscode is None or statuscode == 0:
+        return 0
+    if isinstance(statuscode, int) and 0 < statuscode < 256:
+        return statuscode
+    return 1
+
+
+def _upgrade_process(db_name):
+    """Target of the worker processes of :func:`upgrade_databases`."""
+    sys.exit(exit_status(_upgrade_database(db_name)))
+
+
+def fan_out(target, items, jobs, poll_interval=POLL_INTERVAL):
+    """Call target on each item, in its own forked process.
+
+    Up to ``jobs`` processes run at a time. Their exit codes are checked
+    every ``poll_interval`` seconds, so that a process dying abruptly, e.g.,
+    killed by the OOM killer, is reported as any other failure instead of
+    leaving the caller waiting for it. Processes still running if the
+    iteration is interrupted get terminated.
+
+    :returns: an iterator over ``(item, exit code, duration in seconds)``
+              tuples, in order of completion. As for
+              :class:`multiprocessing.Process`, the exit code is ``-N`` if
+              the process was killed by signal ``N``.
+    """
+    pending = deque(items)
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < max(jobs, 1):
+                item = pending.popleft()
+                process = multiprocessing.Process(target=target,
+                                                  args=(item,))
+                process.start()
+                running.append((item, process, datetime.utcnow()))
+            done = [r for r in running if r[1].exitcode is not None]
+            if not done:
+                time.sleep(poll_interval)
+                continue
+            for item, process, started in done:
+                running.remove((item, process, started))
+                process.join()
+                yield (item, process.exitcode,
+                       total_seconds(datetime.utcnow() - started))
+    finally:
+        for _, process, _ in running:
+            process.terminate()
+            process.join()
+
+
+def upgrade_databases(session, upgrade_script, upgrade_callable, db_names,
+                      db_pattern, jobs, with_demo, log_path, log_level,
+                      console_level, profile=False):
+    """Run the upgrade callable for several databases, and sum up.
+
+    Each database is upgraded in its own process, forked from the current
+    one so that the import of OpenERP/Odoo is done only once, with up to
+    ``jobs`` of them at a time (see :func:`fan_out`). Each one logs to its
+    own file, see :func:`db_log_path`, and its own reports (see
+    :func:`run_instrumented`).
+
+    :returns: the overall status code, 0 if and only if all upgrades
+              succeeded.
+    """
+    start_time = datetime.utcnow()
+    logger = upgrade_logger(log_path, log_level, console_level)
+    names = [name for name in db_names if name is not None]
+    if db_pattern is not None:
+        names.extend(name for name in list_databases(db_pattern)
+                     if name not in names)
+    if not names:
+        logger.error("No database to upgrade")
+        return 1
+
+    logger.info("Upgrading %d databases, %d at a time, logging details "
+                "to %s", len(names), jobs, db_log_path(log_path, '*'))
+    _fanout.update(session=session, upgrade_script=upgrade_script,
+                   upgrade_callable=upgrade_callable, with_demo=with_demo,
+                   log_path=log_path, log_level=log_level,
+                   profile=profile)
+    results = {}
+    for db_name, exitcode, seconds in fan_out(_upgrade_process, names, jobs):
+        results[db_name] = exitcode
+        db_log = db_log_path(log_path, db_name)
+        if exitcode < 0:
+            logger.error("Database %r: upgrade process killed by signal %d "
+                         "after %d seconds, please check logs at %s",
+                         db_name, -exitcode, ceil(seconds), db_log)
+        elif exitcode:
+            logger.error("Database %r: failure (status code %d) after "
+                         "%d seconds, please check logs at %s",
+                         db_name, exitcode, ceil(seconds), db_log)
+        else:
+            logger.info("Database %r: success in %d seconds",
+                        db_name, ceil(seconds))
+
+    failed = [name for name in names if results[name]]
+    logger.info("Upgraded %d databases out of %d. Total time: %d seconds.",
+                len(names) - len(failed), len(names),
+                ceil(total_seconds(datetime.utcnow() - start_time)))
+    if failed:
+        logger.error("Failed databases: %s", ', '.join(failed))
+        return 1
+    return 0
@@ -127,18 +127,53 @@ class ServerRecipe(BaseRecipe):
 
         gunicorn_options['server_wide_modules'] = list(
             self.server_wide_modules) if self.server_wide_modules else ['web']
+        jitter = gunicorn_options.get('max_requests_jitter')
+        gunicorn_options['max_requests_jitter_line'] = (
+            '' if jitter is None
+            else 'max_requests_jitter = %s' % jitter + os.linesep)
+
+        soft_limit = self._gunicorn_megabytes(gunicorn_options,
+                                              'memory_soft_limit')
+        hard_limit = self._gunicorn_megabytes(gunicorn_options,
+                                              'memory_hard_limit')
+        address_space_limit = self._gunicorn_megabytes(
+            gunicorn_options, 'memory_address_space_limit')
+
+        auto_workers = ''
+        if gunicorn_options['workers'].strip().lower() == 'auto':
+            worker_memory = self._gunicorn_megabytes(
+                gunicorn_options, 'auto_worker_memory',
+                default=soft_limit or 256)
+            gunicorn_options['workers'] = '_auto_workers(%d)' % (
+                worker_memory << 20)
+            auto_workers = os.linesep.join((
+                "",
+                "",
+                "def _auto_workers(worker_memory):",
+                "    '''Size workers from the CPUs and available memory.'''",
+                "    import multiprocessing",
+                "    import psutil",
+                "    workers = 2 * multiprocessing.cpu_count() + 1",
+                "    try:",
+                "        available = psutil.virtual_memory().available",
+                "    except AttributeError:  # psutil < 0.6",
+                "        return workers",
+                "    return max(1, min(workers, available // worker_memory))",
+                "",
+            ))
+        gunicorn_options['auto_workers'] = auto_workers
 
         f = open(join(self.etc, qualified_name + '.conf.py'), 'w')
         conf = """'''Gunicorn configuration script.
 Generated by buildout. Do NOT edit.'''
-import openerp
+import openerp%(auto_workers)s
 bind = %(bind)r
 pidfile = %(qualified_name)r + '.pid'
 workers = %(workers)s
 
 timeout = %(timeout)s
 max_requests = %(max_requests)s
-
+%(max_requests_jitter_line)s
 openerp.multi_process = True  # needed even with only one worker
 openerp.conf.server_wide_modules = %(server_wide_modules)r
 conf = openerp.tools.config
@@ -160,9 +195,33 @@ conf = openerp.tools.config
 
             conf += 'conf[%r] = %r' % (opt, val) + os.linesep
 
-        preload_dbs = option_splitlines(self.options.get(
-            'gunicorn.preload_databases'))
-        if preload_dbs:
+        preload_dbs = list(option_splitlines(self.options.get(
+            'gunicorn.preload_databases')))
+        preload_app = self.options.get(
+            'gunicorn.preload_app', 'false').strip().lower() == 'true'
+        if preload_app:
+            conf += os.linesep.join((
+                "",
+                "preload_app = True",
+                "",
+                "def when_ready(server):",
+                "    '''Preload databases in the master, before forking.",
+                "",
+                "    Workers then share the registries copy-on-write.",
+                "    '''",
+                "    from openerp.modules.registry import RegistryManager",
+                "    preload_dbs = %r" % preload_dbs,
+                "    for db_name in preload_dbs:",
+                "        server.log.info('Master loading database %r',",
+                "                        db_name)",
+                "        RegistryManager.get(db_name)",
+                "    # connections can't be shared with the workers",
+                "    openerp.sql_db.close_all()",
+                "    server.log.info('OpenERP databases %r loaded, '",
+                "                    'ready to fork workers', preload_dbs)",
+                "",
+            ))
+        elif preload_dbs:
             conf += os.linesep.join((
                 "",
                 "def post_fork(server, worker):",
@@ -178,9 +237,76 @@ conf = openerp.tools.config
                 "                    'to serve requests', preload_dbs)",
             ))
 
+        if soft_limit is not None or hard_limit is not None:
+            conf += os.linesep.join((
+                "",
+                "",
+                "import multiprocessing",
+                "memory_recycles = multiprocessing.Value('i', 0)",
+                "memory_soft_limit = %r" % (
+                    soft_limit and soft_limit << 20),
+                "memory_hard_limit = %r" % (
+                    hard_limit and hard_limit << 20),
+                "",
+                "def post_request(worker, req, environ, resp):",
+                "    '''Recycle the worker if over the memory limits.",
+                "",
+                "    The worker exits gracefully, once done with the current",
+                "    request, and Gunicorn starts a new one.",
+                "    '''",
+                "    import os",
+                "    import psutil",
+                "    process = psutil.Process(os.getpid())",
+                "    memory_info = getattr(process, 'memory_info', None)",
+                "    if memory_info is None:  # psutil < 2.0",
+                "        memory_info = process.get_memory_info",
+                "    rss = memory_info().rss",
+                "    if memory_hard_limit is not None and (",
+                "            rss > memory_hard_limit):",
+                "        limit, log = 'hard', worker.log.error",
+                "    elif memory_soft_limit is not None and (",
+                "            rss > memory_soft_limit):",
+                "        limit, log = 'soft', worker.log.warning",
+                "    else:",
+                "        return",
+                "    with memory_recycles.get_lock():",
+                "        memory_recycles.value += 1",
+                "        recycles = memory_recycles.value",
+                "    log('Worker %d uses %d MB, over the memory %s limit, '",
+                "        'recycling it (%d memory recycles so far)',",
+                "        worker.pid, rss >> 20, limit, recycles)",
+                "    worker.alive = False",
+                "",
+            ))
+
+        if address_space_limit is not None:
+            conf += os.linesep.join((
+                "",
+                "",
+                "def post_worker_init(worker):",
+                "    '''Cap the address space of the worker.'''",
+                "    import resource",
+                "    address_space_limit = %d" % (address_space_limit << 20),
+                "    resource.setrlimit(resource.RLIMIT_AS,",
+                "                       (address_space_limit, "
+                "address_space_limit))",
+                "",
+            ))
+
         f.write(conf)
         f.close()
 
+    def _gunicorn_megabytes(self, gunicorn_options, name, default=None):
+        """Read an integer number of megabytes from gunicorn options."""
+        value = gunicorn_options.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise UserError("gunicorn.%s must be an integer number of "
+                            "megabytes, got %r" % (name, value))
+
     def _get_server_command(self):
         """Return a full path to the main OpenERP server command."""
         return join(self.openerp_dir, 'openerp-server')
@@ -367,34 +493,27 @@ conf = openerp.tools.config
     def _register_cron_worker_startup_script(self, qualified_name):
         """Register the cron worker script for installation.
 
-        This worker script has been introduced in openobject-server, rev 4184
-        together with changes in the main code that it requires.
-        These changes appeared in nightly build 6.1-20120530-233414.
-        The worker script itself does not appear in nightly builds.
+        See :mod:`anybox.recipe.odoo.runtime.cron_worker`.
         """
-        script_src = join(self.openerp_dir, 'openerp-cron-worker')
-        if not os.path.isfile(script_src):
-            version = self.version_detected
-            if ((version.startswith('6.1-2012') and version[4:12] < '20120530')
-                    or self.version_wanted == '6.1-1'):
-                logger.warn(
-                    "Can't use openerp-cron-worker with version %s "
-                    "You have to run a separate regular OpenERP process "
-                    "for cron jobs to be launched.", version)
-                return
-
-            logger.info("Cron launcher openerp-cron-worker not found in "
-                        "openerp source tree (version %s). "
-                        "This is expected with some nightly builds. "
-                        "Using the launcher script distributed "
-                        "with the recipe.", version)
-            script_src = join(os.path.split(__file__)[0],
-                              'openerp-cron-worker')
+        values = {}
+        for option, default in (('cron_workers', '1'),
+                                ('cron_worker_registries', '4')):
+            value = self.options.get(option, default).strip()
+            try:
+                value = int(value)
+            except ValueError:
+                value = 0
+            if value < 1:
+                raise UserError("%s must be a positive integer, "
+                                "got %r" % (option, self.options[option]))
+            values[option] = value
 
         desc = self._get_or_create_script('openerp_cron_worker',
                                           name=qualified_name)[1]
         desc.update(entry='openerp_cron_worker',
-                    arguments='%r, %r' % (script_src, self.config_path),
+                    arguments='%r, workers=%d, max_registries=%d' % (
+                        self.config_path, values['cron_workers'],
+                        values['cron_worker_registries']),
                     initialization='',
                     )
 
@@ -493,7 +612,7 @@ conf = openerp.tools.config
              'anybox.recipe.odoo.runtime.start_openerp',
              'main'),
             ('openerp_cron_worker',
-             'anybox.recipe.odoo.runtime.start_openerp',
+             'anybox.recipe.odoo.runtime.cron_worker',
              'main'),
             ('openerp-gevent',
              'openerp.cli',
@@ -0,0 +1,261 @@
+"""Static reading of OpenERP/Odoo's setup.py and release.py.
+
+The purpose is to extract the version and the requirements without running
+any code from the main software: its ``setup.py`` tends to import
+third-party packages (Babel being the most notorious), or to perform actions
+as soon as it is executed.
+
+This is done by evaluating module-level assignments with a restricted
+evaluator, that understands just enough Python expressions for the
+``release.py`` files of all known versions. Anything else raises
+:class:`StaticReadError`, and the caller is expected to fall back to
+executing ``setup.py``.
+"""
+import os
+import ast
+
+RELEASE_PATHS = (('openerp', 'release.py'),
+                 ('odoo', 'release.py'),
+                 ('bin', 'release.py'),
+                 )
+"""Known locations of release.py, relative to the main software directory.
+"""
+
+
+class StaticReadError(Exception):
+    """Raised if static reading is not possible."""
+
+
+def _str_method(name):
+    def method(obj, *args):
+        if not isinstance(obj, basestring):
+            raise StaticReadError("Unsupported call of %r on %r" % (
+                name, obj))
+        return getattr(obj, name)(*args)
+    return method
+
+
+SAFE_CALLABLES = dict(str=str, int=int, tuple=tuple, list=list, len=len,
+                      map=map, filter=filter)
+"""Builtins that can be called by the evaluated code."""
+
+SAFE_METHODS = dict((name, _str_method(name)) for name in (
+    'join', 'split', 'strip', 'lower', 'upper', 'replace'))
+"""String methods that can be called by the evaluated code."""
+
+BIN_OPS = {
+    ast.Add: lambda x, y: x + y,
+    ast.Sub: lambda x, y: x - y,
+    ast.Mult: lambda x, y: x * y,
+    ast.Mod: lambda x, y: x % y,
+}
+
+
+class Evaluator(object):
+    """Restricted evaluation of module-level assignments.
+
+    The resulting names are in :attr:`namespace`. Assignments that can't be
+    evaluated simply make their targets unknown, so that evaluation fails
+    only if they are actually needed.
+    """
+
+    def __init__(self):
+        self.namespace = {'True': True, 'False': False, 'None': None}
+
+    def run_module(self, tree):
+        for stmt in tree.body:
+            if isinstance(stmt, ast.Assign):
+                try:
+                    value = self.eval(stmt.value)
+                except StaticReadError:
+                    for target in stmt.targets:
+                        self.forget(target)
+                    continue
+                for target in stmt.targets:
+                    self.assign(target, value)
+
+    def forget(self, target):
+        if isinstance(target, ast.Name):
+            self.namespace.pop(target.id, None)
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for elt in target.elts:
+                self.forget(elt)
+
+    def assign(self, target, value):
+        if isinstance(target, ast.Name):
+            self.namespace[target.id] = value
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            value = list(value)
+            if len(value) != len(target.elts):
+                raise StaticReadError("Can't unpack %r" % value)
+            for elt, val in zip(target.elts, value):
+                self.assign(elt, val)
+        else:
+            self.forget(target)
+
+    def eval(self, node):
+        meth = getattr(self, 'eval_' + node.__class__.__name__, None)
+        if meth is None:
+            raise StaticReadError("Unsupported expression %r at line %s" % (
+                node.__class__.__name__, getattr(node, 'lineno', '?')))
+        return meth(node)
+
+    def eval_Str(self, node):
+        return node.s
+
+    def eval_Num(self, node):
+        return node.n
+
+    def eval_Name(self, node):
+        if node.id in self.namespace:
+            return self.namespace[node.id]
+        if node.id in SAFE_CALLABLES:
+            return SAFE_CALLABLES[node.id]
+        raise StaticReadError("Unknown name %r" % node.id)
+
+    def eval_Tuple(self, node):
+        return tuple(self.eval(elt) for elt in node.elts)
+
+    def eval_List(self, node):
+        return [self.eval(elt) for elt in node.elts]
+
+    def eval_Dict(self, node):
+        return dict((self.eval(k), self.eval(v))
+                    for k, v in zip(node.keys, node.values))
+
+    def eval_BinOp(self, node):
+        op = BIN_OPS.get(node.op.__class__)
+        if op is None:
+            raise StaticReadError("Unsupported operator %r" % node.op)
+        try:
+            return op(self.eval(node.left), self.eval(node.right))
+        except (TypeError, ValueError), exc:
+            raise StaticReadError(str(exc))
+
+    def eval_BoolOp(self, node):
+        values = (self.eval(v) for v in node.values)
+        if isinstance(node.op, ast.Or):
+            for value in values:
+                if value:
+                    return value
+        else:
+            for value in values:
+                if not value:
+                    return value
+        return value
+
+    def eval_Subscript(self, node):
+        value = self.eval(node.value)
+        sl = node.slice
+        try:
+            if isinstance(sl, ast.Index):
+                return value[self.eval(sl.value)]
+            elif isinstance(sl, ast.Slice) and sl.step is None:
+                lower = sl.lower and self.eval(sl.lower)
+                upper = sl.upper and self.eval(sl.upper)
+                return value[lower:upper]
+        except (TypeError, KeyError, IndexError), exc:
+            raise StaticReadError(str(exc))
+        raise StaticReadError("Unsupported subscript")
+
+    def eval_Call(self, node):
+        if node.keywords or node.starargs or node.kwargs:
+            raise StaticReadError("Unsupported call at line %d" % node.lineno)
+        args = [self.eval(arg) for arg in node.args]
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in SAFE_CALLABLES:
+            callable_ = SAFE_CALLABLES[func.id]
+        elif isinstance(func, ast.Attribute) and func.attr in SAFE_METHODS:
+            args.insert(0, self.eval(func.value))
+            callable_ = SAFE_METHODS[func.attr]
+        else:
+            raise StaticReadError("Unsupported call at line %d" % node.lineno)
+        if (callable_ in (map, filter) and args and args[0] is not None
+                and args[0] not in SAFE_CALLABLES.values()):
+            raise StaticReadError("Unsupported callable for map or filter")
+        try:
+            return callable_(*args)
+        except (TypeError, ValueError), exc:
+            raise StaticReadError(str(exc))
+
+
+def parse_file(path):
+    with open(path, 'rb') as f:
+        source = f.read()
+    try:
+        return ast.parse(source, path)
+    except SyntaxError, exc:
+        raise StaticReadError("Could not parse %r: %s" % (path, exc))
+
+
+def find_setup_call(tree):
+    """Return the ``setup()`` call node in the given module tree."""
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if ((isinstance(func, ast.Name) and func.id == 'setup')
+                or (isinstance(func, ast.Attribute)
+                    and func.attr == 'setup')):
+            return node
+    raise StaticReadError("setup() call not found")
+
+
+def release_path(openerp_dir):
+    """Return the path to release.py in openerp_dir, or None."""
+    for rel_path in RELEASE_PATHS:
+        path = os.path.join(openerp_dir, *rel_path)
+        if os.path.isfile(path):
+            return path
+
+
+def read_release(openerp_dir):
+    """Statically read release.py and return its version."""
+    path = release_path(openerp_dir)
+    if path is None:
+        raise StaticReadError("release.py not found in %r" % openerp_dir)
+    evaluator = Evaluator()
+    evaluator.run_module(parse_file(path))
+    version = evaluator.namespace.get('version')
+    if not isinstance(version, basestring):
+        raise StaticReadError("Could not evaluate version in %r" % path)
+    return version
+
+
+def read_setup(openerp_dir):
+    """Statically read version and requirements from setup.py.
+
+    The version is usually not a literal, but defined in ``release.py``,
+    that ``setup.py`` executes. Therefore, the namespace of ``release.py``
+    is evaluated first, then updated by the module-level assignments of
+    ``setup.py``.
+
+    :returns: the version, the list of requirements and the list of paths
+              of the files that have been read.
+    :raises: :class:`StaticReadError`
+    """
+    setup_path = os.path.join(openerp_dir, 'setup.py')
+    tree = parse_file(setup_path)
+    call = find_setup_call(tree)
+
+    evaluator = Evaluator()
+    paths = [setup_path]
+    rel_path = release_path(openerp_dir)
+    if rel_path is not None:
+        evaluator.run_module(parse_file(rel_path))
+        paths.append(rel_path)
+    evaluator.run_module(tree)
+
+    kwargs = dict((kw.arg, kw.value) for kw in call.keywords)
+    if 'version' not in kwargs:
+        raise StaticReadError("No version in setup() call")
+    version = evaluator.eval(kwargs['version'])
+    requirements = kwargs.get('install_requires')
+    requirements = [] if requirements is None else evaluator.eval(
+        requirements)
+    if not isinstance(version, basestring) or not isinstance(
+            requirements, (list, tuple)):
+        raise StaticReadError("Unexpected values for version (%r) or "
+                              "install_requires (%r)" % (version,
+                                                         requirements))
+    return version, list(requirements), paths
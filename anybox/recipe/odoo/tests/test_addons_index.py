@@ -0,0 +1,153 @@
+import os
+import unittest
+import tempfile
+import shutil
+
+from ..addons_index import build_index
+from ..addons_index import write_index
+from ..addons_index import load_index
+from ..addons_index import load_index_from_config
+from ..addons_index import is_fresh
+from ..addons_index import installable_modules
+from ..addons_index import module_checksum
+from ..addons_index import module_fingerprints
+from ..addons_index import modules_to_update
+
+
+class AddonsIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_module(self, addons_dir, name, manifest="{'depends': []}",
+                    manifest_name='__openerp__.py'):
+        module_dir = os.path.join(self.tmpdir, addons_dir, name)
+        os.makedirs(module_dir)
+        with open(os.path.join(module_dir, manifest_name), 'w') as f:
+            f.write(manifest)
+        return module_dir
+
+    def test_build_index(self):
+        main = self.make_module('one', 'main', "{'depends': ['base'],\n"
+                                "# a comment\n 'installable': False}")
+        self.make_module('one', 'base')
+        os.mkdir(os.path.join(self.tmpdir, 'one', 'not_a_module'))
+        other_base = self.make_module('two', 'base')
+        odoo10 = self.make_module('two', 'odoo10', "{'depends': ['main']}",
+                                  manifest_name='__manifest__.py')
+        self.make_module('two', 'not_literal', "dict(depends=[])")
+
+        paths = [os.path.join(self.tmpdir, 'one'),
+                 os.path.join(self.tmpdir, 'two')]
+        index = build_index(paths)
+        self.assertEqual(index['addons_paths'], paths)
+        modules = index['modules']
+        self.assertEqual(sorted(modules),
+                         ['base', 'main', 'not_literal', 'odoo10'])
+        self.assertEqual(modules['main']['path'], main)
+        self.assertEqual(modules['main']['depends'], ['base'])
+        self.assertFalse(modules['main']['installable'])
+        self.assertEqual(modules['odoo10']['path'], odoo10)
+        self.assertTrue(modules['odoo10']['installable'])
+        self.assertEqual(modules['not_literal']['depends'], [])
+        self.assertEqual(index['shadowed'], dict(base=[other_base]))
+
+    def test_write_load(self):
+        self.make_module('addons', 'mod')
+        index = build_index([os.path.join(self.tmpdir, 'addons')])
+        path = os.path.join(self.tmpdir, 'index.json')
+        self.assertTrue(write_index(index, path))
+        self.assertFalse(write_index(index, path))
+        self.assertEqual(load_index(path), index)
+
+        conf = os.path.join(self.tmpdir, 'odoo.cfg')
+        with open(conf, 'w') as f:
+            f.write("[options]\nxmlrpc_port = 8069\n")
+        self.assertIsNone(load_index_from_config(conf))
+        with open(conf, 'a') as f:
+            f.write("[buildout]\naddons_index = %s\n" % path)
+        self.assertEqual(load_index_from_config(conf), index)
+
+    def test_is_fresh(self):
+        self.make_module('addons', 'mod')
+        addons_dir = os.path.join(self.tmpdir, 'addons')
+        index = build_index([addons_dir])
+        self.assertTrue(is_fresh(index))
+        os.utime(addons_dir, (0, 0))  # as if a module had been added
+        self.assertFalse(is_fresh(index))
+
+    def test_installable_modules(self):
+        modules = dict(base=[], web=['base'], sale=['web', 'product'],
+                       product=['base', 'missing'], account=['base'],
+                       cyc1=['cyc2'], cyc2=['cyc1'], old=['base'])
+        index = dict(modules=dict(
+            (name, dict(depends=deps, installable=(name != 'old')))
+            for name, deps in modules.items()))
+        self.assertEqual(installable_modules(index),
+                         ['base', 'account', 'product', 'web', 'sale',
+                          'cyc1', 'cyc2'])
+
+    def test_module_checksum(self):
+        module_dir = self.make_module('one', 'mod')
+        os.mkdir(os.path.join(module_dir, 'models'))
+        py_path = os.path.join(module_dir, 'models', 'mod.py')
+        with open(py_path, 'w') as f:
+            f.write("# model\n")
+        checksum = module_checksum(module_dir)
+
+        # compiled files and VCS metadata don't count
+        with open(py_path + 'c', 'w') as f:
+            f.write("compiled")
+        os.mkdir(os.path.join(module_dir, '.git'))
+        self.assertEqual(module_checksum(module_dir), checksum)
+
+        with open(py_path, 'a') as f:
+            f.write("# uncommitted change\n")
+        self.assertNotEqual(module_checksum(module_dir), checksum)
+
+        # renaming a file is a change
+        checksum = module_checksum(module_dir)
+        os.rename(py_path, os.path.join(module_dir, 'models', 'other.py'))
+        self.assertNotEqual(module_checksum(module_dir), checksum)
+
+    def test_modules_to_update(self):
+        deps = dict(base=[], web=['base'], product=['base'],
+                    sale=['product', 'web'], sale_ext=['sale'])
+        index = dict(modules=dict(
+            (name, dict(depends=depends,
+                        path=self.make_module('addons', name)))
+            for name, depends in deps.items()))
+        index['modules']['gone'] = dict(
+            depends=[], path=os.path.join(self.tmpdir, 'addons', 'gone'))
+        installed = ['base', 'web', 'product', 'sale', 'sale_ext', 'gone',
+                     'unindexed']
+
+        previous = module_fingerprints(index)
+        self.assertEqual(sorted(previous), sorted(deps))
+        self.assertEqual(module_fingerprints(index, ['base', 'gone']),
+                         dict(base=previous['base']))
+        # modules not found can't be told to have changed
+        self.assertEqual(modules_to_update(index, installed, previous), [])
+
+        with open(os.path.join(index['modules']['sale']['path'],
+                               'sale.py'), 'w') as f:
+            f.write("# new file\n")
+        self.assertEqual(modules_to_update(index, installed, previous),
+                         ['sale', 'sale_ext'])
+
+        # not installed modules are ignored, their dependents as well
+        self.assertEqual(modules_to_update(index, ['base', 'web'], previous),
+                         [])
+
+        # current fingerprints can be passed along
+        current = dict(previous, base='changed')
+        self.assertEqual(modules_to_update(index, ['base', 'web'], previous,
+                                           current=current), ['base', 'web'])
+
+        # unknown previous fingerprints count as changes
+        del previous['base']
+        self.assertEqual(modules_to_update(index, installed, previous),
+                         sorted(deps))
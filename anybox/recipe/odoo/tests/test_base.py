@@ -1,11 +1,20 @@
 import os
 import sys
 import subprocess
+import tarfile
+import shutil
+import threading
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer
+import zc.buildout.easy_install
 from zc.buildout import UserError
 from ..server import BaseRecipe
 from ..base import main_software
+from ..base import rfc822_time
 from ..testing import RecipeTestCase
 from ..testing import get_vcs_log
+from ..utils import file_hash
+from .test_download import StandInHandler
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -73,6 +82,296 @@ class TestBaseRecipe(RecipeTestCase):
         self.assertDownloadUrl(url)
         self.assertEquals(recipe.archive_filename, 'openerp-12.0.tgz')
 
+    def test_version_url_sha256(self):
+        url = 'http://download.example/future/openerp-12.0.tgz'
+        sha256 = 'ab' * 32
+        self.make_recipe(version='url %s sha256=%s' % (url, sha256.upper()))
+        recipe = self.recipe
+        self.assertDownloadUrl(url)
+        self.assertEquals(recipe.archive_sha256, sha256)
+        self.assertEquals(recipe.archive_path,
+                          os.path.join(recipe.downloads_dir, 'sha256', sha256,
+                                       'openerp-12.0.tgz'))
+
+        for invalid in ('sha256=abcd', 'sha256=' + 'z' * 64, 'md5=abcd'):
+            version = 'url %s %s' % (url, invalid)
+            try:
+                self.make_recipe(version=version)
+            except UserError as exc:
+                self.assertTrue(repr(version) in str(exc))
+            else:
+                self.fail("Expected UserError for %r" % invalid)
+
+    def test_version_nightly_sha256(self):
+        sha256 = '01' * 32
+        self.make_recipe(version='nightly 8.0 1234-5 sha256=' + sha256)
+        self.assertDownloadUrl(
+            'http://nightly.odoo.com/8.0/nightly/src/'
+            '8-0-nightly-1234-5.tbz')
+        self.assertEquals(self.recipe.version_wanted, '1234-5')
+        self.assertEquals(os.path.dirname(self.recipe.archive_path),
+                          os.path.join(self.recipe.downloads_dir,
+                                       'sha256', sha256))
+
+    def test_main_download_sha256(self):
+        src = os.path.join(self.buildout_dir, 'openerp-12.0.tgz')
+        with open(src, 'w') as f:
+            f.write('not a real archive')
+        sha256 = file_hash(src)
+        url = 'file://' + src
+
+        self.make_recipe(version='url %s sha256=%s' % (url, '0' * 64))
+        archive_dir = os.path.dirname(self.recipe.archive_path)
+        self.assertRaises(UserError, self.recipe.main_download)
+        self.assertFalse(os.path.exists(self.recipe.archive_path))
+        self.assertEquals(os.listdir(archive_dir), [])
+
+        self.make_recipe(version='url %s sha256=%s' % (url, sha256))
+        self.recipe.main_download()
+        with open(self.recipe.archive_path) as f:
+            self.assertEquals(f.read(), 'not a real archive')
+        self.assertEquals(
+            os.listdir(os.path.dirname(self.recipe.archive_path)),
+            ['openerp-12.0.tgz'])
+
+    def serve_archive(self, failures=()):
+        """Serve an archive over HTTP, return the URL."""
+        server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        server.requests = []
+        server.failures = list(failures)
+        server.support_range = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d/openerp-12.0.tgz' % server.server_port
+
+    def test_main_download_not_found(self):
+        url = self.serve_archive(failures=[404])
+        self.make_recipe(version='url %s sha256=%s' % (url, '0' * 64))
+        try:
+            self.recipe.main_download()
+        except LookupError as exc:
+            self.assertTrue('not found' in str(exc))
+        else:
+            self.fail("Expected LookupError")
+        self.assertEquals(
+            os.listdir(os.path.dirname(self.recipe.archive_path)), [])
+
+    def test_main_download_concurrent(self):
+        url = self.serve_archive()
+        self.make_recipe(version='url ' + url)
+        # partial download by another buildout sharing the directory
+        archive_dir = os.path.dirname(self.recipe.archive_path)
+        other_part = self.recipe.archive_path + '.other.part'
+        with open(other_part, 'w') as f:
+            f.write('partial')
+        self.recipe.main_download()
+        with open(other_part) as f:
+            self.assertEquals(f.read(), 'partial')
+        self.assertEquals(sorted(os.listdir(archive_dir)),
+                          ['openerp-12.0.tgz', 'openerp-12.0.tgz.other.part'])
+        self.assertEquals(os.path.getsize(self.recipe.archive_path), 100000)
+
+    def make_archive(self, path, contents, extra_members=()):
+        """Create a tar.gz archive with a top directory, like Odoo ones.
+
+        :param contents: dict of file names (in top directory) to contents
+        :param extra_members: additional :class:`tarfile.TarInfo` instances
+        """
+        with tarfile.open(path, 'w:gz') as tar:
+            top = tarfile.TarInfo('odoo-8.0')
+            top.type = tarfile.DIRTYPE
+            top.mode = 0755
+            tar.addfile(top)
+            for name, content in sorted(contents.items()):
+                tinfo = tarfile.TarInfo('odoo-8.0/' + name)
+                tinfo.size = len(content)
+                tar.addfile(tinfo, StringIO(content))
+            for tinfo in extra_members:
+                tar.addfile(tinfo)
+
+    def test_extract_main_archive(self):
+        archive = os.path.join(self.buildout_dir, 'odoo.tgz')
+        self.make_archive(archive, {'setup.py': 'v1'})
+        os.mkdir(self.buildout['buildout']['parts-directory'])
+        self.make_recipe(version='url file://' + archive)
+        recipe = self.recipe
+
+        recipe.retrieve_main_software()
+        self.assertEquals(recipe.openerp_dir,
+                          os.path.join(recipe.parts, 'odoo-8.0'))
+        with open(os.path.join(recipe.openerp_dir, 'setup.py')) as f:
+            self.assertEquals(f.read(), 'v1')
+        self.assertEquals(sorted(os.listdir(recipe.parts)),
+                          ['.odoo-8.0.archive', 'odoo-8.0'])
+
+        # unchanged archive: no extraction
+        sentinel = os.path.join(recipe.openerp_dir, 'sentinel')
+        with open(sentinel, 'w') as f:
+            f.write('not in archive')
+        recipe.retrieve_main_software()
+        self.assertTrue(os.path.exists(sentinel))
+
+        # modified archive is extracted, previous tree is gone
+        self.make_archive(recipe.archive_path, {'setup.py': 'v2'})
+        recipe.retrieve_main_software()
+        self.assertFalse(os.path.exists(sentinel))
+        with open(os.path.join(recipe.openerp_dir, 'setup.py')) as f:
+            self.assertEquals(f.read(), 'v2')
+        self.assertEquals(sorted(os.listdir(recipe.parts)),
+                          ['.odoo-8.0.archive', 'odoo-8.0'])
+
+    def test_extract_main_archive_sandbox(self):
+        archive = os.path.join(self.buildout_dir, 'odoo.tgz')
+        evil = []
+        for name, linkname in (('odoo-8.0/../evil', None),
+                               ('odoo-8.0/abs_link', '/etc/passwd'),
+                               ('odoo-8.0/rel_link', '../../evil'),
+                               ('odoo-8.0/ok_link', 'setup.py')):
+            tinfo = tarfile.TarInfo(name)
+            if linkname is not None:
+                tinfo.type = tarfile.SYMTYPE
+                tinfo.linkname = linkname
+            evil.append(tinfo)
+        self.make_archive(archive, {'setup.py': 'v1'}, extra_members=evil)
+        os.mkdir(self.buildout['buildout']['parts-directory'])
+        self.make_recipe(version='url file://' + archive)
+
+        self.recipe.retrieve_main_software()
+        self.assertEquals(sorted(os.listdir(self.recipe.openerp_dir)),
+                          ['ok_link', 'setup.py'])
+        self.assertEquals(sorted(os.listdir(self.recipe.parts)),
+                          ['.odoo-8.0.archive', 'odoo-8.0'])
+
+    def test_read_openerp_setup(self):
+        oerp_dir = os.path.join(self.buildout_dir, 'odoo')
+        shutil.copytree(os.path.join(TEST_DIR, 'odoo80'), oerp_dir)
+        self.make_recipe(version='local odoo')
+        self.recipe.requirements = []
+        self.recipe.read_openerp_setup()
+        self.assertEquals(self.recipe.version_detected, '8.0alpha1')
+        self.assertEquals(self.recipe.requirements, [])
+        cached = self.recipe.state['openerp_setup']
+        self.assertEquals(sorted(cached['files']),
+                          [os.path.join(oerp_dir, 'openerp', 'release.py'),
+                           os.path.join(oerp_dir, 'setup.py')])
+
+        # state is persistent, and outdated by changes in setup.py
+        setup_path = os.path.join(oerp_dir, 'setup.py')
+        with open(setup_path) as f:
+            setup = f.read()
+        with open(setup_path, 'w') as f:
+            f.write(setup.replace("install_requires = [],",
+                                  "install_requires = ['foo>=1.0'],"))
+        self.make_recipe(version='local odoo')
+        self.recipe.requirements = []
+        self.assertTrue('openerp_setup' in self.recipe.state)
+        self.recipe.read_openerp_setup()
+        self.assertEquals(self.recipe.requirements, ['foo>=1.0'])
+
+        # unchanged files: the cache is used
+        self.make_recipe(version='local odoo')
+        self.recipe.requirements = []
+        self.recipe.state['openerp_setup']['requirements'] = ['from-cache']
+        self.recipe.read_openerp_setup()
+        self.assertEquals(self.recipe.requirements, ['from-cache'])
+        self.assertEquals(self.recipe.version_detected, '8.0alpha1')
+
+    def test_read_openerp_setup_exec(self):
+        """If static reading fails, setup.py is executed."""
+        oerp_dir = os.path.join(self.buildout_dir, 'odoo')
+        os.mkdir(oerp_dir)
+        with open(os.path.join(oerp_dir, 'setup.py'), 'w') as f:
+            f.write("import setuptools\n"
+                    "def version():\n"
+                    "    return '9.0'\n"
+                    "setuptools.setup(version=version(),\n"
+                    "                 install_requires=['bar'])\n")
+        self.make_recipe(version='local odoo')
+        self.recipe.requirements = []
+        self.recipe.read_openerp_setup()
+        self.assertEquals(self.recipe.version_detected, '9.0')
+        self.assertEquals(self.recipe.requirements, ['bar'])
+        self.assertEquals(self.recipe.state['openerp_setup']['version'],
+                          '9.0')
+
+    def test_phase_unchanged(self):
+        self.make_recipe(version='local odoo')
+        existing = os.path.join(self.buildout_dir, 'eggs')
+        inputs = dict(requirements=['foo'])
+        self.assertIsNone(self.recipe.phase_unchanged('test', inputs))
+        self.recipe.record_phase('test', inputs, paths=[existing],
+                                 working_set=[('Foo', '1.0')], extra=3)
+
+        # foo not being pinned, a newer version may exist
+        self.make_recipe(version='local odoo')
+        self.assertIsNone(self.recipe.phase_unchanged('test', inputs))
+
+        self.buildout['versions'] = dict(foo='1.0')
+        self.make_recipe(version='local odoo')
+        self.assertIsNone(self.recipe.phase_unchanged('test', inputs))
+        self.recipe.record_phase('test', inputs, paths=[existing],
+                                 working_set=[('Foo', '1.0')], extra=3)
+        self.make_recipe(version='local odoo')
+        stored = self.recipe.phase_unchanged('test', inputs)
+        self.assertEquals(stored['extra'], 3)
+
+        # changed inputs
+        self.assertIsNone(self.recipe.phase_unchanged(
+            'test', dict(requirements=['foo', 'bar'])))
+        self.buildout['versions']['foo'] = '1.1'
+        self.make_recipe(version='local odoo')
+        self.assertIsNone(self.recipe.phase_unchanged('test', inputs))
+
+        # offline: pinning does not matter
+        del self.buildout['versions']
+        self.make_recipe(version='local odoo')
+        self.recipe.record_phase('test', inputs, paths=[existing],
+                                 working_set=[('Foo', '1.0')])
+        self.buildout['buildout']['offline'] = 'true'
+        self.make_recipe(version='local odoo')
+        self.assertIsNotNone(self.recipe.phase_unchanged('test', inputs))
+
+        # recorded paths must still exist
+        os.rmdir(existing)
+        self.assertIsNone(self.recipe.phase_unchanged('test', inputs))
+
+    def test_develop_reuse(self):
+        src = os.path.join(self.buildout_dir, 'fake_babel')
+        shutil.copytree(os.path.join(TEST_DIR, 'fake_babel'), src)
+        self.make_recipe(version='local odoo')
+        self.recipe.recipe_requirements_paths = []
+        self.assertEquals(self.recipe.develop(src), 'Babel')
+
+        calls = []
+        orig_develop = zc.buildout.easy_install.develop
+
+        def develop(*args):
+            calls.append(args)
+            return orig_develop(*args)
+        zc.buildout.easy_install.develop = develop
+        try:
+            self.make_recipe(version='local odoo')
+            self.recipe.recipe_requirements_paths = []
+            self.assertEquals(self.recipe.develop(src), 'Babel')
+            self.assertEquals(calls, [])
+
+            with open(os.path.join(src, 'setup.py'), 'a') as f:
+                f.write("# changed\n")
+            self.assertEquals(self.recipe.develop(src), 'Babel')
+            self.assertEquals(len(calls), 1)
+
+            shutil.rmtree(os.path.join(src, 'Babel.egg-info'))
+            self.assertEquals(self.recipe.develop(src), 'Babel')
+            self.assertEquals(len(calls), 2)
+        finally:
+            zc.buildout.easy_install.develop = orig_develop
+
+    def test_rfc822_time(self):
+        self.assertEquals(rfc822_time('Thu, 01 Jan 1970 00:01:00 GMT'), 60)
+
     def test_base_url(self):
         self.make_recipe(version='8.0-1',
                          base_url='http://example.org/openerp')
@@ -303,3 +602,21 @@ class TestBaseRecipe(RecipeTestCase):
         self.recipe.finalize_addons_paths(check_existence=False)
         self.assertEquals(self.recipe.addons_paths,
                           [base_addons, '/some/separate/addons', odoo_addons])
+
+    def test_build_addons_index(self):
+        self.make_recipe(version='local odoo')
+        os.mkdir(self.recipe.parts)
+        addons_paths = []
+        for addons_dir in ('first', 'second'):
+            module_dir = os.path.join(self.buildout_dir, addons_dir, 'mod')
+            os.makedirs(module_dir)
+            with open(os.path.join(module_dir, '__openerp__.py'), 'w') as f:
+                f.write("{'depends': ['base']}")
+            addons_paths.append(os.path.dirname(module_dir))
+        self.recipe.addons_paths = addons_paths
+        index = self.recipe.build_addons_index()
+        self.assertEquals(index['modules']['mod']['path'],
+                          os.path.join(addons_paths[0], 'mod'))
+        self.assertEquals(index['shadowed'],
+                          dict(mod=[os.path.join(addons_paths[1], 'mod')]))
+        self.assertTrue(os.path.exists(self.recipe.addons_index_path))
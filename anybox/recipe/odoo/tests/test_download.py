@@ -0,0 +1,142 @@
+"""Test the streaming downloader against a local HTTP server."""
+import unittest
+import tempfile
+import shutil
+import os
+import re
+import threading
+import urllib2
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from ..download import Downloader
+
+CONTENT = ''.join(chr(i % 256) for i in range(100000))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT, honouring Range requests.
+
+    The behaviour can be altered through attributes of the server:
+
+    - ``support_range``: if False, always send the whole content
+    - ``failures``: list of failures to apply, one per request, either an
+      HTTP status code, or ``'cut'`` to close the connection in the middle
+      of the body.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.getheader('Range'))
+        failure = server.failures.pop(0) if server.failures else None
+        if isinstance(failure, int):
+            self.send_error(failure)
+            return
+
+        start = 0
+        range_header = self.headers.getheader('Range')
+        if range_header is not None and server.support_range:
+            start = int(re.match(r'bytes=(\d+)-', range_header).group(1))
+            if start >= len(CONTENT):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(CONTENT) - 1, len(CONTENT)))
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if failure == 'cut':
+            body = body[:len(body) / 3]
+        self.wfile.write(body)
+
+
+class DownloaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.target = os.path.join(self.dirpath, 'archive.tgz.part')
+        server = self.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        server.requests = []
+        server.failures = []
+        server.support_range = True
+        self.url = 'http://127.0.0.1:%d/archive.tgz' % server.server_port
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dirpath)
+
+    def download(self, **kw):
+        kw.setdefault('backoff', 0)
+        return Downloader(self.url, chunk_size=4096, **kw)(self.target)
+
+    def assertDownloaded(self):
+        with open(self.target, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_download(self):
+        info = self.download()
+        self.assertDownloaded()
+        self.assertEqual(info.gettype(), 'application/x-gzip')
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume(self):
+        with open(self.target, 'wb') as f:
+            f.write(CONTENT[:1000])
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests, ['bytes=1000-'])
+
+    def test_resume_not_supported(self):
+        self.server.support_range = False
+        with open(self.target, 'wb') as f:
+            f.write('garbage')
+        self.download()
+        self.assertDownloaded()
+
+    def test_resume_not_satisfiable(self):
+        with open(self.target, 'wb') as f:
+            f.write(CONTENT + 'garbage')
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests,
+                         ['bytes=%d-' % (len(CONTENT) + 7), None])
+
+    def test_retry_cut(self):
+        self.server.failures = ['cut', 'cut']
+        self.download()
+        self.assertDownloaded()
+        requests = self.server.requests
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(requests[0], None)
+        # each retry resumes from what has been received so far
+        self.assertTrue(requests[1].startswith('bytes='))
+        self.assertNotEqual(requests[1], requests[2])
+
+    def test_retry_server_error(self):
+        self.server.failures = [503]
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_too_many_failures(self):
+        self.server.failures = ['cut'] * 3
+        self.assertRaises(IOError, self.download, retries=2)
+        self.assertEqual(len(self.server.requests), 3)
+        # partial content is kept for later resuming
+        self.assertTrue(os.path.getsize(self.target) > 0)
+
+    def test_not_found(self):
+        self.server.failures = [404]
+        self.assertRaises(urllib2.HTTPError, self.download)
+        self.assertEqual(len(self.server.requests), 1)
@@ -59,6 +59,29 @@ class TestExtraction(RecipeTestCase):
                                '.fake_archival.txt')) as f:
             self.assertEquals(f.read(), 'fakerev')
 
+    def test_extract_addons_parallel(self):
+        target_dir = self.extract_target_dir
+        addons = ['fakevcs http://some/repo vcs-addons%d revspec' % i
+                  for i in range(5)]
+        addons.append('fakevcs http://some/grouped grpd revspec group=grp')
+        self.make_recipe(version='local mainsoftware',
+                         addons=os.linesep.join(addons),
+                         **{'vcs-parallel': '3'})
+
+        conf = ConfigParser()
+        extracted = set()
+        self.recipe._extract_sources(conf, target_dir, extracted)
+        expected = ['vcs-addons%d' % i for i in range(5)]
+        expected.append(os.path.join('grp', 'grpd'))
+        self.assertEquals(extracted, set(os.path.join(target_dir, path)
+                                         for path in expected))
+        for path in expected:
+            self.assertTrue(os.path.exists(os.path.join(
+                target_dir, path, '.fake_archival.txt')))
+        self.assertEquals(conf.get('openerp', 'addons').split(os.linesep),
+                          ['local vcs-addons%d' % i for i in range(5)]
+                          + ['local grp'])
+
     def test_extract_addons_revisions(self):
         """Test extract_downloads_to about revisions overriding.
 
@@ -172,3 +172,35 @@ class TestFreeze(RecipeTestCase):
         # shifted, that's just what the group option does internally
         self.assertEqual(outconf.get('openerp', 'revisions').splitlines(),
                          ['refspec', 'target rev1', 'stdl/stdln rev2'])
+
+    def freeze_to_contents(self, **options):
+        self.make_recipe(
+            version='pr_fakevcs http://main.soft.example odooo refspec',
+            addons="pr_fakevcs http://repo.example target rev1\n"
+            "local somwehere\n"
+            "pr_fakevcs http://repo2.example stdln rev2 group=stdl\n"
+            "pr_fakevcs http://repo3.example third rev3",
+            **options)
+        self.recipe.b_options[GP_VCS_EXTEND_DEVELOP] = (
+            "fakevcs+http://example.com/aeroolib#egg=aeroolib\n"
+            "fakevcs+http://example.com/other#egg=other")
+        if not os.path.isdir(self.recipe.openerp_dir):
+            os.makedirs(self.recipe.openerp_dir)
+        self.recipe.retrieve_main_software()
+        self.recipe.retrieve_addons()
+        self.fill_working_set()
+
+        tmpdir = tempfile.mkdtemp('test_recipe_freeze')
+        frozen_path = os.path.join(tmpdir, 'frozen.cfg')
+        try:
+            self.recipe.freeze_to(frozen_path)
+            with open(frozen_path) as f:
+                return f.read()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_freeze_to_parallel(self):
+        """Concurrent probing of sources gives the same frozen config."""
+        sequential = self.freeze_to_contents()
+        self.assertEqual(self.freeze_to_contents(**{'vcs-parallel': '4'}),
+                         sequential)
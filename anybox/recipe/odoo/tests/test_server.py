@@ -4,6 +4,7 @@ NB: zc.buildout.testing provides utilities for integration tests, with
 an embedded http server, etc.
 """
 import os
+import subprocess
 from pkg_resources import Requirement
 
 from ..base import MissingDistribution
@@ -12,6 +13,9 @@ from zc.buildout import UserError
 from ..server import ServerRecipe
 from ..testing import get_vcs_log
 from ..testing import RecipeTestCase
+from ..vcs import GitRepo
+from ..vcs.testing import COMMIT_USER_EMAIL
+from ..vcs.testing import COMMIT_USER_NAME
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -155,6 +159,106 @@ class TestServer(RecipeTestCase):
                           ])
         self.assertEquals(paths, [group_dir])
 
+    def test_retrieve_addons_parallel(self):
+        """With vcs-parallel, order of paths and VCS options are unchanged."""
+        self.make_recipe(
+            version='8.0', **{
+                'vcs-parallel': '4',
+                'addons': os.linesep.join(
+                    ['fakevcs http://trunk.example addons-%d rev' % d
+                     for d in range(10)] +
+                    ['fakevcs lp:my-addons%d addons%d last:1 '
+                     'group=grouped' % (d, d) for d in range(3)])})
+        self.assertEqual(self.recipe.vcs_parallel, 4)
+
+        self.recipe.retrieve_addons()
+        group_dir = os.path.join(self.buildout_dir, 'grouped')
+        self.assertEqual(self.recipe.addons_paths,
+                         [os.path.join(self.buildout_dir, 'addons-%d') % d
+                          for d in range(10)] + [group_dir])
+        self.assertEqual(
+            sorted(get_vcs_log()),
+            sorted([(os.path.join(self.buildout_dir, 'addons-%d' % d),
+                     'http://trunk.example', 'rev',
+                     dict(offline=False, clear_locks=False, clean=False))
+                    for d in range(10)] +
+                   [(os.path.join(group_dir, 'addons%d' % d),
+                     'lp:my-addons%d' % d, 'last:1',
+                     dict(offline=False, clear_locks=False, clean=False,
+                          group='grouped'))
+                    for d in range(3)]))
+
+    def test_vcs_parallel_invalid(self):
+        for value in ('0', '-2', 'many'):
+            self.assertRaises(UserError, self.make_recipe, version='8.0',
+                              **{'vcs-parallel': value})
+
+    def test_resolve_git_refs(self):
+        """All refs of a Git remote are resolved at once, and cached."""
+        src = os.path.join(self.buildout_dir, 'src-repo')
+        subprocess.check_call(['git', 'init', '-q', src])
+        subprocess.check_call(
+            ['git', '-c', 'user.name=' + COMMIT_USER_NAME,
+             '-c', 'user.email=' + COMMIT_USER_EMAIL,
+             'commit', '-q', '--allow-empty', '-m', 'initial'], cwd=src)
+        subprocess.check_call(['git', 'tag', 'v1'], cwd=src)
+        subprocess.check_call(['git', 'branch', 'other'], cwd=src)
+        sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=src).strip()
+
+        self.make_recipe(version='8.0', **{
+            'vcs-parallel': '2',
+            'addons': os.linesep.join((
+                'git %s addons1 master' % src,
+                'git %s addons2 v1' % src,
+                'fakevcs http://trunk.example addons3 rev')),
+            'merges': 'git %s addons1 other' % src})
+        try:
+            self.recipe.resolve_git_refs()
+            self.assertEqual(GitRepo.cached_remote_ref(src, 'master'),
+                             ('branch', sha))
+            self.assertEqual(GitRepo.cached_remote_ref(src, 'v1'),
+                             ('tag', sha))
+            self.assertEqual(GitRepo.cached_remote_ref(src, 'other'),
+                             ('branch', sha))
+        finally:
+            GitRepo._remote_refs.clear()
+
+    def test_resolve_git_refs_local_tag(self):
+        """Tags already in the target repository aren't queried."""
+        src = os.path.join(self.buildout_dir, 'src-repo')
+        subprocess.check_call(['git', 'init', '-q', src])
+        subprocess.check_call(
+            ['git', '-c', 'user.name=' + COMMIT_USER_NAME,
+             '-c', 'user.email=' + COMMIT_USER_EMAIL,
+             'commit', '-q', '--allow-empty', '-m', 'initial'], cwd=src)
+        subprocess.check_call(['git', 'tag', 'v1'], cwd=src)
+        subprocess.check_call(['git', 'clone', '-q', src,
+                               os.path.join(self.buildout_dir, 'addons1')])
+        subprocess.check_call(['git', 'tag', 'v2'], cwd=src)
+
+        self.make_recipe(version='8.0', **{
+            'addons': os.linesep.join((
+                'git %s addons1 v1' % src,
+                'git %s addons2 v2' % src))})
+        queried = []
+        orig = GitRepo.__dict__['resolve_remote_refs']
+        GitRepo.resolve_remote_refs = classmethod(
+            lambda cls, url, refs: queried.append((url, set(refs))))
+        try:
+            self.recipe.resolve_git_refs()
+        finally:
+            GitRepo.resolve_remote_refs = orig
+        # v1 is in addons1, whereas addons2 doesn't exist yet
+        self.assertEqual(queried, [(src, set(['v2']))])
+        # the retrieval won't need to look for v1 again
+        addons1 = os.path.join(self.buildout_dir, 'addons1')
+        try:
+            self.assertEqual(
+                GitRepo._fixed_revisions.keys(), [(addons1, 'v1')])
+        finally:
+            GitRepo._fixed_revisions.clear()
+
     def test_addons_standalone_oldstyle_prohibited(self):
         """Standalone addons must now be declared by the 'group' option."""
         dirname = 'standalone'
@@ -413,6 +517,92 @@ class TestServer(RecipeTestCase):
                 "['web', 'anybox_homepage']\n"
                 in gu)
 
+    def test_gunicorn_conf_preload_app(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct',
+                         **{'gunicorn.preload_app': 'true',
+                            'gunicorn.preload_databases': 'db1\ndb2'})
+        self.recipe.version_detected = "8.0alpha"
+        self.install_scripts()
+
+        with open(os.path.join(
+                self.buildout_dir, 'etc', 'gunicorn_openerp.conf.py')) as gu:
+            conf = gu.read()
+        compile(conf, 'gunicorn_openerp.conf.py', 'exec')
+        self.assertTrue("\npreload_app = True\n" in conf)
+        self.assertTrue("def when_ready(server):" in conf)
+        self.assertTrue("preload_dbs = ['db1', 'db2']" in conf)
+        self.assertFalse("def post_fork" in conf)
+        # no jitter unless configured
+        self.assertTrue("\nmax_requests = 2000\n\nopenerp.multi_process"
+                        in conf)
+        self.assertFalse("max_requests_jitter" in conf)
+
+    def test_gunicorn_conf_auto_workers(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct',
+                         **{'gunicorn.workers': 'auto',
+                            'gunicorn.auto_worker_memory': '100',
+                            'gunicorn.max_requests_jitter': '50'})
+        self.recipe.version_detected = "8.0alpha"
+        self.install_scripts()
+
+        with open(os.path.join(
+                self.buildout_dir, 'etc', 'gunicorn_openerp.conf.py')) as gu:
+            conf = gu.read()
+        compile(conf, 'gunicorn_openerp.conf.py', 'exec')
+        self.assertTrue("\nworkers = _auto_workers(104857600)\n" in conf)
+        self.assertTrue("\ndef _auto_workers(worker_memory):\n" in conf)
+        self.assertTrue("\nmax_requests_jitter = 50\n" in conf)
+
+    def test_gunicorn_conf_memory_limits(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct',
+                         **{'gunicorn.workers': 'auto',
+                            'gunicorn.memory_soft_limit': '512',
+                            'gunicorn.memory_hard_limit': '1024'})
+        self.recipe.version_detected = "8.0alpha"
+        self.install_scripts()
+
+        with open(os.path.join(
+                self.buildout_dir, 'etc', 'gunicorn_openerp.conf.py')) as gu:
+            conf = gu.read()
+        compile(conf, 'gunicorn_openerp.conf.py', 'exec')
+        # the soft limit is the default memory expected for a worker
+        self.assertTrue("\nworkers = _auto_workers(536870912)\n" in conf)
+        self.assertTrue(
+            "\ndef post_request(worker, req, environ, resp):\n" in conf)
+        self.assertTrue("\nmemory_soft_limit = 536870912\n" in conf)
+        self.assertTrue("\nmemory_hard_limit = 1073741824\n" in conf)
+        # no address space cap unless explicitly asked for
+        self.assertFalse("def post_worker_init" in conf)
+
+    def test_gunicorn_conf_memory_hard_limit(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct',
+                         **{'gunicorn.memory_hard_limit': '1024',
+                            'gunicorn.memory_address_space_limit': '2048'})
+        self.recipe.version_detected = "8.0alpha"
+        self.install_scripts()
+
+        with open(os.path.join(
+                self.buildout_dir, 'etc', 'gunicorn_openerp.conf.py')) as gu:
+            conf = gu.read()
+        compile(conf, 'gunicorn_openerp.conf.py', 'exec')
+        self.assertTrue(
+            "\ndef post_request(worker, req, environ, resp):\n" in conf)
+        self.assertTrue("\nmemory_soft_limit = None\n" in conf)
+        self.assertTrue("\nmemory_hard_limit = 1073741824\n" in conf)
+        self.assertTrue("\ndef post_worker_init(worker):\n" in conf)
+        self.assertTrue("    address_space_limit = 2147483648\n" in conf)
+
+    def test_gunicorn_conf_invalid_limit(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct',
+                         **{'gunicorn.memory_soft_limit': '1G'})
+        self.recipe.version_detected = "8.0alpha"
+        self.assertRaises(UserError, self.install_scripts)
+
     def test_install_scripts_80_no_devtools(self):
         self.test_install_scripts_80(with_devtools='false')
 
@@ -427,6 +617,30 @@ class TestServer(RecipeTestCase):
                             'cron_worker_openerp',
                             ))
 
+    def test_cron_workers(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct', cron_workers='3')
+        self.recipe.version_detected = "8.0alpha"
+
+        self.install_scripts()
+        script = self.read_script('cron_worker_openerp')
+        self.assertTrue("workers=3, max_registries=4" in script)
+
+    def test_cron_worker_registries(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct', cron_worker_registries='10')
+        self.recipe.version_detected = "8.0alpha"
+
+        self.install_scripts()
+        script = self.read_script('cron_worker_openerp')
+        self.assertTrue("workers=1, max_registries=10" in script)
+
+    def test_cron_workers_invalid(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
+                         gunicorn='direct', cron_workers='many')
+        self.recipe.version_detected = "8.0alpha"
+        self.assertRaises(UserError, self.install_scripts)
+
     def test_parse_openerp_scripts(self):
         self.make_recipe(
             version='local %s' % os.path.join(TEST_DIR, 'odoo80'),
@@ -0,0 +1,94 @@
+import os
+import unittest
+import tempfile
+import shutil
+
+from ..setup_reader import read_setup
+from ..setup_reader import read_release
+from ..setup_reader import StaticReadError
+
+TEST_DIR = os.path.dirname(__file__)
+
+RELEASE_10 = """
+RELEASE_LEVELS = [ALPHA, BETA, RELEASE_CANDIDATE, FINAL] = ['alpha', 'beta',
+                                                            'candidate',
+                                                            'final']
+RELEASE_LEVELS_DISPLAY = {ALPHA: ALPHA,
+                          BETA: BETA,
+                          RELEASE_CANDIDATE: 'rc',
+                          FINAL: ''}
+version_info = (10, 0, 0, FINAL, 0, '')
+version = '.'.join(map(str, version_info[:2])) + \\
+    RELEASE_LEVELS_DISPLAY[version_info[3]] + \\
+    str(version_info[4] or '') + version_info[5]
+series = serie = major_version = '.'.join(map(str, version_info[:2]))
+import os
+nt_service_name = "odoo-server-" + series.replace('~', '-')
+"""
+
+SETUP_10 = """
+import os
+from os.path import join, dirname
+from setuptools import find_packages, setup
+
+exec(open(join(dirname(__file__), 'odoo', 'release.py'), 'rb').read())
+lib_name = 'odoo'
+
+setup(
+    name='odoo',
+    version=version,
+    packages=find_packages(),
+    install_requires=[
+        'babel >= 1.0',
+        'decorator',
+    ],
+)
+"""
+
+
+class SetupReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.odoo_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.odoo_dir, 'odoo'))
+
+    def tearDown(self):
+        shutil.rmtree(self.odoo_dir)
+
+    def write(self, rel_path, contents):
+        with open(os.path.join(self.odoo_dir, rel_path), 'w') as f:
+            f.write(contents)
+
+    def test_odoo80(self):
+        odoo80 = os.path.join(TEST_DIR, 'odoo80')
+        version, requirements, paths = read_setup(odoo80)
+        self.assertEqual(version, '8.0alpha1')
+        self.assertEqual(requirements, [])
+        self.assertEqual(paths, [os.path.join(odoo80, 'setup.py'),
+                                 os.path.join(odoo80, 'openerp',
+                                              'release.py')])
+
+    def test_odoo10(self):
+        self.write('setup.py', SETUP_10)
+        self.write(os.path.join('odoo', 'release.py'), RELEASE_10)
+        version, requirements, paths = read_setup(self.odoo_dir)
+        self.assertEqual(version, '10.0')
+        self.assertEqual(requirements, ['babel >= 1.0', 'decorator'])
+        self.assertEqual(read_release(self.odoo_dir), '10.0')
+
+    def test_unsupported(self):
+        self.write('setup.py', SETUP_10.replace(
+            "version=version", "version=compute_version()"))
+        self.write(os.path.join('odoo', 'release.py'), RELEASE_10)
+        self.assertRaises(StaticReadError, read_setup, self.odoo_dir)
+
+        self.write('setup.py', "import os\n")
+        self.assertRaises(StaticReadError, read_setup, self.odoo_dir)
+
+    def test_no_code_execution(self):
+        self.write('setup.py', SETUP_10)
+        self.write(os.path.join('odoo', 'release.py'),
+                   "version = __import__('os').remove('setup.py')\n")
+        self.assertRaises(StaticReadError, read_setup, self.odoo_dir)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.odoo_dir, 'setup.py')))
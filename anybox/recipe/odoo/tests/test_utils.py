@@ -2,9 +2,14 @@ import unittest
 import tempfile
 import shutil
 import os
+import errno
+import logging
+import threading
 from datetime import timedelta
 
 from ..utils import working_directory_keeper, total_seconds
+from ..utils import ordered_parallel_map
+from ..utils import link_or_copy_tree
 
 
 class WorkingDirectoryTestCase(unittest.TestCase):
@@ -32,3 +37,115 @@ class VariousTestCase(unittest.TestCase):
         self.assertEqual(total_seconds(timedelta(1, 2)), 86402.0)
         self.assertEqual(total_seconds(timedelta(0, -3)), -3.0)
         self.assertEqual(total_seconds(timedelta(0, 12, 35000)), 12.035)
+
+
+class ListHandler(logging.Handler):
+    """Keep records messages in a list."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ParallelMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        logging.getLogger().addHandler(self.handler)
+        self.logger = logging.getLogger('test.parallel')
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+
+    def test_sequential(self):
+        self.assertEqual(ordered_parallel_map(lambda x: x * 2, (1, 2, 3)),
+                         [2, 4, 6])
+
+    def test_ordering(self):
+        threads = set()
+        # events make sure that item 1 finishes before item 0
+        done = dict((i, threading.Event()) for i in range(4))
+
+        def func(item):
+            threads.add(threading.current_thread().ident)
+            if item == 0:
+                done[1].wait(10)
+            self.logger.info("start %d", item)
+            self.logger.info("end %d", item)
+            done[item].set()
+            return item * 10
+
+        self.assertEqual(ordered_parallel_map(func, range(4), workers=2),
+                         [0, 10, 20, 30])
+        self.assertTrue(len(threads) > 1)
+        self.assertEqual(self.handler.messages,
+                         ['%s %d' % (step, i)
+                          for i in range(4) for step in ('start', 'end')])
+
+    def test_exception(self):
+        done = []
+
+        def func(item):
+            if item in (1, 2):
+                raise ValueError(item)
+            done.append(item)
+
+        try:
+            ordered_parallel_map(func, range(4), workers=3)
+        except ValueError as exc:
+            self.assertEqual(exc.args, (1,))
+        else:
+            self.fail("Expected ValueError")
+        self.assertEqual(sorted(done), [0, 3])
+
+
+class LinkOrCopyTreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.src, 'sub', 'subsub'))
+        for rel_path in ('a', os.path.join('sub', 'b'),
+                         os.path.join('sub', 'subsub', 'c')):
+            with open(os.path.join(self.src, rel_path), 'w') as f:
+                f.write(rel_path)
+        os.symlink('sub', os.path.join(self.src, 'link'))
+        self.dst = os.path.join(self.tmpdir, 'dst')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameTree(self):
+        for rel_path in ('a', os.path.join('sub', 'b'),
+                         os.path.join('sub', 'subsub', 'c')):
+            with open(os.path.join(self.dst, rel_path)) as f:
+                self.assertEqual(f.read(), rel_path)
+        link = os.path.join(self.dst, 'link')
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.readlink(link), 'sub')
+
+    def test_link(self):
+        link_or_copy_tree(self.src, self.dst)
+        self.assertSameTree()
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.src, 'sub', 'b'),
+            os.path.join(self.dst, 'sub', 'b')))
+
+    def test_copy_fallback(self):
+        orig_link = os.link
+
+        def failing_link(src, dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os.link = failing_link
+        try:
+            link_or_copy_tree(self.src, self.dst, workers=2)
+        finally:
+            os.link = orig_link
+        self.assertSameTree()
+        self.assertFalse(os.path.samefile(
+            os.path.join(self.src, 'sub', 'b'),
+            os.path.join(self.dst, 'sub', 'b')))
@@ -1,8 +1,16 @@
 import os
 import sys
 import re
+import shutil
+import hashlib
 import subprocess
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import logging
 logger = logging.getLogger(__name__)
 
@@ -162,6 +170,92 @@ def check_output(*popenargs, **kwargs):
 INLINE_COMMENT_REGEXP = re.compile(r'\s;|^;')
 
 
+def file_hash(path, algorithm='sha256', chunk_size=1 << 20):
+    """Return the hexadecimal digest of the file at path.
+
+    The file is read by chunks of the given size, so that big archives
+    don't need to fit in memory.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     f.write('abc')
+    ...     f.flush()
+    ...     file_hash(f.name, 'md5', chunk_size=2)
+    '900150983cd24fb0d6963f7d28e17f72'
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, previous=None):
+    """Return a fingerprint of the file at path, as a JSON serializable dict.
+
+    :param previous: a former fingerprint of the same file. If size and
+                     modification time are unchanged, its checksum is
+                     reused instead of being computed again.
+    :returns: ``None`` if there is no such file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    fingerprint = dict(size=stat.st_size, mtime=stat.st_mtime)
+    if (previous is not None
+            and previous.get('size') == fingerprint['size']
+            and previous.get('mtime') == fingerprint['mtime']):
+        fingerprint['sha256'] = previous.get('sha256')
+    else:
+        fingerprint['sha256'] = file_hash(path)
+    return fingerprint
+
+
+def files_unchanged(fingerprints):
+    """Tell if files are unchanged, given their former fingerprints.
+
+    :param fingerprints: dict whose keys are paths, and values are as
+                         returned by :func:`file_fingerprint`. Modification
+                         times are updated in place if the contents are the
+                         same.
+    """
+    if not fingerprints:
+        return False
+    for path, previous in fingerprints.items():
+        current = file_fingerprint(path, previous=previous)
+        if current is None or previous is None:
+            if current != previous:
+                return False
+        elif current['sha256'] != previous.get('sha256'):
+            return False
+        else:
+            previous.update(current)
+    return True
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path, shared with other processes.
+
+    The lock file is created if needed, and left in place afterwards. This
+    does not protect against other threads of the current process: combine
+    it with a :class:`threading.Lock` if needed. On platforms without
+    :mod:`fcntl`, this does nothing.
+    """
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def option_splitlines(opt_val):
     r"""Split a multiline option value.
 
@@ -250,3 +344,164 @@ def total_seconds(td):
 
     return ((td.microseconds +
              (td.seconds + td.days * 24 * 3600) * 1e6) / 10**6)
+
+
+class ThreadLogCapture(logging.Filter):
+    """A handler filter that holds back records emitted by worker threads.
+
+    The records are stored, together with the handler that was about to emit
+    them, in the list that ``buffers`` associates to the emitting thread.
+    Records from threads that don't appear in ``buffers`` are let through.
+    """
+
+    def __init__(self, handler, buffers):
+        logging.Filter.__init__(self)
+        self.handler = handler
+        self.buffers = buffers
+
+    def filter(self, record):
+        buf = self.buffers.get(threading.current_thread().ident)
+        if buf is None:
+            return True
+        buf.append((self.handler, record))
+        return False
+
+
+@contextmanager
+def captured_thread_logs():
+    """Context manager to hold back log records from worker threads.
+
+    Yields a ``dict`` whose keys are identifiers of threads whose log records
+    must be held back, and values lists of ``(handler, record)`` pairs.
+    Calling ``handler.handle(record)`` from a non registered thread
+    emits the record for good.
+
+    This acts on the handlers of the root logger only.
+    """
+    buffers = {}
+    installed = []
+    for handler in logging.getLogger().handlers:
+        capture = ThreadLogCapture(handler, buffers)
+        handler.addFilter(capture)
+        installed.append(capture)
+    try:
+        yield buffers
+    finally:
+        for capture in installed:
+            capture.handler.removeFilter(capture)
+
+
+def _captured_call(buffers, func, item):
+    """Call ``func(item)`` with log capture. Meant to run in a worker thread.
+
+    :returns: log records, return value and exception info (``None`` if
+              no exception occurred)
+    """
+    ident = threading.current_thread().ident
+    records = buffers[ident] = []
+    try:
+        try:
+            return records, func(item), None
+        except Exception:
+            return records, None, sys.exc_info()
+    finally:
+        del buffers[ident]
+
+
+POOL_WAIT_TIMEOUT = 1e6
+"""Timeout for waiting on each task of a thread pool.
+
+Waiting with a timeout is necessary with Python 2 for the main thread to be
+interruptible (think Ctrl-C).
+"""
+
+
+def ordered_parallel_map(func, items, workers=1):
+    """Apply func to all items in a pool of threads and return the results.
+
+    The results come in the same order as ``items``, and so do the log records
+    emitted from ``func``: they are held back until the main thread gets
+    to the corresponding item, then emitted together.
+    Output written directly by subprocesses is not affected.
+
+    If one or several of the calls raise an exception, all the other ones
+    are still waited for, then the first exception (in ``items`` order) is
+    re-raised.
+
+    :param workers: the maximum number of threads. If it is ``1`` (the
+                    default), everything happens in sequence in the current
+                    thread, with no log capture.
+    :returns: a list of results
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = []
+    error = None
+    pool = ThreadPool(min(workers, len(items)))
+    with captured_thread_logs() as buffers:
+        try:
+            async_results = [
+                pool.apply_async(_captured_call, (buffers, func, item))
+                for item in items]
+            for async_result in async_results:
+                records, result, exc_info = async_result.get(
+                    POOL_WAIT_TIMEOUT)
+                for handler, record in records:
+                    handler.handle(record)
+                if exc_info is not None and error is None:
+                    error = exc_info
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return results
+
+
+def link_or_copy_tree(src, dst, workers=1):
+    """Recursively reproduce the src directory as dst, using hard links.
+
+    This is meant for trees that are never modified in place, such as
+    extracted archives. Files get hard linked if possible, which costs no
+    data I/O at all. As soon as that fails (typically if src and dst are on
+    different filesystems), the remaining files get copied instead, with
+    up to ``workers`` copies going on concurrently.
+
+    As with :func:`shutil.copytree`, dst must not exist, symbolic links are
+    reproduced as such, and permissions of directories are preserved.
+    """
+    files = []
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, rel_dir))
+        os.mkdir(target_dir)
+        dirs.append((dirpath, target_dir))
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+                if name in dirnames:
+                    dirnames.remove(name)  # os.walk does not follow anyway
+            elif name in filenames:
+                files.append((path, target))
+
+    to_copy = []
+    for i, (path, target) in enumerate(files):
+        try:
+            os.link(path, target)
+        except OSError, exc:
+            logger.info("Could not hard link %r to %r (%s), copying "
+                        "remaining files instead", path, target, exc)
+            to_copy = files[i:]
+            break
+
+    ordered_parallel_map(lambda paths: shutil.copy2(*paths), to_copy,
+                         workers=workers)
+    for path, target in reversed(dirs):
+        shutil.copystat(path, target)
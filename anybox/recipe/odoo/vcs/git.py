@@ -1,11 +1,11 @@
 import os
 import subprocess
 import logging
-import tempfile
+import hashlib
+import threading
 
 from zc.buildout import UserError
 from .. import utils
-from ..utils import working_directory_keeper
 from ..utils import check_output
 from .base import BaseRepo
 from .base import SUBPROCESS_ENV
@@ -42,8 +42,31 @@ class GitRepo(BaseRepo):
 
     _git_version = None
 
+    _mirrors_updated = set()
+    """Paths of the mirrors already updated during this run."""
+
+    _mirrors_locks = {}
+    _mirrors_locks_lock = threading.Lock()
+
+    _remote_refs = {}
+    """Remote refs resolved beforehand for this run, by remote URL.
+
+    Values are dicts whose keys are the queried refs, and values as returned
+    by :meth:`query_remote_ref`.
+    """
+
+    _remote_refs_lock = threading.Lock()
+
+    _fixed_revisions = {}
+    """Fixed revisions found in target directories during this run.
+
+    Keys are ``(target_dir, revstr)`` pairs, values are full SHAs, as
+    returned by :meth:`have_fixed_revision`.
+    """
+
     def __init__(self, *args, **kwargs):
         super(GitRepo, self).__init__(*args, **kwargs)
+        self.mirrors_dir = self.options.pop('mirrors_dir', None)
         depth = self.options.pop('depth', None)
         if depth is not None and depth != 'None':
             # 'None' as a str can be used as an explicit per-repo override
@@ -141,46 +164,45 @@ class GitRepo(BaseRepo):
                  log_level=logging.INFO, **kw):
             """Wrap a subprocess call with logging
 
+            The call is done from within :attr:`target_dir` unless an explicit
+            ``cwd`` keyword argument is passed. This avoids changing the
+            working directory of the whole process.
+
             :param meth: the calling method to use.
             """
             logger.log(log_level, "%s> call %r", self.target_dir, cmd)
+            kw.setdefault('cwd', self.target_dir)
             return callwith(cmd, **kw)
 
     def clean(self):
         if not os.path.isdir(self.target_dir):
             return
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['git', 'clean', '-fdqx'])
+        subprocess.check_call(['git', 'clean', '-fdqx'], cwd=self.target_dir)
 
     def parents(self, pip_compatible=False):
         """Return full hash of parent nodes.
 
         :param pip_compatible: ignored, all Git revspecs are pip compatible
         """
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            p = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
-                                 stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
-            return p.communicate()[0].split()
+        p = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
+                             stdout=subprocess.PIPE, env=SUBPROCESS_ENV,
+                             cwd=self.target_dir)
+        return p.communicate()[0].split()
 
     def uncommitted_changes(self):
         """True if we have uncommitted changes."""
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            p = subprocess.Popen(['git', 'status', '--short'],
-                                 stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
-            out = p.communicate()[0]
-            return bool(out.strip())
+        p = subprocess.Popen(['git', 'status', '--short'],
+                             stdout=subprocess.PIPE, env=SUBPROCESS_ENV,
+                             cwd=self.target_dir)
+        out = p.communicate()[0]
+        return bool(out.strip())
 
     def get_current_remote_fetch(self):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            for line in self.log_call(['git', 'remote', '-v'],
-                                      callwith=check_output).splitlines():
-                if (line.endswith('(fetch)')
-                        and line.startswith(BUILDOUT_ORIGIN)):
-                    return line[len(BUILDOUT_ORIGIN):-7].strip()
+        for line in self.log_call(['git', 'remote', '-v'],
+                                  callwith=check_output).splitlines():
+            if (line.endswith('(fetch)')
+                    and line.startswith(BUILDOUT_ORIGIN)):
+                return line[len(BUILDOUT_ORIGIN):-7].strip()
 
     def offline_update(self, revision):
         target_dir = self.target_dir
@@ -201,18 +223,147 @@ class GitRepo(BaseRepo):
                             "Cannot update adresses in offline mode." % (
                                 self.target_dir, current_url, self.url))
         self.log_call(['git', 'checkout', revision],
-                      callwith=update_check_call,
-                      cwd=self.target_dir)
+                      callwith=update_check_call)
+
+    def have_fixed_revision(self, revstr):
+        """Return the commit for revstr if it is a fixed revision we have.
+
+        Fixed revisions are local tags and commits identified by a long
+        enough (12 chars) prefix of their SHA. As in
+        :meth:`HgRepo.have_fixed_revision`, tags are considered to be fixed,
+        even though they could be overridden upstream.
 
-    def fetch_remote_sha(self, sha):
+        Found revisions are cached for the rest of the run: the recipe
+        checks them once before resolving remote refs, and
+        :meth:`get_update` then reuses the result. Missing revisions
+        aren't cached, since a fetch can bring them.
+
+        :return: the full SHA of the commit, or ``None``
+        """
+        revstr = revstr.strip()
+        cache_key = (self.target_dir, revstr)
+        sha = self._fixed_revisions.get(cache_key)
+        if sha is not None:
+            return sha
+        if not revstr or not self.is_versioned(self.target_dir):
+            return None
+        by_sha = len(revstr) >= 12 and ishex(revstr)
+        if by_sha:
+            candidate = revstr + '^{commit}'
+        else:
+            candidate = 'refs/tags/%s^{commit}' % revstr
+
+        p = subprocess.Popen(['git', 'rev-parse', '-q', '--verify',
+                              candidate],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=SUBPROCESS_ENV, cwd=self.target_dir)
+        sha = p.communicate()[0].strip()
+        if p.returncode or not sha:
+            return None
+        if by_sha and not sha.startswith(revstr.lower()):
+            # a ref name that happens to be hexadecimal
+            return None
+        logger.info("[git] Found requested %s %r in %s as %s",
+                    'commit' if by_sha else 'tag', revstr,
+                    self.target_dir, sha)
+        self._fixed_revisions[cache_key] = sha
+        return sha
+
+    def fetch_remote_sha(self, sha, remote=BUILDOUT_ORIGIN):
         """Backwards compatibility wrapper."""
 
         logger.warn("Pointing to a remote commit directly by its SHA "
                     "is unsafe and heavy. It is only supported for "
                     "backwards compatibility.")
-        self.log_call(['git', 'fetch', BUILDOUT_ORIGIN])
+        parents = self.parents()
+        if parents and parents[0].startswith(sha):
+            logger.info("%s already at %s, nothing to fetch",
+                        self.target_dir, sha)
+            return
+        cmd = ['git', 'fetch', remote]
+        if remote != BUILDOUT_ORIGIN:
+            cmd.append('+refs/heads/*:refs/remotes/%s/*' % BUILDOUT_ORIGIN)
+        self.log_call(cmd)
         self.log_call(['git', 'checkout', sha])
 
+    @property
+    def mirror_path(self):
+        """Path to the bare mirror of :attr:`url`, or ``None``.
+
+        Mirrors are kept in :attr:`mirrors_dir`, one per remote URL.
+        """
+        if not self.mirrors_dir:
+            return None
+        name = os.path.basename(self.url.rstrip('/'))
+        if name.endswith('.git'):
+            name = name[:-4]
+        name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        return os.path.join(self.mirrors_dir, '%s-%s.git' % (
+            name, hashlib.sha1(self.url).hexdigest()[:12]))
+
+    @classmethod
+    def _mirror_lock(cls, path):
+        with cls._mirrors_locks_lock:
+            return cls._mirrors_locks.setdefault(path, threading.Lock())
+
+    def update_mirror(self):
+        """Create or update the bare mirror of :attr:`url`.
+
+        A given mirror is updated at most once per run, even if several
+        repositories, possibly retrieved concurrently, share it.
+        A ``.lock`` file next to the mirror also serializes its creation
+        and updates with other processes, such as buildouts sharing
+        the same :attr:`mirrors_dir`.
+        Automatic garbage collection is disabled in mirrors, because
+        working trees borrow their objects.
+
+        :returns: the mirror path
+        """
+        path = self.mirror_path
+        cls = self.__class__
+        with cls._mirror_lock(path):
+            if path in cls._mirrors_updated:
+                return path
+            if not os.path.isdir(self.mirrors_dir):
+                try:
+                    os.makedirs(self.mirrors_dir)
+                except OSError:
+                    if not os.path.isdir(self.mirrors_dir):
+                        raise
+            with utils.file_lock(path + '.lock'):
+                self._update_mirror(path)
+            cls._mirrors_updated.add(path)
+        return path
+
+    def _update_mirror(self, path):
+        """Clone or fetch the mirror, while holding its locks."""
+        if not os.path.exists(path):
+            logger.info("Creating Git mirror of %s in %s",
+                        self.url, path)
+            self.log_call(['git', 'clone', '--mirror', self.url, path],
+                          cwd=None, callwith=update_check_call)
+            self.log_call(['git', 'config', 'gc.auto', '0'], cwd=path)
+        else:
+            logger.info("Updating Git mirror %s", path)
+            self.log_call(['git', 'fetch', BUILDOUT_ORIGIN], cwd=path,
+                          callwith=update_check_call)
+
+    def borrow_mirror_objects(self, mirror):
+        """Register the objects of mirror as alternates of target_dir."""
+        objects = os.path.join(mirror, 'objects')
+        alternates = os.path.join(self.target_dir, '.git', 'objects',
+                                  'info', 'alternates')
+        if os.path.exists(alternates):
+            with open(alternates) as alt_file:
+                if objects in (line.strip() for line in alt_file):
+                    return
+        elif not os.path.isdir(os.path.dirname(alternates)):
+            os.makedirs(os.path.dirname(alternates))
+        logger.debug("Adding %s to Git alternates of %s",
+                     objects, self.target_dir)
+        with open(alternates, 'a') as alt_file:
+            alt_file.write(objects + '\n')
+
     def query_remote_ref(self, remote, ref):
         """Query remote repo about given ref.
 
@@ -220,16 +371,89 @@ class GitRepo(BaseRepo):
                  ``('branch', sha)`` if ref is branch (aka "head") in remote
                  ``(None, ref)`` if ref does not exist in remote. This happens
                  notably if ref if a commit sha (they can't be queried)
+
+        Refs that have been resolved beforehand by :meth:`resolve_remote_refs`
+        don't need to be queried again.
         """
-        out = self.log_call(['git', 'ls-remote', remote, ref],
-                            cwd=self.target_dir,
-                            callwith=check_output).strip()
-        for sha, fullref in (l.split() for l in out.splitlines()):
-            if fullref == 'refs/heads/' + ref:
-                return 'branch', sha
-            elif fullref == 'refs/tags/' + ref:
-                return 'tag', sha
-        return None, ref
+        cached = self.cached_remote_ref(remote, ref)
+        if cached is not None:
+            logger.debug("%s> ref %r of %r already resolved as %r",
+                         self.target_dir, ref, remote, cached)
+            return cached
+        logger.info("%s> querying %r about %r", self.target_dir, remote, ref)
+        return self.ls_remote(remote, (ref,), cwd=self.target_dir)[ref]
+
+    @classmethod
+    def cached_remote_ref(cls, remote, ref):
+        """Return what's been resolved about ref during this run, or None.
+        """
+        with cls._remote_refs_lock:
+            return cls._remote_refs.get(remote, {}).get(ref)
+
+    @classmethod
+    def ls_remote(cls, remote, refs, cwd=None):
+        """Query remote repo about several refs with a single ``ls-remote``.
+
+        :param cwd: needed only if remote is relative to a local repository
+        :return: a dict whose keys are the refs, and values are as in
+                 :meth:`query_remote_ref`
+        """
+        cmd = ['git', 'ls-remote', remote]
+        cmd.extend(sorted(set(refs)))
+        out = check_output(cmd, cwd=cwd).strip()
+        remote_refs = dict((fullref, sha) for sha, fullref in (
+            l.split() for l in out.splitlines()))
+        res = {}
+        for ref in refs:
+            if 'refs/heads/' + ref in remote_refs:
+                res[ref] = 'branch', remote_refs['refs/heads/' + ref]
+            elif 'refs/tags/' + ref in remote_refs:
+                res[ref] = 'tag', remote_refs['refs/tags/' + ref]
+            else:
+                res[ref] = None, ref
+        return res
+
+    @classmethod
+    def resolve_remote_refs(cls, remote, refs):
+        """Resolve several refs of remote at once, for the rest of the run.
+
+        Subsequent calls of :meth:`query_remote_ref` for these refs
+        will be answered without querying remote again.
+
+        :return: same as :meth:`ls_remote`
+        """
+        logger.info("Resolving refs %s of %r", ', '.join(sorted(refs)),
+                    remote)
+        res = cls.ls_remote(remote, refs)
+        with cls._remote_refs_lock:
+            cls._remote_refs.setdefault(remote, {}).update(res)
+        return res
+
+    def is_at_remote_ref(self, rtype, ref, sha):
+        """True if local repo is already on ref, as resolved remotely to sha.
+
+        For a branch, this means that ``HEAD``, the local branch and its
+        remote tracking branch are all on sha. For a tag, that the local tag
+        is sha, and ``HEAD`` is the commit it points to.
+        """
+        if rtype == 'branch':
+            revs = ('HEAD', 'refs/heads/' + ref,
+                    '/'.join(('refs', 'remotes', BUILDOUT_ORIGIN, ref)))
+            expected = [sha] * 3
+        elif rtype == 'tag':
+            revs = ('refs/tags/' + ref, 'HEAD', 'refs/tags/%s^{commit}' % ref)
+            expected = [sha]
+        else:
+            return False
+        p = subprocess.Popen(['git', 'rev-parse'] + list(revs),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=SUBPROCESS_ENV, cwd=self.target_dir)
+        out = p.communicate()[0].split()
+        if p.returncode:
+            return False
+        if rtype == 'tag':
+            expected.extend((out[1], out[1]))
+        return out == expected
 
     def get_update(self, revision):
         """Make it so that the target directory is at the prescribed revision.
@@ -246,39 +470,58 @@ class GitRepo(BaseRepo):
         target_dir = self.target_dir
         url = self.url
 
-        with working_directory_keeper:
-            is_new = not os.path.exists(target_dir)
-            if is_new:
-                self.log_call(['git', 'init', target_dir])
-
-            os.chdir(target_dir)
-            self.log_call(['git', 'remote', 'add' if is_new else 'set-url',
-                           BUILDOUT_ORIGIN, url],
-                          log_level=logging.DEBUG)
-
-            rtype, sha = self.query_remote_ref(BUILDOUT_ORIGIN, revision)
-            if rtype is None and ishex(revision):
-                return self.fetch_remote_sha(revision)
-
-            fetch_cmd = ['git', 'fetch']
-            depth = self.options.get('depth')
-            if depth is not None:
-                fetch_cmd.extend(('--depth', str(depth)))
-            if rtype == 'tag':
-                fetch_refspec = '+refs/tags/%s:refs/tags/%s' % (revision,
-                                                                revision)
-            else:
-                fetch_refspec = revision
-            fetch_cmd.extend((BUILDOUT_ORIGIN, fetch_refspec))
-            self.log_call(fetch_cmd, callwith=update_check_call)
-
-            if rtype == 'tag':
-                self.log_call(['git', 'checkout', revision])
-            elif rtype == 'branch':
-                self.update_fetched_branch(revision)
-            else:
-                raise NotImplementedError(
-                    "Unknown remote reference type %r" % rtype)
+        is_new = not os.path.exists(target_dir)
+        if is_new:
+            self.log_call(['git', 'init', target_dir], cwd=None)
+
+        self.log_call(['git', 'remote', 'add' if is_new else 'set-url',
+                       BUILDOUT_ORIGIN, url],
+                      log_level=logging.DEBUG)
+
+        if not is_new:
+            fixed = self.have_fixed_revision(revision)
+            if fixed is not None:
+                if self.parents() != [fixed]:
+                    self.log_call(['git', 'checkout', revision],
+                                  callwith=update_check_call)
+                return
+
+        fetch_remote = BUILDOUT_ORIGIN
+        query_remote = url
+        depth = self.options.get('depth')
+        if self.mirrors_dir:
+            fetch_remote = query_remote = self.update_mirror()
+            self.borrow_mirror_objects(fetch_remote)
+            # objects are shared with the mirror, nothing to gain
+            depth = None
+
+        rtype, sha = self.query_remote_ref(query_remote, revision)
+        if rtype is None and ishex(revision):
+            return self.fetch_remote_sha(revision, remote=fetch_remote)
+
+        if not is_new and self.is_at_remote_ref(rtype, revision, sha):
+            logger.info("%s already at %s %r (%s), nothing to fetch",
+                        target_dir, rtype, revision, sha)
+            return
+
+        fetch_cmd = ['git', 'fetch']
+        if depth is not None:
+            fetch_cmd.extend(('--depth', str(depth)))
+        if rtype == 'tag':
+            fetch_refspec = '+refs/tags/%s:refs/tags/%s' % (revision,
+                                                            revision)
+        else:
+            fetch_refspec = revision
+        fetch_cmd.extend((fetch_remote, fetch_refspec))
+        self.log_call(fetch_cmd, callwith=update_check_call)
+
+        if rtype == 'tag':
+            self.log_call(['git', 'checkout', revision])
+        elif rtype == 'branch':
+            self.update_fetched_branch(revision)
+        else:
+            raise NotImplementedError(
+                "Unknown remote reference type %r" % rtype)
 
     def update_fetched_branch(self, branch):
         # TODO: check what happens when there are local changes
@@ -288,7 +531,7 @@ class GitRepo(BaseRepo):
         # harm
         self.log_call(['git', 'update-ref', '/'.join((
             'refs', 'remotes', BUILDOUT_ORIGIN, branch)), 'FETCH_HEAD'])
-        if self.options.get('depth'):
+        if self.options.get('depth') and not self.mirrors_dir:
             # doing it the other way does not work, at least
             # not on Git 1.7
             self.log_call(['git', 'checkout', 'FETCH_HEAD'],
@@ -324,50 +567,68 @@ class GitRepo(BaseRepo):
 
     def merge(self, revision):
         """Merge revision into current branch"""
-        with working_directory_keeper:
-            if not self.is_versioned(self.target_dir):
-                raise RuntimeError("Cannot merge into non existent "
-                                   "or non git local directory %s" %
-                                   self.target_dir)
-            os.chdir(self.target_dir)
-            cmd = ['git', 'pull', self.url, revision]
-            if self.git_version >= (1, 7, 8):
-                # --edit and --no-edit appear with Git 1.7.8
-                # see Documentation/RelNotes/1.7.8.txt of Git
-                # (https://git.kernel.org/cgit/git/git.git/tree)
-                cmd.insert(2, '--no-edit')
-
-            self.log_call(cmd)
+        if not self.is_versioned(self.target_dir):
+            raise RuntimeError("Cannot merge into non existent "
+                               "or non git local directory %s" %
+                               self.target_dir)
+        cmd = ['git', 'pull', self.url, revision]
+        if self.git_version >= (1, 7, 8):
+            # --edit and --no-edit appear with Git 1.7.8
+            # see Documentation/RelNotes/1.7.8.txt of Git
+            # (https://git.kernel.org/cgit/git/git.git/tree)
+            cmd.insert(2, '--no-edit')
+
+        rtype, sha = self.cached_remote_ref(self.url, revision) or (None, None)
+        if rtype is not None and self.is_merged(sha):
+            logger.info("%s: %s %r (%s) already merged", self.target_dir,
+                        rtype, revision, sha)
+            return
+        self.log_call(cmd)
+
+    def is_merged(self, sha):
+        """True if commit sha is known locally and an ancestor of HEAD."""
+        p = subprocess.Popen(['git', 'merge-base', sha, 'HEAD'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=SUBPROCESS_ENV, cwd=self.target_dir)
+        out = p.communicate()[0].strip()
+        return not p.returncode and out == sha
 
     def archive(self, target_path):
         # TODO: does this work with merge-ins?
         revision = self.parents()[0]
         if not os.path.exists(target_path):
             os.makedirs(target_path)
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            target_tar = tempfile.NamedTemporaryFile(
-                prefix=os.path.split(self.target_dir)[1] + '.tar')
-            target_tar.file.close()
-            subprocess.check_call(['git', 'archive', revision,
-                                   '-o', target_tar.name])
-            subprocess.check_call(['tar', '-x', '-f', target_tar.name,
-                                   '-C', target_path])
-            os.unlink(target_tar.name)
+        # no intermediate file: the archive is piped straight to tar
+        archive_cmd = ['git', 'archive', revision]
+        tar_cmd = ['tar', '-x', '-f', '-', '-C', target_path]
+        archiver = subprocess.Popen(archive_cmd, cwd=self.target_dir,
+                                    stdout=subprocess.PIPE)
+        try:
+            tar = subprocess.Popen(tar_cmd, stdin=archiver.stdout)
+        finally:
+            # only tar must hold the reading end, so that git gets SIGPIPE
+            # if tar dies
+            archiver.stdout.close()
+        tar_code = tar.wait()
+        archive_code = archiver.wait()
+        if archive_code:
+            raise subprocess.CalledProcessError(archive_code, archive_cmd)
+        if tar_code:
+            raise subprocess.CalledProcessError(tar_code, tar_cmd)
 
     def revert(self, revision):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['git', 'checkout', revision])
-            if self._is_a_branch(revision):
-                self.log_call(['git', 'reset', '--hard',
-                              BUILDOUT_ORIGIN + '/' + revision],
-                              callwith=update_check_call)
-            else:
-                self.log_call(['git', 'reset', '--hard', revision])
+        subprocess.check_call(['git', 'checkout', revision],
+                              cwd=self.target_dir)
+        if self._is_a_branch(revision):
+            self.log_call(['git', 'reset', '--hard',
+                          BUILDOUT_ORIGIN + '/' + revision],
+                          callwith=update_check_call)
+        else:
+            self.log_call(['git', 'reset', '--hard', revision])
 
     def _is_a_branch(self, revision):
         # if this fails, we have a seriously corrupted repo
-        branches = update_check_output(["git", "branch"])
+        branches = update_check_output(["git", "branch"],
+                                       cwd=self.target_dir)
         branches = branches.split()
         return revision in branches
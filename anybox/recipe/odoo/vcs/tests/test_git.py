@@ -1,7 +1,9 @@
 """VCS tests: Git."""
 
 import os
+import time
 import subprocess
+import multiprocessing
 from zc.buildout import UserError
 from ..testing import COMMIT_USER_EMAIL
 from ..testing import COMMIT_USER_NAME
@@ -11,6 +13,7 @@ from ..git import BUILDOUT_ORIGIN
 from ..base import UpdateError
 from ...utils import working_directory_keeper, WorkingDirectoryKeeper
 from ...utils import check_output
+from ...utils import file_lock
 
 
 def git_set_user_info(repo_dir):
@@ -48,6 +51,11 @@ def git_write_commit(repo_dir, filepath, contents, msg="Unit test commit"):
 class GitBaseTestCase(VcsTestCase):
     """Common utilities for Git test cases."""
 
+    def setUp(self):
+        super(GitBaseTestCase, self).setUp()
+        GitRepo._remote_refs.clear()
+        GitRepo._fixed_revisions.clear()
+
     def create_src(self):
         os.chdir(self.src_dir)
         subprocess.call(['git', 'init', 'src-repo'])
@@ -291,6 +299,212 @@ class GitTestCase(GitBaseTestCase):
                          (None, 'deadbeef'))
 
 
+class GitResolutionTestCase(GitBaseTestCase):
+    """Batched resolution of remote refs, and updates avoidance."""
+
+    def test_resolve_remote_refs(self):
+        subprocess.check_call(['git', 'tag', 'v1', self.commit_1_sha],
+                              cwd=self.src_repo)
+        res = GitRepo.resolve_remote_refs(self.src_repo,
+                                          ['master', 'v1', 'unknown'])
+        self.assertEqual(res, {'master': ('branch', self.commit_2_sha),
+                               'v1': ('tag', self.commit_1_sha),
+                               'unknown': (None, 'unknown')})
+        self.assertEqual(GitRepo.cached_remote_ref(self.src_repo, 'v1'),
+                         ('tag', self.commit_1_sha))
+        self.assertEqual(GitRepo.cached_remote_ref(self.src_repo, 'other'),
+                         None)
+
+    def test_up_to_date_branch(self):
+        repo = GitRepo(os.path.join(self.dst_dir, "clone"), self.src_repo)
+        repo('master')
+        GitRepo.resolve_remote_refs(self.src_repo, ['master'])
+        self.assertTrue(repo.is_at_remote_ref('branch', 'master',
+                                              self.commit_2_sha))
+        self.assertFalse(repo.is_at_remote_ref('branch', 'master',
+                                               self.commit_1_sha))
+        self.assertFalse(repo.is_at_remote_ref('branch', 'other',
+                                               self.commit_2_sha))
+
+        # the resolution being obsolete, no fetch occurs
+        git_write_commit(self.src_repo, 'tracked',
+                         "new contents", msg="new commit")
+        repo('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+        GitRepo._remote_refs.clear()
+        repo('master')
+        self.assertNotEqual(repo.parents(), [self.commit_2_sha])
+
+    def test_up_to_date_tag(self):
+        subprocess.check_call(['git', 'tag', '-a', '-m', "annotated",
+                               'v1', self.commit_1_sha], cwd=self.src_repo)
+        repo = GitRepo(os.path.join(self.dst_dir, "clone"), self.src_repo)
+        repo('v1')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        rtype, sha = GitRepo.resolve_remote_refs(self.src_repo, ['v1'])['v1']
+        self.assertEqual(rtype, 'tag')
+        self.assertTrue(repo.is_at_remote_ref('tag', 'v1', sha))
+
+        git_write_commit(repo.target_dir, 'tracked', "local", msg="local")
+        self.assertFalse(repo.is_at_remote_ref('tag', 'v1', sha))
+
+    def test_fixed_revision(self):
+        subprocess.check_call(['git', 'tag', 'v1', self.commit_1_sha],
+                              cwd=self.src_repo)
+        repo = GitRepo(os.path.join(self.dst_dir, "clone"), self.src_repo)
+        self.assertIsNone(repo.have_fixed_revision(self.commit_1_sha))
+        repo('v1')
+
+        self.assertEqual(repo.have_fixed_revision('v1'), self.commit_1_sha)
+        self.assertEqual(repo.have_fixed_revision(self.commit_1_sha[:12]),
+                         self.commit_1_sha)
+        self.assertIsNone(repo.have_fixed_revision(self.commit_1_sha[:8]))
+        self.assertIsNone(repo.have_fixed_revision('master'))
+        self.assertIsNone(repo.have_fixed_revision('0' * 40))
+
+        # found revisions are checked only once per run
+        subprocess.check_call(['git', 'tag', '-d', 'v1'],
+                              cwd=repo.target_dir)
+        self.assertEqual(repo.have_fixed_revision('v1'), self.commit_1_sha)
+        GitRepo._fixed_revisions.clear()
+        self.assertIsNone(repo.have_fixed_revision('v1'))
+
+    def test_fixed_revision_no_network(self):
+        """Pinned commits and known tags are updated without the remote."""
+        repo = GitRepo(os.path.join(self.dst_dir, "clone"), self.src_repo)
+        repo('master')
+        subprocess.check_call(['git', 'tag', 'local-tag', self.commit_1_sha],
+                              cwd=repo.target_dir)
+        os.rename(self.src_repo, self.src_repo + '.unreachable')
+
+        repo(self.commit_1_sha)
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        repo(self.commit_2_sha)
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+        repo('local-tag')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        # already there
+        repo('local-tag')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+
+    def test_merge_already_merged(self):
+        subprocess.check_call(['git', 'branch', 'merged', self.commit_1_sha],
+                              cwd=self.src_repo)
+        repo = GitRepo(os.path.join(self.dst_dir, "clone"), self.src_repo)
+        repo('master')
+        self.assertTrue(repo.is_merged(self.commit_1_sha))
+        self.assertFalse(repo.is_merged('0' * 40))
+
+        GitRepo.resolve_remote_refs(self.src_repo, ['merged'])
+        GitRepo(repo.target_dir, self.src_repo, merge=True)('merged')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+
+class GitMirrorTestCase(GitBaseTestCase):
+    """Retrieval through a local bare mirror."""
+
+    def setUp(self):
+        super(GitMirrorTestCase, self).setUp()
+        self.mirrors_dir = os.path.join(self.sandbox, 'mirrors')
+        GitRepo._mirrors_updated.clear()
+
+    def tearDown(self):
+        GitRepo._mirrors_updated.clear()
+        super(GitMirrorTestCase, self).tearDown()
+
+    def make_repo(self, name):
+        return GitRepo(os.path.join(self.dst_dir, name), self.src_repo,
+                       mirrors_dir=self.mirrors_dir)
+
+    def test_clone(self):
+        repo = self.make_repo("clone 1")
+        repo('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+        self.assertEqual(repo.get_current_remote_fetch(), self.src_repo)
+
+        mirror = repo.mirror_path
+        self.assertTrue(mirror.startswith(self.mirrors_dir))
+        self.assertEqual(check_output(['git', 'config', 'core.bare'],
+                                      cwd=mirror).strip(), 'true')
+        alternates = os.path.join(repo.target_dir, '.git', 'objects',
+                                  'info', 'alternates')
+        with open(alternates) as alt_file:
+            self.assertEqual(alt_file.read().strip(),
+                             os.path.join(mirror, 'objects'))
+
+        # another clone of the same URL shares the mirror
+        repo2 = self.make_repo("clone 2")
+        self.assertEqual(repo2.mirror_path, mirror)
+        repo2('master')
+        self.assertEqual(repo2.parents(), [self.commit_2_sha])
+        with open(alternates) as alt_file:
+            self.assertEqual(len(alt_file.readlines()), 1)
+
+    def test_update_once_per_run(self):
+        repo = self.make_repo("clone")
+        repo('master')
+
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new contents", msg="new commit")
+        # the mirror has already been updated during this run
+        repo('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+        # next run
+        GitRepo._mirrors_updated.clear()
+        repo('master')
+        self.assertEqual(repo.parents(), [new_sha])
+
+    def update_mirror_in_process(self):
+        """Update the mirror in a separate process, as another buildout."""
+        def target():
+            GitRepo._mirrors_updated.clear()
+            os._exit(0 if os.path.isdir(
+                self.make_repo("clone").update_mirror()) else 1)
+        process = multiprocessing.Process(target=target)
+        process.start()
+        return process
+
+    def test_two_writers(self):
+        mirror = self.make_repo("clone").mirror_path
+        os.makedirs(self.mirrors_dir)
+        with file_lock(mirror + '.lock'):
+            writers = [self.update_mirror_in_process() for i in range(2)]
+            time.sleep(0.5)
+            # both are waiting for the lock
+            self.assertFalse(os.path.exists(mirror))
+            self.assertTrue(all(w.is_alive() for w in writers))
+        for writer in writers:
+            writer.join()
+        self.assertEqual([w.exitcode for w in writers], [0, 0])
+        self.assertEqual(check_output(['git', 'rev-parse', 'master'],
+                                      cwd=mirror).strip(), self.commit_2_sha)
+
+    def test_existing_clone(self):
+        """A clone made without mirror starts to use it."""
+        target_dir = os.path.join(self.dst_dir, "clone")
+        GitRepo(target_dir, self.src_repo)('master')
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new contents", msg="new commit")
+        repo = self.make_repo("clone")
+        repo('master')
+        self.assertEqual(repo.parents(), [new_sha])
+        self.assertTrue(os.path.exists(os.path.join(
+            target_dir, '.git', 'objects', 'info', 'alternates')))
+
+    def test_clone_on_sha(self):
+        repo = self.make_repo("clone")
+        repo(self.commit_1_sha)
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+
+    def test_depth_ignored(self):
+        repo = GitRepo(os.path.join(self.dst_dir, "clone"), self.src_repo,
+                       mirrors_dir=self.mirrors_dir, depth='1')
+        repo('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+
 class GitBranchTestCase(GitBaseTestCase):
 
     def create_src(self):